@@ -1,63 +1,39 @@
 """
 After generating the RGB images
-run any of the examples below to generate a movie with a given resolution and field of view.
+run the example below to generate movies with different resolutions and fields of view.
+All the movies are encoded in a single pass: the images are read and decoded only once.
+Remove the renditions you do not need, or call visualization.encode_video with a single one of them.
 """
 import visualization
+from visualization import VideoRendition
 
 
 # Directory of the rgb images
 images_dir = '/Users/rattie/Data/SDO/AIA/event_2012_08_31/rgb'
+# Number of frames per second
+fps = 30
 
-if __name__ == '__main__':
+renditions = [
     # Use uncropped images at 1/2 resolution (4096 x 4096 -> 2048 x 2048) - this only makes sense on 4k or 5k screens
-    frame_size = (2048, 2048)
-    filename = 'rgb_movie_full_half'
-    # Number of frames per second
-    fps = 30
-    # Encode movie
-    visualization.encode_video(images_dir, filename, fps=fps, frame_size=frame_size)
-
+    VideoRendition('rgb_movie_full_half', frame_size=(2048, 2048)),
 
     # Cropping over a 2048 x 2048 window in the bottom-left quadrant, at full resolution.
-    crop = [2048, 2048, 0, 2048] # [width, height, x, y] where x, y are top-left corner of the cropping window
-    frame_size = (2048, 2048)
-    filename = 'rgb_movie_crop_2048x2048_2048x2048'
-    fps = 30
-    # Encode movie
-    visualization.encode_video(images_dir, filename, crop=crop, frame_size=frame_size)
-
+    # crop = [width, height, x, y] where x, y are top-left corner of the cropping window
+    VideoRendition('rgb_movie_crop_2048x2048_2048x2048', crop=[2048, 2048, 0, 2048], frame_size=(2048, 2048)),
 
     # Same as before at half resolution
-    crop = [2048, 2048, 0, 2048] # [width, height, x, y] where x, y are top-left corner of the cropping window
-    frame_size = (1024, 1024)
-    filename = 'rgb_movie_2048x2048_1024x1024'
-    fps = 30
-    # Encode movie
-    visualization.encode_video(images_dir, filename, crop=crop, frame_size=frame_size)
+    VideoRendition('rgb_movie_2048x2048_1024x1024', crop=[2048, 2048, 0, 2048], frame_size=(1024, 1024)),
 
     # With a 16:9 aspect ratio, crop over 3840 x 2160 around bottom half and output at full HD resolution (1920 x 1080)
-    crop = [3840, 2160, 128, 1935]
-    frame_size = (1920, 1080)
-    filename = 'rgb_movie_3840x2160_1920x1080'
-    fps = 30
-    # Encode movie
-    command = visualization.encode_video(images_dir, filename, crop=crop, frame_size=frame_size)
-
+    VideoRendition('rgb_movie_3840x2160_1920x1080', crop=[3840, 2160, 128, 1935], frame_size=(1920, 1080)),
 
     # With a 16:9 aspect ratio, crop over 3840 x 2160 around bottom half and output at full resolution
-    crop = [3840, 2160, 128, 1935]
-    frame_size = (3840, 2160)
-    filename = 'rgb_movie_3840x2160_3840x2160'
-    fps = 30
-    # Encode movie
-    visualization.encode_video(images_dir, filename, crop=crop, frame_size=frame_size)
-
+    VideoRendition('rgb_movie_3840x2160_3840x2160', crop=[3840, 2160, 128, 1935], frame_size=(3840, 2160)),
 
     # full sun rescaled to 1080x1080 and padded at 1920 x 1080 for optimized youtube videos
-    frame_size = (1080, 1080)
-    padded_size = (1920, 1080)
-    filename = 'rgb_movie_full_padded_1920_1080'
-    # Number of frames per second
-    fps = 30
-    # Encode movie
-    visualization.encode_video(images_dir, filename, fps=fps, frame_size=frame_size, padded_size=padded_size)
+    VideoRendition('rgb_movie_full_padded_1920_1080', frame_size=(1080, 1080), padded_size=(1920, 1080)),
+]
+
+if __name__ == '__main__':
+    # Encode movies
+    command = visualization.encode_video(images_dir, fps=fps, renditions=renditions)
@@ -0,0 +1,298 @@
+"""
+Benchmarks of the calibration and rendering of AIA images, on synthetic data so that they run anywhere.
+
+Synthetic AIA-like level-1 compressed fits files are generated for the 304, 171 and 193 channels at each image size.
+Each step of the pipeline is timed, from the scaled rotation to the parallel processing of an image series, and the
+results are saved in a json file that can be compared with the results of a previous run:
+
+    python benchmark.py --sizes 1024 4096 --ncores 1 2 4 --output benchmark.json --compare previous.json
+
+Throughputs are in frames per second, latencies in seconds and peak resident set sizes in MB. The peak resident set size
+is the high-water mark of the process up to the end of each benchmark. Each parallel benchmark runs in a fresh process,
+so that its peak is that of its own largest process, the fresh process or one of its workers, and not that of the
+previous benchmarks.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import tempfile
+import multiprocessing
+import concurrent.futures
+import numpy as np
+from astropy.io import fits
+import cv2
+import calibration
+import visualization
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: peak memory is not reported
+    resource = None
+
+# Exposure time in seconds and quiet-sun disk count rate in DN/s of the synthetic channels
+synthetic_channels = {'304': (2.9, 40.0), '171': (2.0, 400.0), '193': (2.0, 500.0)}
+
+
+def synthetic_aia_image(size=calibration.aia_image_size, wavelength='171', seed=None):
+    """
+    AIA-like level-1 image: a limb-darkened solar disk, an exponentially decaying off-limb corona, a few bright active
+    regions and photon noise, in 14-bit detector counts. The disk radius is scaled with the image size so that the
+    image always covers the same field of view.
+
+    :param size: number of pixels along each axis
+    :param wavelength: one of the keys of synthetic_channels
+    :param seed: seed of the random number generator
+    :return: int16 image and exposure time in seconds
+    """
+    exptime, rate = synthetic_channels[wavelength]
+    rng = np.random.default_rng(seed)
+    # The solar radius is ~1600 px on the 4096 px detector
+    rsun = 0.39 * size
+    y, x = np.ogrid[:size, :size]
+    center = (size - 1) / 2.0
+    r = np.hypot(x - center, y - center) / rsun
+    mu = np.sqrt(np.clip(1 - r ** 2, 0, 1))
+    intensity = np.where(r < 1, 0.4 + 0.6 * mu, 0.3 * np.exp(-(r - 1) / 0.05))
+    for _ in range(5):
+        # Active regions on the disk
+        radius, theta = rng.uniform(0, 0.8), rng.uniform(0, 2 * np.pi)
+        ax, ay = center + radius * rsun * np.cos(theta), center + radius * rsun * np.sin(theta)
+        width = rng.uniform(0.02, 0.06) * rsun
+        intensity = intensity + rng.uniform(5, 20) * np.exp(-((x - ax) ** 2 + (y - ay) ** 2) / (2 * width ** 2))
+    counts = rng.poisson(intensity * rate * exptime)
+    return np.clip(counts, 0, 2 ** 14 - 1).astype(np.int16), exptime
+
+
+def write_synthetic_aia(filename, size=calibration.aia_image_size, wavelength='171',
+                        t_obs='2012-08-31T19:00:00.00Z', seed=None):
+    """
+    Write a synthetic image as a Rice-compressed fits file with a realistic AIA level-1 header, e.g. pointing
+    slightly off-center, a small roll angle and a pixel scale close to 0.6 arcsec.
+
+    :param filename: path to the fits file
+    :param size: number of pixels along each axis
+    :param wavelength: one of the keys of synthetic_channels
+    :param t_obs: observation time
+    :param seed: seed of the random number generator
+    :return: filename
+    """
+    data, exptime = synthetic_aia_image(size, wavelength=wavelength, seed=seed)
+    rng = np.random.default_rng(seed)
+    cdelt = 0.6 + rng.uniform(0, 0.0015)
+    hdu = fits.CompImageHDU(data, compression_type='RICE_1')
+    header = hdu.header
+    header['TELESCOP'] = 'SDO/AIA'
+    header['INSTRUME'] = 'AIA_%d' % {'304': 4, '171': 3, '193': 2}[wavelength]
+    header['LVL_NUM'] = 1.0
+    header['T_OBS'] = t_obs
+    header['DATE-OBS'] = t_obs.rstrip('Z')
+    header['WAVELNTH'] = int(wavelength)
+    header['WAVEUNIT'] = 'angstrom'
+    header['EXPTIME'] = exptime
+    header['BUNIT'] = 'DN'
+    header['CTYPE1'] = 'HPLN-TAN'
+    header['CTYPE2'] = 'HPLT-TAN'
+    header['CUNIT1'] = 'arcsec'
+    header['CUNIT2'] = 'arcsec'
+    header['CDELT1'] = cdelt
+    header['CDELT2'] = cdelt
+    header['CRPIX1'] = (size + 1) / 2.0 + rng.normal(0, 2)
+    header['CRPIX2'] = (size + 1) / 2.0 + rng.normal(0, 2)
+    header['CRVAL1'] = 0.0
+    header['CRVAL2'] = 0.0
+    header['CROTA2'] = rng.uniform(-0.1, 0.1)
+    header['RSUN_OBS'] = 0.39 * size * cdelt
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=True)
+    return filename
+
+
+def write_synthetic_series(directory, nimages, size=calibration.aia_image_size, cadence=12):
+    """
+    Write a time series of synthetic images of the 304, 171 and 193 channels, each channel in its own subdirectory.
+
+    :param directory: parent directory of the channel directories
+    :param nimages: number of images per channel
+    :param size: number of pixels along each axis
+    :param cadence: time between two images, in seconds
+    :return: list of the files of each channel, as the data_files of visualization.RGBMixer
+    """
+    start = datetime.datetime(2012, 8, 31, 19, 0, 0)
+    data_files = []
+    for wavelength in synthetic_channels:
+        wavel_dir = os.path.join(directory, wavelength)
+        os.makedirs(wavel_dir, exist_ok=True)
+        files = []
+        for i in range(nimages):
+            t_obs = (start + datetime.timedelta(seconds=i * cadence)).strftime('%Y-%m-%dT%H:%M:%S.00Z')
+            files.append(write_synthetic_aia(os.path.join(wavel_dir, 'aia.lev1.%sA_%04d.fits' % (wavelength, i)),
+                                             size=size, wavelength=wavelength, t_obs=t_obs, seed=i))
+        data_files.append(files)
+    return data_files
+
+
+def peak_rss(children=False):
+    """
+    :param children: set to True for the largest terminated child process instead of the current process
+    :return: peak resident set size in MB, or None if unavailable
+    """
+    if not children:
+        # On Linux, the high-water mark of the process itself. ru_maxrss keeps that of the parent process across the
+        # fork and exec of a process started by the spawn method.
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 2 ** 10
+        except OSError:
+            pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 2 ** 10
+
+
+def time_function(func, repeats=5, warmup=1):
+    """
+    Time a function call.
+
+    :param func: function without arguments
+    :param repeats: number of timed calls
+    :param warmup: number of untimed calls before, e.g. to allocate reusable buffers
+    :return: dictionary of throughput in calls per second, latency percentiles and peak resident set size
+    """
+    for _ in range(warmup):
+        func()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies)
+    return {'repeats': repeats,
+            'throughput': repeats / latencies.sum(),
+            'latency': dict(zip(('p50', 'p90', 'p99'), np.percentile(latencies, [50, 90, 99]).tolist())),
+            'peak_rss_mb': peak_rss()}
+
+
+def _process_rgb_list_run(aia_mixer, nprocs, nimages):
+    """ Parallel benchmark of run_benchmarks, run in a fresh process so that its peak resident set size is its own """
+    summary = aia_mixer.process_rgb_list(nprocs, range(nimages), progress_interval=None)
+    peaks = [peak for peak in (peak_rss(), peak_rss(children=True)) if peak is not None]
+    summary['peak_rss_mb'] = max(peaks) if peaks else None
+    return summary
+
+
+def run_benchmarks(sizes=(1024, calibration.aia_image_size), ncores=(1, 2), repeats=5, nimages=8, workdir=None):
+    """
+    Run the benchmarks at each image size, and the parallel processing with each number of processes.
+
+    :param sizes: sequence of image sizes
+    :param ncores: sequence of numbers of processes for RGBMixer.process_rgb_list
+    :param repeats: number of timed calls of each function
+    :param nimages: number of images of the series processed by RGBMixer.process_rgb_list
+    :param workdir: directory of the synthetic data and rendered images. Default is a temporary directory.
+    :return: list of results, one dictionary per benchmark with its name, image size and number of processes
+    """
+    if workdir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            return run_benchmarks(sizes, ncores, repeats, nimages, tmp_dir)
+
+    results = []
+
+    def record(name, size, result, nprocs=1):
+        result.update(name=name, size=size, ncores=nprocs)
+        results.append(result)
+        print('%-20s %5d px %2d cores: %8.2f frames/s, p50 %.4f s' % (name, size, nprocs, result['throughput'],
+                                                                       result['latency']['p50']))
+
+    for size in sizes:
+        size_dir = os.path.join(workdir, str(size))
+        data_files = write_synthetic_series(size_dir, nimages, size=size)
+        outputdir = os.path.join(size_dir, 'output')
+        os.makedirs(outputdir, exist_ok=True)
+
+        data, header = calibration.read_aia(data_files[1][0])
+        scale_factor = header['CDELT1'] / 0.6
+        reference_pixel = [header['CRPIX1'] - 1, header['CRPIX2'] - 1]
+        record('scale_rotate', size, time_function(lambda: calibration.scale_rotate(
+            data, angle=-header['CROTA2'], scale_factor=scale_factor, reference_pixel=reference_pixel), repeats))
+        record('aia_pad', size, time_function(lambda: calibration.aia_pad(data, size // 4, size // 4), repeats))
+        record('aiaprep', size, time_function(lambda: calibration.aiaprep(data_files[1][0], cropsize=size), repeats))
+
+        aia_mixer = visualization.RGBMixer(data_files=data_files, outputdir=outputdir)
+        aia_mixer.set_aia_default()
+        aia_mixer.cropsize = size
+        rgb = [calibration.aiaprep(files[0], cropsize=size) for files in data_files]
+        # Scaling values of the benchmark size: small images fill too little of the full-size grid for its percentiles
+        aia_mixer.ref_histogram = visualization.IntensityHistogram()
+        aia_mixer.ref_histogram.update(rgb)
+        aia_mixer.set_ref_low_high()
+        scale_args = dict(rgblow=aia_mixer.rgblow, rgbhigh=aia_mixer.rgbhigh, gamma_rgb=aia_mixer.gamma_rgb,
+                          rgbmix=aia_mixer.rgbmix, scalemin=aia_mixer.scalemin)
+        record('scale_rgb', size, time_function(lambda: visualization.scale_rgb(rgb, **scale_args), repeats))
+        bgr = visualization.scale_rgb(rgb, **scale_args)[:, :, ::-1]
+        record('process_lab_32bit', size, time_function(lambda: visualization.process_lab_32bit(
+            bgr, *aia_mixer.lab, lmin=aia_mixer.lmin), repeats))
+        record('process_rgb_image', size, time_function(lambda: aia_mixer.process_rgb(0), repeats))
+
+        for nprocs in ncores:
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                summary = executor.submit(_process_rgb_list_run, aia_mixer, nprocs, nimages).result()
+            record('process_rgb_list', size, {'repeats': summary['done'], 'throughput': summary['throughput'],
+                                              'latency': summary['latency'], 'stages': summary['stages'],
+                                              'peak_rss_mb': summary['peak_rss_mb']}, nprocs)
+    return results
+
+
+def benchmark_metadata():
+    """ Versions and hardware of the benchmark run """
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def compare_results(previous, current):
+    """
+    Print the throughput ratio of the current results over the previous ones, for the benchmarks present in both.
+
+    :param previous: list of results of a previous run
+    :param current: list of results of the current run
+    """
+    previous_results = {(r['name'], r['size'], r['ncores']): r for r in previous}
+    for result in current:
+        old = previous_results.get((result['name'], result['size'], result['ncores']))
+        if old is not None and old['throughput'] > 0:
+            print('%-20s %5d px %2d cores: %6.2fx' % (result['name'], result['size'], result['ncores'],
+                                                      result['throughput'] / old['throughput']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the AIA rgb pipeline on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, calibration.aia_image_size])
+    parser.add_argument('--ncores', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--nimages', type=int, default=8, help='number of images of the parallel benchmark')
+    parser.add_argument('--workdir', default=None, help='directory of the synthetic data. Default is temporary.')
+    parser.add_argument('--output', default='benchmark.json', help='json file of the results')
+    parser.add_argument('--compare', default=None, help='json file of previous results to compare with')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.ncores, args.repeats, args.nimages, args.workdir)
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': benchmark_metadata(), 'results': results}, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(json.load(f)['results'], results)
+
+
+if __name__ == '__main__':
+    main()
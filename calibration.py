@@ -1,10 +1,49 @@
+import os
 import numpy as np
 import cv2
 from astropy.io import fits
+import instrumentation
+import prefetch
 
 # The aia image size is fixed by the size of the detector. For AIA raw data, this has no reason to change.
 aia_image_size = 4096
 
+# Working precision of the calibrated data. 'float32' halves the memory footprint of 'float64' with no visible effect
+# on the 8-bit tone-mapped output. 'raw' keeps the detector counts in their integer type and leaves out the exposure time
+# normalization, which must then be folded into the intensity scaling values (see visualization.scale_rgb).
+precision_modes = ('float32', 'float64', 'raw')
+# Data types supported by cv2.warpAffine. Raw integer data of any other type is converted to float32.
+warp_dtypes = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+
+def precision_dtype(precision):
+    """
+    Floating point type used for computations in a given precision mode. Raw integer data are processed in float32.
+
+    :param precision: one of precision_modes
+    :return: numpy floating point type
+    """
+    if precision not in precision_modes:
+        raise ValueError('precision must be one of %s' % ', '.join(precision_modes))
+    return np.float64 if precision == 'float64' else np.float32
+
+
+def cast_data(data, precision):
+    """
+    Cast raw image data to the working type of the precision mode. In 'raw' mode, the data keep their integer type
+    unless not supported by opencv, but are converted to native byte order.
+
+    :param data: numpy array as read from the fits file
+    :param precision: one of precision_modes
+    :return: numpy array in native byte order
+    """
+    if precision == 'raw':
+        if data.dtype.type not in warp_dtypes:
+            return data.astype(np.float32)
+        return data.astype(data.dtype.newbyteorder('='), copy=False)
+    return data.astype(precision_dtype(precision))
+
+
 def scale_rotate(image, angle=0, scale_factor=1, reference_pixel=None):
     """
     Perform scaled rotation with opencv. About 20 times faster than with Sunpy & scikit/skimage warp methods.
@@ -22,6 +61,8 @@ def scale_rotate(image, angle=0, scale_factor=1, reference_pixel=None):
 
     if reference_pixel is None:
         reference_pixel = array_center
+    # opencv only parses python or numpy floats as coordinates
+    reference_pixel = np.asarray(reference_pixel, dtype=np.float64)
 
     # convert angle to radian
     angler = angle * np.pi / 180
@@ -57,13 +98,135 @@ def scale_rotate(image, angle=0, scale_factor=1, reference_pixel=None):
     return rotated_image
 
 
-def aiaprep(fitsfile, cropsize=aia_image_size):
+def scale_rotate_to_grid(image, output_shape, angle=0, scale_factor=1, reference_pixel=None, output_center=None,
+                         interpolation=cv2.INTER_LINEAR, downscale=1):
+    """
+    Perform the same scaled rotation as scale_rotate but warp directly into an output array of arbitrary shape, instead
+    of into a padded array that needs to be cropped afterwards. Nothing is allocated nor interpolated outside the output
+    grid, and pixels of the output falling outside the input image are set to 0.
+
+    :param image: Numpy 2D array
+    :param output_shape: (rows, cols) shape of the output array
+    :param angle: rotation angle in degrees. Positive angle  will rotate counterclocwise if array origin on top-left
+    :param scale_factor: ratio of the wavelength-dependent pixel scale over the target scale of 0.6 arcsec
+    :param reference_pixel: tuple of (x, y) coordinate. Given as (x, y) = (col, row) and not (row, col).
+    :param output_center: (x, y) coordinate in the output array where the reference pixel lands.
+    Default is the center of the output array.
+    :param interpolation: opencv interpolation flag. Default is bilinear, as used by scale_rotate.
+    :param downscale: integer factor by which the output is downscaled, e.g. for previews. The input is first averaged
+    over blocks of downscale x downscale pixels, and the affine transform is composed with the binning and the
+    downscaling so that the output samples the same grid as the full resolution output, downscale times coarser.
+    :return: scaled and rotated image of shape output_shape, or output_shape / downscale rounded up
+    """
+    if reference_pixel is None:
+        reference_pixel = (np.array(image.shape)[::-1] - 1) / 2.0
+    if output_center is None:
+        output_center = (np.array(output_shape)[::-1] - 1) / 2.0
+    reference_pixel = np.asarray(reference_pixel, dtype=np.float64)
+    output_center = np.asarray(output_center, dtype=np.float64)
+
+    rmatrix_cv = cv2.getRotationMatrix2D((reference_pixel[0], reference_pixel[1]), angle, scale_factor)
+    # The rotation matrix keeps the reference pixel in place. Shift it to the requested position in the output grid.
+    shift = output_center - reference_pixel
+    rmatrix_cv[0, 2] += shift[0]
+    rmatrix_cv[1, 2] += shift[1]
+    if downscale > 1:
+        rows, cols = image.shape
+        image = downscale_image(image, downscale)
+        # Full resolution coordinates of the centers of the binned input pixels
+        sx, sy = cols / image.shape[1], rows / image.shape[0]
+        binning = np.array([[sx, 0, (sx - 1) / 2], [0, sy, (sy - 1) / 2], [0, 0, 1]])
+        # Coordinates in the downscaled output of the full resolution output coordinates
+        downscaling = np.array([[1, 0, -(downscale - 1) / 2], [0, 1, -(downscale - 1) / 2]]) / downscale
+        rmatrix_cv = downscaling @ np.vstack([rmatrix_cv, [0, 0, 1]]) @ binning
+        output_shape = downscaled_shape(output_shape, downscale)
+    rotated_image = cv2.warpAffine(image, rmatrix_cv, (int(output_shape[1]), int(output_shape[0])),
+                                   flags=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return rotated_image
+
+
+def downscale_image(image, downscale):
+    """
+    Average an image over blocks of downscale x downscale pixels. Blocks at the right and bottom edges of images whose
+    size is not a multiple of downscale are partial.
+
+    :param image: Numpy 2D array
+    :param downscale: integer downscaling factor
+    :return: downscaled image of shape downscaled_shape(image.shape, downscale)
+    """
+    rows, cols = downscaled_shape(image.shape, downscale)
+    return cv2.resize(image, (cols, rows), interpolation=cv2.INTER_AREA)
+
+
+def downscaled_shape(shape, downscale):
+    """ (rows, cols) shape divided by downscale, rounded up """
+    return tuple(-(-int(size) // downscale) for size in shape)
+
+
+def aiaprep(fitsfile, cropsize=aia_image_size, precision='float32', return_header=False, crop_center=None,
+            downscale=1):
+    """
+    Calibrate an AIA level-1 fits file: normalize by the exposure time, rescale to 0.6 arcsec/px, rotate solar north up
+    and recenter on the reference pixel. With a cropsize, the data are warped directly into the output grid.
+
+    :param fitsfile: path to the fits file
+    :param cropsize: size of the output array. Either an integer for a square array or (width, height).
+    If None, the whole padded array of scale_rotate is returned.
+    :param precision: one of precision_modes. 'float32' (default), 'float64', or 'raw' to keep the integer detector
+    counts without exposure time normalization. In that case, the exposure time must be folded into the scaling values.
+    :param return_header: set to True to also return the fits header, e.g. to get the exposure time in 'raw' mode.
+    :param crop_center: (x, y) coordinates of the center of the output array in the full-size recentered image of
+    aia_image_size x aia_image_size pixels, where the reference pixel is at the center. Default is that center,
+    e.g. a cropsize of 2048 gives the central 2048 x 2048 window.
+    :param downscale: integer factor by which the output array is downscaled, with area averaging, e.g. 2, 4 or 8 for
+    fast previews. Requires a cropsize. The output array is the cropsize divided by downscale, rounded up.
+    :return: calibrated image, and the fits header if return_header is True
+    """
+    data, header = read_aia(fitsfile, precision=precision)
+    prepdata = prep_aia(data, header, cropsize=cropsize, crop_center=crop_center, downscale=downscale)
 
-    hdul = fits.open(fitsfile)
-    hdul[1].verify('silentfix')
-    header = hdul[1].header
-    data = hdul[1].data.astype(np.float64)
-    data /= header['EXPTIME']
+    if return_header:
+        return prepdata, header
+    return prepdata
+
+
+def read_aia(fitsfile, precision='float32'):
+    """
+    Read and decompress the image of an AIA level-1 fits file, normalized by the exposure time except in 'raw' mode.
+    This is the first step of aiaprep.
+
+    :param fitsfile: path to the fits file. Read from memory if prefetched, see prefetch.py
+    :param precision: one of precision_modes
+    :return: image and fits header
+    """
+    precision_dtype(precision)
+
+    with instrumentation.stage('read_aia') as stage:
+        hdul = fits.open(prefetch.fits_source(fitsfile))
+        hdul[1].verify('silentfix')
+        header = hdul[1].header
+        data = cast_data(hdul[1].data, precision)
+        if precision != 'raw':
+            data /= header['EXPTIME']
+        if instrumentation.enabled:
+            # No stat call when disabled
+            stage.add(bytes_read=os.path.getsize(fitsfile))
+    return data, header
+
+
+def prep_aia(data, header, cropsize=aia_image_size, crop_center=None, downscale=1):
+    """
+    Rescale, rotate and recenter an image read with read_aia. This is the second step of aiaprep.
+
+    :param data: image
+    :param header: fits header of the image
+    :param cropsize: see aiaprep
+    :param crop_center: see aiaprep
+    :param downscale: see aiaprep
+    :return: calibrated image
+    """
+    if downscale > 1 and cropsize is None:
+        raise ValueError('downscale requires a cropsize')
     # Target scale is 0.6 arcsec/px
     target_scale = 0.6
     scale_factor = header['CDELT1'] / target_scale
@@ -71,22 +234,42 @@ def aiaprep(fitsfile, cropsize=aia_image_size):
     reference_pixel = [header['CRPIX1'] - 1, header['CRPIX2'] - 1]
     # Rotation angle with openCV uses coordinate origin at top-left corner. For solar images in numpy we need to invert the angle.
     angle = -header['CROTA2']
-    # Run scaled rotation. The output will be a rotated, rescaled, padded array.
-    prepdata = scale_rotate(data, angle=angle, scale_factor=scale_factor, reference_pixel=reference_pixel)
-    prepdata[prepdata < 0] = 0
 
-    if cropsize is not None:
-        center = ((np.array(prepdata.shape) - 1) / 2.0).astype(int)
-        half_size = int(cropsize / 2)
-        prepdata = prepdata[center[1] - half_size:center[1] + half_size, center[0] - half_size:center[0] + half_size]
+    with instrumentation.stage('warp'):
+        if cropsize is None:
+            # Run scaled rotation. The output will be a rotated, rescaled, padded array.
+            prepdata = scale_rotate(data, angle=angle, scale_factor=scale_factor, reference_pixel=reference_pixel)
+        else:
+            output_shape, output_center = output_grid(cropsize, crop_center)
+            prepdata = scale_rotate_to_grid(data, output_shape, angle=angle, scale_factor=scale_factor,
+                                            reference_pixel=reference_pixel, output_center=output_center,
+                                            downscale=downscale)
+        prepdata[prepdata < 0] = 0
 
     return prepdata
 
 
+def output_grid(cropsize, crop_center=None):
+    """
+    Shape of the output array of aiaprep and the position of the reference pixel within it.
+
+    :param cropsize: integer for a square output array or (width, height)
+    :param crop_center: (x, y) center of the output array in the full-size recentered image. Default is its center.
+    :return: (rows, cols) output shape and (x, y) position of the reference pixel in the output array
+    """
+    width, height = np.broadcast_to(np.asarray(cropsize, dtype=int), 2)
+    full_center = np.array([aia_image_size - 1, aia_image_size - 1]) / 2.0
+    if crop_center is None:
+        crop_center = full_center
+    # Top-left corner of the output window in the full-size recentered image
+    origin = np.asarray(crop_center, dtype=np.float64) - (np.array([width, height]) - 1) / 2.0
+    return (int(height), int(width)), full_center - origin
+
+
 # Alternate padding method. On AIA, it is ~6x faster than numpy.pad used in Sunpy's aiaprep
 def aia_pad(image, pad_x, pad_y):
     newsize = [image.shape[0]+2*pad_y, image.shape[1]+2*pad_x]
-    pimage = np.empty(newsize)
+    pimage = np.empty(newsize, dtype=image.dtype)
     pimage[0:pad_y,:] = 0
     pimage[:,0:pad_x]=0
     pimage[pad_y+image.shape[0]:, :] = 0
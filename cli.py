@@ -0,0 +1,350 @@
+"""
+Command-line entry point of the pipeline, driven by a json or toml configuration file:
+
+    aia-reloaded prep config.toml      calibrate the images into the frame cache of the configuration
+    aia-reloaded render config.toml    render the rgb images
+    aia-reloaded encode config.toml    encode the movies of the rendered images with ffmpeg
+    aia-reloaded bench --sizes 1024    benchmark the pipeline on synthetic data, see benchmark.py
+
+or equivalently python cli.py <command> ... The configuration has 3 sections:
+[mixer] with the arguments and attributes of visualization.RGBMixer, [render] with the options of the parallel
+processing and [encode] with the movie renditions. See example_config.toml.
+
+Only the standard library is imported at startup: numpy, astropy, opencv and the pipeline modules are imported by the
+commands that need them. --help, --dry-run and the validation of the configuration are thus fast, and so is the
+startup of the spawned worker processes, which import this module as their main module.
+"""
+import os, sys
+import glob
+import json
+import argparse
+import subprocess
+
+# Keyword arguments of RGBMixer
+mixer_arguments = ('data_dir', 'wavel_dirs', 'data_files', 'calibrate', 'outputdir', 'ref', 'filename_lab',
+                   'filename_rgb', 'precision', 'time_tolerance', 'index_file')
+# Attributes of RGBMixer set before the scaling values
+mixer_processing = ('cropsize', 'crop_center', 'crop', 'reuse_buffers', 'nthreads', 'color_lut', 'strip_rows',
+                    'downscale')
+# Attributes of RGBMixer set after the default scaling values
+mixer_scaling = ('percentiles_low', 'percentiles_high', 'rgblow', 'rgbhigh', 'gamma_rgb', 'rgbmix', 'scalemin', 'lab',
+                 'lmin')
+config_keys = {
+    'mixer': mixer_arguments + mixer_processing + mixer_scaling + ('defaults', 'frame_cache', 'frame_cache_bytes',
+                                                                   'frame_writer'),
+    'render': ('ncores', 'file_range', 'max_pending', 'maxtasksperchild', 'progress_interval', 'manifest_file',
+               'hash_inputs', 'read_ahead', 'read_ahead_bytes', 'adaptive_scaling', 'queue_dir', 'lease_timeout',
+               'batch_size', 'trace_file'),
+    'encode': ('images_dir', 'fps', 'image_format', 'image_pattern_search', 'renditions'),
+}
+# Fields of visualization.VideoRendition
+rendition_keys = ('movie_filename', 'crop', 'frame_size', 'padded_size', 'fps', 'file_ext', 'codec', 'preset', 'crf',
+                  'pix_fmt')
+adaptive_scaling_keys = ('window', 'subsample')
+# Arguments of writers.FrameWriter
+frame_writer_keys = ('image_format', 'quality', 'png_compression', 'nthreads', 'max_pending')
+
+
+def load_config(filename):
+    """
+    Read and validate a configuration file.
+
+    :param filename: path to a .json or .toml file
+    :return: dictionary of the configuration sections
+    """
+    if filename.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            # Python < 3.11
+            import tomli as tomllib
+        with open(filename, 'rb') as f:
+            config = tomllib.load(f)
+    else:
+        with open(filename) as f:
+            config = json.load(f)
+    validate_config(config)
+    return config
+
+
+def _check_keys(name, table, keys):
+    if not isinstance(table, dict):
+        raise ValueError('%s must be a table' % name)
+    unknown = sorted(set(table) - set(keys))
+    if unknown:
+        raise ValueError('Unknown %s parameters: %s' % (name, ', '.join(unknown)))
+
+
+def validate_config(config):
+    """
+    Check the sections and parameters of a configuration, without reading any image.
+
+    :param config: dictionary of the configuration sections
+    """
+    _check_keys('configuration', config, config_keys)
+    for section, table in config.items():
+        _check_keys(section, table, config_keys[section])
+    mixer = config.get('mixer', {})
+    if mixer:
+        if 'outputdir' not in mixer:
+            raise ValueError('Missing mixer outputdir')
+        if 'data_files' not in mixer and 'wavel_dirs' not in mixer:
+            raise ValueError('Missing input directories or files. Need either wavel_dirs, OR data_files')
+        if mixer.get('defaults') not in (None, 'aia'):
+            raise ValueError("mixer defaults must be 'aia'")
+        if 'defaults' not in mixer and 'percentiles_high' not in mixer and 'rgbhigh' not in mixer:
+            raise ValueError("Missing scaling values. Need defaults = 'aia', percentiles_high or rgbhigh")
+        if ('rgblow' in mixer) != ('rgbhigh' in mixer):
+            raise ValueError('mixer rgblow and rgbhigh must be set together')
+        if 'frame_writer' in mixer:
+            _check_keys('frame_writer', mixer['frame_writer'], frame_writer_keys)
+    render = config.get('render', {})
+    file_range = render.get('file_range')
+    if isinstance(file_range, dict):
+        _check_keys('file_range', file_range, ('start', 'stop', 'step'))
+    elif file_range is not None and not (isinstance(file_range, list)
+                                         and all(isinstance(i, int) for i in file_range)):
+        raise ValueError('file_range must be a list of image indices or a table of start, stop and step')
+    if 'adaptive_scaling' in render:
+        _check_keys('adaptive_scaling', render['adaptive_scaling'], adaptive_scaling_keys)
+    encode = config.get('encode', {})
+    for rendition in encode.get('renditions', []):
+        _check_keys('rendition', rendition, rendition_keys)
+        if 'movie_filename' not in rendition:
+            raise ValueError('Missing rendition movie_filename')
+
+
+def check_command(config, command):
+    """
+    Check that a configuration has the sections and parameters required by a command.
+
+    :param config: dictionary of the configuration sections
+    :param command: 'prep', 'render' or 'encode'
+    """
+    mixer = config.get('mixer')
+    if command in ('prep', 'render') and mixer is None:
+        raise ValueError('Missing mixer section')
+    if command == 'prep' and 'frame_cache' not in mixer:
+        raise ValueError('prep requires a mixer frame_cache directory')
+    if (command == 'render' and 'adaptive_scaling' in config.get('render', {}) and mixer.get('calibrate', True)
+            and 'frame_cache' not in mixer):
+        raise ValueError('adaptive_scaling requires a mixer frame_cache directory')
+    if command == 'encode':
+        encode = config.get('encode', {})
+        if not encode.get('renditions'):
+            raise ValueError('Missing encode renditions')
+        if 'images_dir' not in encode and 'outputdir' not in config.get('mixer', {}):
+            raise ValueError('Missing encode images_dir or mixer outputdir')
+
+
+def input_files(mixer):
+    """
+    Input files of a mixer section, as found by RGBMixer without matching the images in time.
+
+    :param mixer: mixer section of the configuration
+    :return: list of the files of each channel
+    """
+    if 'data_files' in mixer:
+        return mixer['data_files']
+    data_dir = os.path.expanduser(mixer.get('data_dir', ''))
+    return [sorted(glob.glob(os.path.join(data_dir, wavel, '*.fits'))) for wavel in mixer['wavel_dirs']]
+
+
+def frame_indices(render, nimages):
+    """
+    :param render: render section of the configuration
+    :param nimages: number of images of the series
+    :return: list of the image indices to process. Default is all images.
+    """
+    file_range = render.get('file_range')
+    if file_range is None:
+        return list(range(nimages))
+    if isinstance(file_range, dict):
+        return list(range(file_range.get('start', 0), file_range.get('stop', nimages), file_range.get('step', 1)))
+    return list(file_range)
+
+
+def build_mixer(mixer, set_scaling=True):
+    """
+    Create the RGBMixer of a mixer section.
+
+    :param mixer: mixer section of the configuration
+    :param set_scaling: set to False to skip the scaling values, e.g. to only calibrate the images.
+    :return: RGBMixer
+    """
+    import numpy as np
+    import visualization
+
+    kwargs = {key: mixer[key] for key in mixer_arguments if key in mixer}
+    for key in ('data_dir', 'outputdir', 'index_file'):
+        if key in kwargs:
+            kwargs[key] = os.path.expanduser(kwargs[key])
+    os.makedirs(kwargs['outputdir'], exist_ok=True)
+    aia_mixer = visualization.RGBMixer(**kwargs)
+    if 'frame_cache' in mixer:
+        from frame_cache import FrameCache
+        aia_mixer.frame_cache = FrameCache(os.path.expanduser(mixer['frame_cache']),
+                                           max_bytes=mixer.get('frame_cache_bytes'))
+    if 'frame_writer' in mixer:
+        from writers import FrameWriter
+        aia_mixer.frame_writer = FrameWriter(**mixer['frame_writer'])
+    for key in mixer_processing:
+        if key in mixer:
+            value = mixer[key]
+            if key == 'crop':
+                # [[x start, x stop], [y start, y stop]]
+                value = tuple(slice(*bounds) for bounds in value)
+            elif isinstance(value, list):
+                value = tuple(value)
+            setattr(aia_mixer, key, value)
+    if not set_scaling:
+        return aia_mixer
+
+    if mixer.get('defaults') == 'aia':
+        aia_mixer.set_aia_default()
+        # set_aia_default names the output images
+        for key in ('filename_lab', 'filename_rgb'):
+            if key in mixer:
+                setattr(aia_mixer, key, mixer[key])
+    for key in mixer_scaling:
+        if key in mixer:
+            value = mixer[key]
+            setattr(aia_mixer, key, np.array(value) if key in ('rgblow', 'rgbhigh', 'rgbmix') else value)
+    if ('percentiles_low' in mixer or 'percentiles_high' in mixer) and 'rgbhigh' not in mixer:
+        if getattr(aia_mixer, 'ref_histogram', None) is None:
+            aia_mixer.set_ref_histogram()
+        aia_mixer.set_ref_low_high()
+    return aia_mixer
+
+
+# Frame cache and calibration parameters of the worker processes of the prep command, set by _init_prep_worker.
+_prep_state = None
+
+
+def _init_prep_worker(frame_cache, data_files, cropsize, precision, crop_center, downscale=1):
+    global _prep_state
+    _prep_state = (frame_cache, data_files, cropsize, precision, crop_center, downscale)
+
+
+def _prep_worker(image_index):
+    frame_cache, data_files, cropsize, precision, crop_center, downscale = _prep_state
+    for files in data_files:
+        frame_cache.aiaprep(files[image_index], cropsize=cropsize, precision=precision, crop_center=crop_center,
+                            downscale=downscale)
+    return {'index': image_index}
+
+
+def run_prep(config, args):
+    mixer = config['mixer']
+    render = config.get('render', {})
+    ncores = args.ncores if args.ncores is not None else render.get('ncores', 1)
+    if args.dry_run:
+        files = input_files(mixer)
+        indices = frame_indices(render, min(len(channel) for channel in files))
+        print('Would calibrate %d images of %d channels into %s with %d processes'
+              % (len(indices), len(files), mixer['frame_cache'], ncores))
+        return
+
+    from pipeline import FramePipeline
+    aia_mixer = build_mixer(mixer, set_scaling=False)
+    indices = frame_indices(render, len(aia_mixer.data_files[0]))
+    frame_pipeline = FramePipeline(ncores, progress_interval=render.get('progress_interval', 10))
+    frame_pipeline.run(_prep_worker, indices, initializer=_init_prep_worker,
+                       initargs=(aia_mixer.frame_cache, aia_mixer.data_files, aia_mixer.cropsize, aia_mixer.precision,
+                                 aia_mixer.crop_center, aia_mixer.downscale))
+
+
+def run_render(config, args):
+    mixer = config['mixer']
+    render = config.get('render', {})
+    ncores = args.ncores if args.ncores is not None else render.get('ncores', 1)
+    if args.dry_run:
+        files = input_files(mixer)
+        indices = frame_indices(render, min(len(channel) for channel in files))
+        print('Would render %d images from %s files to %s with %d processes'
+              % (len(indices), ' / '.join(str(len(channel)) for channel in files), mixer['outputdir'], ncores))
+        return
+
+    import instrumentation
+    aia_mixer = build_mixer(mixer)
+    indices = frame_indices(render, len(aia_mixer.data_files[0]))
+    if 'trace_file' in render:
+        instrumentation.enable()
+    if 'adaptive_scaling' in render:
+        aia_mixer.set_adaptive_scaling(indices, ncores=ncores, **render['adaptive_scaling'])
+    progress_interval = render.get('progress_interval', 10)
+    if 'queue_dir' in render:
+        summary = aia_mixer.process_rgb_queue(os.path.expanduser(render['queue_dir']), indices, ncores=ncores,
+                                              batch_size=render.get('batch_size'),
+                                              lease_timeout=render.get('lease_timeout', 600),
+                                              progress_interval=progress_interval)
+    else:
+        options = {key: render[key] for key in ('max_pending', 'maxtasksperchild', 'manifest_file', 'hash_inputs',
+                                                'read_ahead', 'read_ahead_bytes') if key in render}
+        summary = aia_mixer.process_rgb_list(ncores, indices, progress_interval=progress_interval, **options)
+    if 'trace_file' in render:
+        print(instrumentation.summary_table())
+        instrumentation.write_trace(render['trace_file'])
+    return summary
+
+
+def run_encode(config, args):
+    encode = config['encode']
+    images_dir = encode.get('images_dir', config.get('mixer', {}).get('outputdir'))
+
+    import visualization
+    renditions = [visualization.VideoRendition(**{key: tuple(value) if isinstance(value, list) else value
+                                                  for key, value in rendition.items()})
+                  for rendition in encode['renditions']]
+    command = visualization.encode_video(os.path.expanduser(images_dir), fps=encode.get('fps', 30),
+                                         image_format=encode.get('image_format', 'jpeg'),
+                                         image_pattern_search=encode.get('image_pattern_search'),
+                                         command_only=args.dry_run, renditions=renditions, check=True)
+    if args.dry_run:
+        print(command)
+    return command
+
+
+def run_bench(argv):
+    import benchmark
+    benchmark.main(argv)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='aia-reloaded', description='Create rgb images and movies of AIA images.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, description in [('prep', 'calibrate the images into the frame cache'),
+                                  ('render', 'render the rgb images'),
+                                  ('encode', 'encode the movies of the rendered images')]:
+        subparser = subparsers.add_parser(command, help=description, description=description)
+        subparser.add_argument('config', help='json or toml configuration file')
+        subparser.add_argument('--dry-run', action='store_true',
+                               help='validate the configuration and print what would be done')
+        if command != 'encode':
+            subparser.add_argument('--ncores', type=int, default=None,
+                                   help='number of processes. Overrides the render section.')
+    bench = subparsers.add_parser('bench', help='benchmark the pipeline on synthetic data', add_help=False)
+    bench.add_argument('arguments', nargs=argparse.REMAINDER, help='arguments of benchmark.py')
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['bench']:
+        # All arguments, including --help, are for benchmark.py
+        run_bench(argv[1:])
+        return 0
+    args = parser.parse_args(argv)
+    try:
+        config = load_config(args.config)
+        check_command(config, args.command)
+    except (OSError, ValueError) as error:
+        parser.exit(2, '%s: error: %s\n' % (parser.prog, error))
+    runners = {'prep': run_prep, 'render': run_render, 'encode': run_encode}
+    try:
+        runners[args.command](config, args)
+    except (subprocess.CalledProcessError, FileNotFoundError) as error:
+        # e.g. failed ffmpeg run of encode, or ffmpeg not found
+        parser.exit(1, '%s: error: %s\n' % (parser.prog, error))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import os, glob
+import json
+import datetime
+import numpy as np
+from astropy.io import fits
+
+# Header values kept in the index: observation time, wavelength, exposure and geometry used by calibration.aiaprep
+index_header_keys = ('T_OBS', 'DATE-OBS', 'WAVELNTH', 'EXPTIME', 'CDELT1', 'CDELT2', 'CRPIX1', 'CRPIX2', 'CROTA2',
+                     'NAXIS1', 'NAXIS2')
+
+
+def read_index_header(fitsfile):
+    """
+    Read the header values of index_header_keys without reading the image data. The header of the image extension
+    is used for compressed fits files, and the primary header otherwise.
+
+    :param fitsfile: path to the fits file
+    :return: dictionary of the header values present in the file
+    """
+    with fits.open(fitsfile) as hdul:
+        header = hdul[1].header if len(hdul) > 1 else hdul[0].header
+        return {key: header[key] for key in index_header_keys if key in header}
+
+
+def parse_time(value):
+    """
+    Convert a fits time string, e.g. '2012-08-31T19:00:01.34Z', to POSIX seconds in UTC.
+
+    :param value: ISO 8601 time string, with or without fractional seconds and trailing Z
+    :return: float number of seconds
+    """
+    value = value.strip().rstrip('Z')
+    seconds, _, fraction = value.partition('.')
+    date = datetime.datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp() + (float('0.' + fraction) if fraction else 0)
+
+
+class FitsIndex:
+    """ Persistent index of the fits headers of a set of files.
+    Only the headers are read, and only for files that are new or changed since the last update, identified by their
+    size and modification time. The index is saved as a json file. It is used to match images of different
+    wavelengths in time.
+    """
+
+    def __init__(self, index_file=None):
+        """
+        :param index_file: path to the json file of the index. It is loaded if it exists. Default is not persistent.
+        """
+        self.index_file = index_file
+        self.entries = {}
+        if index_file is not None and os.path.isfile(index_file):
+            with open(index_file) as f:
+                self.entries = json.load(f)
+
+    def update(self, files):
+        """
+        Add the headers of new or modified files to the index.
+
+        :param files: sequence of paths to fits files
+        :return: number of headers read
+        """
+        nread = 0
+        for fitsfile in files:
+            path = os.path.abspath(fitsfile)
+            stat = os.stat(path)
+            entry = self.entries.get(path)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                continue
+            header = read_index_header(path)
+            time_string = header.get('T_OBS', header.get('DATE-OBS'))
+            self.entries[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'header': header,
+                                  'time': None if time_string is None else parse_time(time_string)}
+            nread += 1
+        return nread
+
+    def scan(self, directory, pattern='*.fits'):
+        """
+        Update the index with the files of a directory.
+
+        :param directory: path to the directory
+        :param pattern: glob pattern of the fits files
+        :return: sorted list of the files
+        """
+        files = sorted(glob.glob(os.path.join(directory, pattern)))
+        self.update(files)
+        return files
+
+    def prune(self):
+        """ Remove the files that do not exist anymore from the index. """
+        self.entries = {path: entry for path, entry in self.entries.items() if os.path.isfile(path)}
+
+    def save(self):
+        """ Write the index to its json file, atomically. """
+        if self.index_file is None:
+            return
+        tmp_file = '%s.%d.tmp' % (self.index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.index_file)
+
+    def header(self, fitsfile):
+        """
+        :param fitsfile: path to an indexed fits file
+        :return: dictionary of its indexed header values
+        """
+        return self.entries[os.path.abspath(fitsfile)]['header']
+
+    def times(self, files):
+        """
+        :param files: sequence of paths to indexed fits files
+        :return: numpy array of their observation times in POSIX seconds
+        """
+        return np.array([self.entries[os.path.abspath(fitsfile)]['time'] for fitsfile in files], dtype=np.float64)
+
+    def match_triplets(self, channel_files, tolerance):
+        """
+        Match the files of several channels in time. For each file of the first channel, the closest file in time of
+        every other channel is selected. The match is dropped if any of them is further than the tolerance.
+        The files are indexed first if needed.
+
+        :param channel_files: list of sequences of files, one per channel. e.g. [red files, green files, blue files]
+        :param tolerance: maximum time difference in seconds with the file of the first channel
+        :return: list of lists of matched files, one per channel, in chronological order: [rgb channels][image index]
+        """
+        channels = []
+        for files in channel_files:
+            self.update(files)
+            times = self.times(files)
+            order = np.argsort(times, kind='stable')
+            channels.append((np.asarray(files)[order], times[order]))
+
+        ref_files, ref_times = channels[0]
+        matched = [list(ref_files)]
+        keep = np.ones(len(ref_times), dtype=bool)
+        for files, times in channels[1:]:
+            if len(times) == 0:
+                return [[] for _ in channel_files]
+            # Closest time among the two neighbours of the insertion point
+            right = np.clip(np.searchsorted(times, ref_times), 0, len(times) - 1)
+            left = np.clip(right - 1, 0, len(times) - 1)
+            closest = np.where(np.abs(times[left] - ref_times) <= np.abs(times[right] - ref_times), left, right)
+            keep &= np.abs(times[closest] - ref_times) <= tolerance
+            matched.append(list(files[closest]))
+
+        return [[str(fitsfile) for fitsfile, k in zip(files, keep) if k] for files in matched]
@@ -0,0 +1,147 @@
+import os, glob
+import json
+import hashlib
+import numpy as np
+from astropy.io import fits
+import calibration
+import instrumentation
+
+# Header values of the AIA fits files that determine the output of calibration.aiaprep
+cache_header_keys = ('CDELT1', 'CRPIX1', 'CRPIX2', 'CROTA2', 'EXPTIME')
+
+
+class FrameCache:
+    """ On-disk cache of calibrated AIA images.
+    Calibrated images are stored as .npy files and read back as read-only memory-mapped arrays, so that re-rendering
+    an event with different tone-mapping parameters only costs the tone-mapping. An image is identified by the path,
+    size and modification time of its fits file, the header values in cache_header_keys and the calibration parameters.
+    When the cache exceeds its maximum size, the least recently used images are evicted.
+    The cache directory can be shared by several processes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        :param cache_dir: directory of the cached images. Created if it does not exist.
+        :param max_bytes: maximum size of the cache in bytes. Default is unlimited.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fitsfile, header, cropsize=calibration.aia_image_size, precision='float32', crop_center=None,
+            downscale=1):
+        """
+        Cache key of a calibrated image.
+
+        :param fitsfile: path to the fits file
+        :param header: header of the image extension of the fits file
+        :param cropsize: see calibration.aiaprep
+        :param precision: see calibration.aiaprep
+        :param crop_center: see calibration.aiaprep
+        :param downscale: see calibration.aiaprep
+        :return: hexadecimal string
+        """
+        stat = os.stat(fitsfile)
+        if cropsize is not None:
+            cropsize = np.broadcast_to(np.asarray(cropsize, dtype=int), 2).tolist()
+        if crop_center is not None:
+            crop_center = np.asarray(crop_center, dtype=np.float64).tolist()
+        items = [os.path.abspath(fitsfile), stat.st_size, stat.st_mtime_ns,
+                 [header[key] for key in cache_header_keys], cropsize, crop_center, precision]
+        if downscale > 1:
+            # Keys of full resolution images are unchanged
+            items.append(downscale)
+        return hashlib.sha1(json.dumps(items).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def contains(self, fitsfile, cropsize=calibration.aia_image_size, precision='float32', crop_center=None,
+                 downscale=1):
+        """
+        Check whether a calibrated image is cached. Only the fits header is read.
+
+        :param fitsfile: path to the fits file
+        :return: True if aiaprep with the same parameters reads the image from the cache
+        """
+        header = fits.getheader(fitsfile, 1)
+        return os.path.isfile(self.path(self.key(fitsfile, header, cropsize=cropsize, precision=precision,
+                                                 crop_center=crop_center, downscale=downscale)))
+
+    def aiaprep(self, fitsfile, cropsize=calibration.aia_image_size, precision='float32', return_header=False,
+                crop_center=None, downscale=1):
+        """
+        Drop-in replacement of calibration.aiaprep reading from the cache. Only the fits header is read if the
+        calibrated image is cached. Otherwise the image is calibrated and added to the cache.
+
+        :return: read-only calibrated image, and the fits header if return_header is True
+        """
+        header = fits.getheader(fitsfile, 1)
+        path = self.path(self.key(fitsfile, header, cropsize=cropsize, precision=precision, crop_center=crop_center,
+                                  downscale=downscale))
+        try:
+            with instrumentation.stage('cache_read') as stage:
+                prepdata = np.load(path, mmap_mode='r')
+                stage.add(bytes_read=prepdata.nbytes)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            prepdata = calibration.aiaprep(fitsfile, cropsize=cropsize, precision=precision, crop_center=crop_center,
+                                           downscale=downscale)
+            with instrumentation.stage('cache_write') as stage:
+                self.store(path, prepdata)
+                stage.add(bytes_written=prepdata.nbytes)
+        else:
+            self.hits += 1
+            # Record the access for the least-recently-used eviction
+            os.utime(path)
+
+        if return_header:
+            return prepdata, header
+        return prepdata
+
+    def store(self, path, prepdata):
+        """
+        Write a calibrated image in the cache. The file is written under a temporary name and then renamed so that
+        other processes never read a partially written file.
+
+        :param path: path of the cached image
+        :param prepdata: calibrated image
+        """
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, prepdata)
+        os.replace(tmp_path, path)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def size(self):
+        """ Total size of the cached images in bytes. """
+        return sum(os.path.getsize(path) for path in self._entries())
+
+    def evict(self, max_bytes=0):
+        """
+        Remove the least recently used images until the cache fits in max_bytes. Default clears the cache.
+
+        :param max_bytes: maximum size of the cache in bytes after eviction.
+        """
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _entries(self):
+        return glob.glob(os.path.join(self.cache_dir, '*.npy'))
@@ -0,0 +1,285 @@
+"""
+Instrumentation of the processing stages of calibration and visualization.
+
+Each instrumented stage records an event with its wall time, the image index, the bytes read and written, the resident
+memory of the process at the end of the stage, and how much the peak resident memory of the process grew since the
+start of the image, i.e. the memory that image required beyond what the previous images already used. The peak of the
+whole process is also kept. Events of the worker processes of
+visualization.RGBMixer.process_rgb_list are sent back to the parent process with the results. They can be summarized
+per stage or per image, and exported as a trace file in the Chrome trace event format, viewable in a timeline viewer
+such as chrome://tracing or https://ui.perfetto.dev
+
+Instrumentation is disabled by default. When disabled, stage() returns a shared no-op context manager and nothing is
+recorded. Usage:
+
+    instrumentation.enable()
+    aia_mixer.process_rgb_list(4, range(225))
+    print(instrumentation.summary_table())
+    instrumentation.write_trace('trace.json')
+"""
+import os, sys
+import json
+import time
+import threading
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: peak memory is not recorded
+    resource = None
+
+enabled = False
+# Events recorded in this process, and events received from worker processes
+_events = []
+# Image index of the events recorded in this process
+_frame = None
+# Peak resident memory of the process at the start of the current image
+_frame_peak = None
+
+
+def enable(flag=True):
+    """
+    Switch the instrumentation on or off. Worker processes started afterwards by process_rgb_list follow this switch.
+
+    :param flag: True to record the stages, False to stop recording
+    """
+    global enabled
+    enabled = flag
+
+
+def set_frame(index):
+    """
+    Set the image index attached to the events recorded next in this process, including in its threads, and start
+    measuring the growth of the peak memory for that image.
+
+    :param index: image index, or None
+    """
+    global _frame, _frame_peak
+    _frame = index
+    _frame_peak = peak_rss() if enabled else None
+
+
+def current_frame():
+    """ Image index attached to the events recorded next in this process, e.g. to record a stage of that image later
+    in another thread. """
+    return _frame
+
+
+def peak_rss():
+    """ Peak resident set size of the process since it started, in bytes, or None if unavailable """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def current_rss():
+    """ Current resident set size of the process in bytes, or None if unavailable (only on Linux) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _NullStage:
+    """ No-op stage returned by stage() when the instrumentation is disabled """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add(self, bytes_read=0, bytes_written=0):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class Stage:
+    """ Context manager recording the wall time of a stage as an event """
+
+    def __init__(self, name, frame=None):
+        self.name = name
+        self.frame = frame
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def add(self, bytes_read=0, bytes_written=0):
+        """
+        Count the bytes read or written by the stage.
+
+        :param bytes_read: number of bytes read
+        :param bytes_written: number of bytes written
+        """
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+    def __enter__(self):
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            # Failed stages are not recorded, e.g. a cache miss
+            return False
+        peak = peak_rss()
+        if self.frame is None:
+            frame = _frame
+            peak_growth = None if peak is None or _frame_peak is None else peak - _frame_peak
+        else:
+            # Stage of another image than the current one, e.g. its background write
+            frame = self.frame
+            peak_growth = None
+        _events.append({'name': self.name, 'frame': frame, 'pid': os.getpid(), 'tid': threading.get_ident(),
+                        'ts': self.timestamp, 'dur': duration, 'bytes_read': self.bytes_read,
+                        'bytes_written': self.bytes_written, 'rss': current_rss(), 'peak_growth': peak_growth,
+                        'process_peak_rss': peak})
+        return False
+
+
+def stage(name, frame=None):
+    """
+    Instrument a stage: with instrumentation.stage('warp'): ...
+
+    :param name: stage name
+    :param frame: image index of the stage. Default is the current image of the process, see set_frame().
+    :return: Stage if the instrumentation is enabled, otherwise a no-op context manager
+    """
+    if not enabled:
+        return _null_stage
+    return Stage(name, frame=frame)
+
+
+def collect():
+    """ Remove and return the events recorded in this process, e.g. to send them from a worker to the parent. """
+    global _events
+    events, _events = _events, []
+    return events
+
+
+def add_events(events):
+    """
+    Add events recorded in another process.
+
+    :param events: list of events returned by collect()
+    """
+    _events.extend(events)
+
+
+def events():
+    """ List of the events recorded in this process or added to it """
+    return list(_events)
+
+
+def reset():
+    """ Discard all events """
+    del _events[:]
+
+
+def _maximum(events, key):
+    values = [event[key] for event in events if event[key] is not None]
+    return max(values) if values else None
+
+
+def summary(events=None):
+    """
+    Aggregate events per stage.
+
+    :param events: list of events. Default is all the events of this process.
+    :return: dictionary per stage name of the number of calls, total, mean, median and maximum wall times in seconds,
+    total bytes read and written, maximum resident memory at the end of the stage, maximum growth of the peak memory
+    within an image up to the end of the stage, and maximum peak memory of the processes, in bytes.
+    """
+    if events is None:
+        events = _events
+    stages = {}
+    for event in events:
+        stages.setdefault(event['name'], []).append(event)
+    result = {}
+    for name, stage_events in stages.items():
+        durations = np.array([event['dur'] for event in stage_events])
+        result[name] = {'calls': len(stage_events),
+                        'total': durations.sum(),
+                        'mean': durations.mean(),
+                        'median': np.median(durations),
+                        'max': durations.max(),
+                        'bytes_read': sum(event['bytes_read'] for event in stage_events),
+                        'bytes_written': sum(event['bytes_written'] for event in stage_events),
+                        'rss': _maximum(stage_events, 'rss'),
+                        'peak_growth': _maximum(stage_events, 'peak_growth'),
+                        'process_peak_rss': _maximum(stage_events, 'process_peak_rss')}
+    return result
+
+
+def frame_summary(events=None):
+    """
+    Aggregate events per image.
+
+    :param events: list of events. Default is all the events of this process.
+    :return: dictionary per image index of the wall time in seconds per stage, total bytes read and written, maximum
+    resident memory at the end of its stages, growth of the peak memory of the process during the image, i.e. the
+    memory it required beyond what the previous images of the process used, and peak memory of the process since it
+    started, in bytes.
+    """
+    if events is None:
+        events = _events
+    frames = {}
+    for event in events:
+        frames.setdefault(event['frame'], []).append(event)
+    result = {}
+    for index, frame_events in frames.items():
+        stages = {}
+        for event in frame_events:
+            stages[event['name']] = stages.get(event['name'], 0) + event['dur']
+        result[index] = {'stages': stages,
+                         'bytes_read': sum(event['bytes_read'] for event in frame_events),
+                         'bytes_written': sum(event['bytes_written'] for event in frame_events),
+                         'rss': _maximum(frame_events, 'rss'),
+                         'peak_growth': _maximum(frame_events, 'peak_growth'),
+                         'process_peak_rss': _maximum(frame_events, 'process_peak_rss')}
+    return result
+
+
+def summary_table(events=None):
+    """
+    :param events: list of events. Default is all the events of this process.
+    :return: printable table of the summary per stage, sorted by decreasing total wall time
+    """
+    def megabytes(value):
+        return '-' if value is None else '%.1f' % (value / 2 ** 20)
+
+    lines = ['%-16s %7s %10s %10s %10s %10s %10s %10s %10s %10s %12s' % (
+        'stage', 'calls', 'total s', 'mean ms', 'median ms', 'max ms', 'read MB', 'written MB', 'rss MB',
+        'growth MB', 'proc peak MB')]
+    stages = summary(events)
+    for name, s in sorted(stages.items(), key=lambda item: -item[1]['total']):
+        lines.append('%-16s %7d %10.3f %10.2f %10.2f %10.2f %10.1f %10.1f %10s %10s %12s' % (
+            name, s['calls'], s['total'], 1e3 * s['mean'], 1e3 * s['median'], 1e3 * s['max'],
+            s['bytes_read'] / 2 ** 20, s['bytes_written'] / 2 ** 20, megabytes(s['rss']),
+            megabytes(s['peak_growth']), megabytes(s['process_peak_rss'])))
+    return '\n'.join(lines)
+
+
+def write_trace(filename, events=None):
+    """
+    Write the events as a trace file in the Chrome trace event format.
+
+    :param filename: path to the json file
+    :param events: list of events. Default is all the events of this process.
+    """
+    if events is None:
+        events = _events
+    trace_events = [{'name': event['name'], 'cat': 'aia', 'ph': 'X', 'pid': event['pid'], 'tid': event['tid'],
+                     'ts': event['ts'] * 1e6, 'dur': event['dur'] * 1e6,
+                     'args': {key: event[key] for key in ('frame', 'bytes_read', 'bytes_written', 'rss',
+                                                          'peak_growth', 'process_peak_rss')}}
+                    for event in events]
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import hashlib
+
+
+def file_signature(path, hash_contents=False):
+    """
+    Signature of a file to detect changes: path, size, modification time and optionally a hash of its contents.
+
+    :param path: path to the file
+    :param hash_contents: set to True to add the sha1 of the contents, e.g. if modification times are unreliable.
+    :return: list of [absolute path, size, modification time in ns, sha1 or None]
+    """
+    stat = os.stat(path)
+    digest = None
+    if hash_contents:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        digest = sha1.hexdigest()
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns, digest]
+
+
+def parameters_hash(parameters):
+    """
+    Hash of processing parameters.
+
+    :param parameters: object with a deterministic repr, e.g. a namedtuple of numbers, strings and tuples.
+    :return: hexadecimal string
+    """
+    return hashlib.sha1(repr(parameters).encode()).hexdigest()
+
+
+class RunManifest:
+    """ Record of the images rendered from an image series, to resume or update a run without reprocessing the
+    images that are up to date. For each image index, it holds the signatures of the input files, the hash of the
+    processing parameters and the output files. An image is up to date if none of these changed and all its output
+    files exist. The manifest is saved as a json file.
+    """
+
+    def __init__(self, manifest_file, hash_contents=False, save_interval=10):
+        """
+        :param manifest_file: path to the json file. It is loaded if it exists.
+        :param hash_contents: set to True to also compare the contents of the input files, not only size and time.
+        :param save_interval: minimum time in seconds between two automatic saves when recording images.
+        """
+        self.manifest_file = manifest_file
+        self.hash_contents = hash_contents
+        self.save_interval = save_interval
+        self.frames = {}
+        self.last_save = time.perf_counter()
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                self.frames = json.load(f)['frames']
+
+    def inputs_signature(self, files):
+        return [file_signature(path, hash_contents=self.hash_contents) for path in files]
+
+    def is_up_to_date(self, index, files, params_hash, outputs):
+        """
+        :param index: image index
+        :param files: input files of the image
+        :param params_hash: hash of the processing parameters
+        :param outputs: output files of the image
+        :return: True if the image was rendered with the same inputs and parameters, and its outputs exist.
+        """
+        entry = self.frames.get(str(index))
+        if entry is None or entry['params'] != params_hash or entry['outputs'] != list(outputs):
+            return False
+        if not all(os.path.isfile(path) for path in outputs):
+            return False
+        return entry['inputs'] == self.inputs_signature(files)
+
+    def record(self, index, files, params_hash, outputs):
+        """
+        Record a rendered image, and save the manifest if the last save is older than save_interval.
+
+        :param index: image index
+        :param files: input files of the image
+        :param params_hash: hash of the processing parameters
+        :param outputs: output files of the image
+        """
+        self.frames[str(index)] = {'inputs': self.inputs_signature(files), 'params': params_hash,
+                                   'outputs': list(outputs)}
+        if time.perf_counter() - self.last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        """ Write the manifest to its json file, atomically. """
+        tmp_file = '%s.%d.tmp' % (self.manifest_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({'frames': self.frames}, f)
+        os.replace(tmp_file, self.manifest_file)
+        self.last_save = time.perf_counter()
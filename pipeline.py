@@ -0,0 +1,353 @@
+"""
+Scheduling of the image processing over a pool of worker processes.
+Tasks are dispatched one at a time to whichever worker is free, with a bounded number of tasks in flight so that results
+never pile up in the parent process. Worker processes can be recycled after a number of tasks to cap memory growth.
+Tasks can instead be assigned to the workers a few tasks in advance, so that each worker can prepare its next tasks,
+e.g. read their input files ahead.
+"""
+import time
+import queue
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class ProgressReporter:
+    """ Print the progress, throughput and per-stage wall times of a series of tasks. """
+
+    def __init__(self, total, interval=10, label='frames'):
+        """
+        :param total: total number of tasks, or None if unknown
+        :param interval: minimum time in seconds between two progress reports. None disables the reports.
+        :param label: name of the tasks in the reports
+        """
+        self.total = total
+        self.interval = interval
+        self.label = label
+        self.done = 0
+        self.timings = {}
+        # Total wall time of each task, summed over its stages
+        self.task_times = []
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, timings=None):
+        """
+        Record a finished task.
+
+        :param timings: optional dictionary of wall time in seconds per stage of the task
+        """
+        self.done += 1
+        if timings:
+            for stage, seconds in timings.items():
+                self.timings[stage] = self.timings.get(stage, 0) + seconds
+            self.task_times.append(sum(timings.values()))
+        now = time.perf_counter()
+        if self.interval is not None and now - self.last_report >= self.interval and self.done != self.total:
+            self.last_report = now
+            rate = self.done / (now - self.start)
+            if self.total is None:
+                print('%d %s, %.2f %s/s' % (self.done, self.label, rate, self.label))
+            else:
+                print('%d/%d %s, %.2f %s/s, %.0f s remaining' % (self.done, self.total, self.label, rate, self.label,
+                                                                  (self.total - self.done) / rate))
+
+    def summary(self):
+        """
+        :return: dictionary with the number of tasks done, the elapsed time, the throughput, the mean wall time per
+        stage and per task, and the 50th, 90th and 99th percentiles of the wall time per task if tasks report timings.
+        """
+        elapsed = time.perf_counter() - self.start
+        summary = {'done': self.done,
+                   'elapsed': elapsed,
+                   'throughput': self.done / elapsed if elapsed > 0 else 0,
+                   'stages': {stage: seconds / max(self.done, 1) for stage, seconds in self.timings.items()}}
+        if self.task_times:
+            summary['latency'] = dict(zip(('p50', 'p90', 'p99'),
+                                          np.percentile(self.task_times, [50, 90, 99]).tolist()))
+        return summary
+
+    def close(self):
+        """ Print and return the summary. """
+        summary = self.summary()
+        if self.interval is not None:
+            stages = ', '.join('%s %.2f s' % item for item in summary['stages'].items())
+            print('%d %s in %.1f s, %.2f %s/s%s' % (summary['done'], self.label, summary['elapsed'],
+                                                     summary['throughput'], self.label,
+                                                     ' (per frame: %s)' % stages if stages else ''))
+        return summary
+
+
+class _TaskError:
+    """ Exception raised by a task in a worker, passed through the result queue. """
+
+    def __init__(self, error):
+        self.error = error
+
+
+class FramePipeline:
+    """ Run a function over a sequence of indices in a pool of worker processes.
+    The function must be picklable, i.e. defined at module level. Worker state, e.g. processing parameters, is best
+    passed once per worker with the initializer instead of with every task.
+    """
+
+    def __init__(self, ncores=1, max_pending=None, maxtasksperchild=None, progress_interval=10,
+                 start_method='spawn'):
+        """
+        :param ncores: number of worker processes. With 1, tasks run in the calling process.
+        :param max_pending: maximum number of tasks in flight. Default is twice the number of workers.
+        :param maxtasksperchild: number of tasks after which a worker process is replaced. Default never replaces.
+        :param progress_interval: minimum time in seconds between progress reports. None disables the reports.
+        :param start_method: multiprocessing start method of the workers.
+        """
+        self.ncores = ncores
+        self.max_pending = max_pending if max_pending is not None else 2 * ncores
+        self.maxtasksperchild = maxtasksperchild
+        self.progress_interval = progress_interval
+        self.start_method = start_method
+
+    def run(self, func, indices, initializer=None, initargs=(), consumer=None, read_ahead=0, prepare=None):
+        """
+        Call func(index) for each index, and pass the results to the consumer in the order they complete.
+
+        :param func: picklable function of the index
+        :param indices: sequence of indices, or iterable consumed as the tasks are dispatched, e.g. to claim them from
+        a work queue only when a worker is about to be free
+        :param initializer: function called with initargs in each worker before any task
+        :param initargs: arguments of the initializer
+        :param consumer: function called in the calling process with each result. If the results are dictionaries,
+        their 'timings' item of per-stage wall times is used for the progress reports.
+        :param read_ahead: number of tasks assigned to each worker in advance of the one it processes. The tasks are
+        then sent to each worker through its own queue, instead of to the first free worker, so that the worker knows
+        its next tasks, e.g. to read their input files ahead. New tasks still go to the workers with the fewest tasks
+        left, one at a time. max_pending and maxtasksperchild are not used.
+        :param prepare: picklable function called in the worker before each task with the list of the indices assigned
+        to the worker and not processed yet, the index of the task first. Only used with read_ahead.
+        :return: summary dictionary of ProgressReporter
+        """
+        progress = ProgressReporter(len(indices) if hasattr(indices, '__len__') else None,
+                                    interval=self.progress_interval)
+
+        def finish(result):
+            if consumer is not None:
+                consumer(result)
+            progress.update(result.get('timings') if isinstance(result, dict) else None)
+
+        if self.ncores <= 1:
+            if initializer is not None:
+                initializer(*initargs)
+            tasks = iter(indices)
+            upcoming = collections.deque(itertools.islice(tasks, read_ahead))
+            for index in tasks:
+                upcoming.append(index)
+                if prepare is not None and read_ahead > 0:
+                    prepare(list(upcoming))
+                finish(func(upcoming.popleft()))
+            while upcoming:
+                if prepare is not None:
+                    prepare(list(upcoming))
+                finish(func(upcoming.popleft()))
+            return progress.close()
+
+        if read_ahead > 0:
+            self._run_assigned(func, indices, initializer, initargs, finish, read_ahead, prepare)
+            return progress.close()
+
+        ctx = multiprocessing.get_context(self.start_method)
+        results = queue.Queue()
+        pool = ctx.Pool(self.ncores, initializer=initializer, initargs=initargs,
+                        maxtasksperchild=self.maxtasksperchild)
+
+        def submit(index):
+            pool.apply_async(func, (index,), callback=results.put,
+                             error_callback=lambda error: results.put(_TaskError(error)))
+
+        try:
+            tasks = iter(indices)
+            pending = 0
+            for index in tasks:
+                submit(index)
+                pending += 1
+                if pending >= self.max_pending:
+                    break
+            while pending:
+                result = results.get()
+                pending -= 1
+                if isinstance(result, _TaskError):
+                    raise result.error
+                # Submit the next task before consuming so that workers stay busy
+                index = next(tasks, None)
+                if index is not None:
+                    submit(index)
+                    pending += 1
+                finish(result)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        return progress.close()
+
+    def _run_assigned(self, func, indices, initializer, initargs, finish, read_ahead, prepare):
+        """ run() with the tasks assigned to the workers in advance, through a queue per worker. """
+        ctx = multiprocessing.get_context(self.start_method)
+        task_queues = [ctx.SimpleQueue() for _ in range(self.ncores)]
+        # A pipe of results per worker, so that no lock is shared by the workers. Results are pickled when they are
+        # sent, before the worker reuses its buffers.
+        pipes = [ctx.Pipe(duplex=False) for _ in range(self.ncores)]
+        workers = [ctx.Process(target=_assigned_worker, args=(task_queues[worker_id], pipes[worker_id][1], func,
+                                                              prepare, initializer, initargs), daemon=True)
+                   for worker_id in range(self.ncores)]
+        for worker in workers:
+            worker.start()
+        # Only the workers hold the sending ends, so that the pipe of a worker that died reads as closed
+        for _, sender in pipes:
+            sender.close()
+        receivers = [receiver for receiver, _ in pipes]
+        assigned = [0] * self.ncores
+        tasks = iter(indices)
+
+        def assign(worker_id):
+            index = next(tasks, None)
+            if index is None:
+                return False
+            task_queues[worker_id].put(index)
+            assigned[worker_id] += 1
+            return True
+
+        try:
+            # One task per worker at a time, so that a short job is spread over all the workers
+            for _ in range(read_ahead + 1):
+                if not all(assign(worker_id) for worker_id in range(self.ncores)):
+                    break
+            while sum(assigned):
+                ready = multiprocessing.connection.wait(receivers)
+                worker_id = receivers.index(ready[0])
+                try:
+                    result = receivers[worker_id].recv()
+                except EOFError:
+                    workers[worker_id].join()
+                    raise RuntimeError('A worker process exited with code %s' % workers[worker_id].exitcode)
+                assigned[worker_id] -= 1
+                if isinstance(result, _TaskError):
+                    raise result.error
+                # Assign the next task before consuming so that the worker stays busy
+                assign(worker_id)
+                finish(result)
+            for task_queue in task_queues:
+                task_queue.put(None)
+            for worker in workers:
+                worker.join()
+        except BaseException:
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+            for receiver in receivers:
+                receiver.close()
+
+
+def _assigned_worker(task_queue, results, func, prepare, initializer, initargs):
+    """ Worker process of FramePipeline._run_assigned """
+    if initializer is not None:
+        initializer(*initargs)
+    upcoming = collections.deque()
+    while True:
+        if not upcoming:
+            upcoming.append(task_queue.get())
+        # Tasks already assigned to this worker, without waiting
+        while upcoming[-1] is not None and not task_queue.empty():
+            upcoming.append(task_queue.get())
+        if upcoming[0] is None:
+            return
+        if prepare is not None:
+            prepare([index for index in upcoming if index is not None])
+        index = upcoming.popleft()
+        try:
+            result = func(index)
+        except Exception as error:
+            result = _TaskError(error)
+        results.send(result)
+
+
+class SharedFrameRing:
+    """ Ring of preallocated frame slots in shared memory, to pass frames from worker processes to the parent process
+    without pickling them. A worker acquires a free slot, writes its frame in it and returns only the slot number.
+    The parent reads the frame through a numpy view of the slot and releases the slot when done with it.
+    Workers block when all slots are in use, which bounds the memory held by frames waiting to be consumed.
+
+    The ring is created in the parent process, and attached to the shared memory when unpickled in a worker, e.g.
+    when passed in the initializer arguments of a pool.
+    """
+
+    def __init__(self, nslots, shape, dtype=np.uint8, start_method='spawn'):
+        """
+        :param nslots: number of frame slots
+        :param shape: shape of the frames
+        :param dtype: data type of the frames
+        :param start_method: multiprocessing start method of the worker processes
+        """
+        self.nslots = nslots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=max(nslots * self.slot_bytes, 1))
+        self.free_slots = multiprocessing.get_context(start_method).Queue()
+        for slot in range(nslots):
+            self.free_slots.put(slot)
+        self.owner = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = self.shm.name
+        state['owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state['shm'])
+
+    def view(self, slot):
+        """
+        :param slot: slot number
+        :return: numpy array of the frame in the slot, sharing its memory
+        """
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+
+    def put(self, frame):
+        """
+        Copy a frame in a free slot. Blocks until a slot is free.
+
+        :param frame: numpy array of the ring shape
+        :return: slot number
+        """
+        slot = self.free_slots.get()
+        np.copyto(self.view(slot), frame, casting='unsafe')
+        return slot
+
+    def release(self, slot):
+        """
+        Make a slot available again. Views of this slot must not be used anymore.
+
+        :param slot: slot number
+        """
+        self.free_slots.put(slot)
+
+    def close(self):
+        """ Release the shared memory. Called by the parent process, it also frees it for all processes. """
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,205 @@
+"""
+Read-ahead of the fits files in background threads, so that the disk or network filesystem reads the next images while
+the current one is processed.
+
+A Prefetcher reads the raw bytes of scheduled files, in order, within a memory budget. Once installed in a process,
+calibration.read_aia and visualization.load_fits read the prefetched bytes from memory instead of the file.
+Files that are requested before their read started are read directly instead, and counted as misses.
+
+    prefetch.install(prefetch.Prefetcher(max_bytes=2 ** 28))
+    prefetch.schedule(files)
+    for file in files:
+        data, header = calibration.read_aia(file)
+"""
+import os
+import io
+import time
+import threading
+import collections
+
+# Prefetcher used by fits_source() in this process
+_prefetcher = None
+
+
+class Prefetcher:
+    """ Background reader of the raw bytes of files, holding at most max_bytes of files not yet taken. """
+
+    def __init__(self, max_bytes=2 ** 28, nthreads=2):
+        """
+        :param max_bytes: memory budget in bytes of the files read ahead. A single file larger than the budget is still
+        read, alone.
+        :param nthreads: number of reading threads
+        """
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        self.pending = collections.deque()
+        # State of the scheduled files not yet read: 'pending', 'budget' (waiting for memory) or 'reading'
+        self.state = {}
+        self.ready = {}
+        self.used = 0
+        self.peak_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.wait = 0.0
+        self.closed = False
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(nthreads)]
+        for thread in self.threads:
+            thread.start()
+
+    def schedule(self, paths):
+        """
+        Add files to read ahead, in the order they will be taken.
+
+        :param paths: sequence of file paths
+        """
+        with self.cond:
+            for path in paths:
+                if path not in self.state and path not in self.ready:
+                    self.state[path] = 'pending'
+                    self.pending.append(path)
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                path = self.pending.popleft()
+                if self.state.get(path) != 'pending':
+                    continue
+                self.state[path] = 'budget'
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            with self.cond:
+                while (self.used > 0 and self.used + size > self.max_bytes and self.state.get(path) == 'budget'
+                       and not self.closed):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                if self.state.get(path) != 'budget':
+                    # Taken or discarded in the meantime
+                    continue
+                self.state[path] = 'reading'
+                self.used += size
+                self.peak_bytes = max(self.peak_bytes, self.used)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                # Left to the reader of the file to raise the error
+                data = None
+            with self.cond:
+                if self.state.pop(path, None) == 'reading' and data is not None:
+                    self.ready[path] = data
+                else:
+                    self.used -= size
+                self.cond.notify_all()
+
+    def take(self, path):
+        """
+        Remove a file from the prefetched files.
+
+        :param path: file path
+        :return: bytes of the file, or None if its read did not start yet, or failed, or the file was not scheduled.
+        Waits for the end of the read if it is in progress.
+        """
+        with self.cond:
+            if self.state.get(path) == 'reading':
+                start = time.perf_counter()
+                while self.state.get(path) == 'reading':
+                    self.cond.wait()
+                self.wait += time.perf_counter() - start
+            data = self.ready.pop(path, None)
+            if data is None:
+                self.state.pop(path, None)
+                self.misses += 1
+                return None
+            self.used -= len(data)
+            self.hits += 1
+            self.cond.notify_all()
+            return data
+
+    def clear(self):
+        """ Discard the files not taken yet, prefetched or not. """
+        with self.cond:
+            self.pending.clear()
+            self.state.clear()
+            self.used -= sum(len(data) for data in self.ready.values())
+            self.ready.clear()
+            self.cond.notify_all()
+
+    def discard(self, paths):
+        """
+        Discard files that will not be taken, prefetched or not, e.g. the files of an image that is done.
+
+        :param paths: sequence of file paths
+        """
+        with self.cond:
+            for path in paths:
+                self.state.pop(path, None)
+                data = self.ready.pop(path, None)
+                if data is not None:
+                    self.used -= len(data)
+            self.cond.notify_all()
+
+    def stats(self):
+        """
+        :return: dictionary of the number of hits and misses, the time in seconds spent waiting for reads in progress,
+        the memory in bytes held by prefetched files and its peak.
+        """
+        with self.cond:
+            return {'hits': self.hits, 'misses': self.misses, 'wait': self.wait, 'used': self.used,
+                    'peak_bytes': self.peak_bytes}
+
+    def close(self):
+        """ Stop the reading threads and discard the prefetched files. """
+        self.clear()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+def install(prefetcher):
+    """
+    Set the prefetcher used by fits_source() in this process. The previous one is closed.
+
+    :param prefetcher: Prefetcher, or None to read all files directly
+    """
+    global _prefetcher
+    if _prefetcher is not None and _prefetcher is not prefetcher:
+        _prefetcher.close()
+    _prefetcher = prefetcher
+
+
+def installed():
+    """ Prefetcher installed in this process, or None """
+    return _prefetcher
+
+
+def schedule(paths):
+    """
+    Read files ahead with the installed prefetcher, if any.
+
+    :param paths: sequence of file paths, in the order they will be read
+    """
+    if _prefetcher is not None:
+        _prefetcher.schedule(paths)
+
+
+def fits_source(path):
+    """
+    Source of a fits file for astropy.io.fits.open()
+
+    :param path: path to the fits file
+    :return: in-memory file of the prefetched bytes, or the path itself if not prefetched
+    """
+    if _prefetcher is None:
+        return path
+    data = _prefetcher.take(path)
+    return path if data is None else io.BytesIO(data)
@@ -33,6 +33,8 @@ if __name__ == '__main__':
         outputdir=os.path.abspath('../aia_data/'))
     aia_mixer.set_aia_default()
     aia_mixer.filename_lab = 'im_lab'
+    # Optional: per-image scaling values, smoothed over 9 images, to follow flares and exposure changes.
+    # aia_mixer.set_adaptive_scaling(file_range, window=9, ncores=ncores)
 
     aia_mixer.process_rgb_list(ncores, file_range)
 
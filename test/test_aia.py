@@ -1,7 +1,29 @@
-import os, glob
+import os, sys, glob
+import json
+import argparse
+import math
+import pickle
+import time
+import tracemalloc
+import subprocess
 import numpy as np
-from calibration import scale_rotate, aiaprep
-from visualization import RGBMixer
+import pytest
+from astropy.io import fits
+import cv2
+import benchmark
+import cli
+import instrumentation
+import prefetch
+import visualization
+from calibration import scale_rotate, scale_rotate_to_grid, aiaprep, aia_pad
+from fits_index import FitsIndex
+from frame_cache import FrameCache
+from pipeline import FramePipeline
+from work_queue import LeaseQueue
+from writers import FrameWriter, TilePyramidWriter
+from visualization import RGBMixer, ToneMapper, IntensityHistogram, OrderedFrameSink, VideoStream, scale_rgb, \
+    VideoRendition, process_rgb_image, encode_video, get_color_lut, \
+    parameter_grid, render_sweep
 
 
 # Testing for any non-zero values at borders
@@ -70,12 +92,739 @@ def test_aia_rgb_sample():
     assert os.path.isfile(outputfile_lab)
 
 
+def write_aia_fits(filename, data, exptime=2.0, cdelt=0.6, crpix=None, crota=0.0, t_obs='2012-08-31T19:00:00.00Z'):
+    """ Write a compressed fits file with the subset of the AIA level-1 header used by calibration.aiaprep """
+    if crpix is None:
+        crpix = ((data.shape[1] + 1) / 2.0, (data.shape[0] + 1) / 2.0)
+    hdu = fits.CompImageHDU(data)
+    hdu.header['EXPTIME'] = exptime
+    hdu.header['CDELT1'] = cdelt
+    hdu.header['CDELT2'] = cdelt
+    hdu.header['CRPIX1'] = crpix[0]
+    hdu.header['CRPIX2'] = crpix[1]
+    hdu.header['CROTA2'] = crota
+    hdu.header['T_OBS'] = t_obs
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=True)
+    return filename
+
+
+def test_aia_pad_keeps_dtype():
+    image = np.ones((100, 120), dtype=np.float32)
+    padded = aia_pad(image, 10, 5)
+    assert padded.dtype == np.float32
+    assert padded.shape == (110, 140)
+    assert padded.sum() == image.sum()
+
+
+def test_aiaprep_precision(tmp_path):
+    data = (np.random.rand(256, 256) * 1000).astype(np.int16)
+    fitsfile = write_aia_fits(str(tmp_path / 'aia.171.fits'), data, exptime=2.0, crota=10)
+    prep32 = aiaprep(fitsfile, cropsize=256)
+    prep64 = aiaprep(fitsfile, cropsize=256, precision='float64')
+    prep_raw, header = aiaprep(fitsfile, cropsize=256, precision='raw', return_header=True)
+    assert prep32.dtype == np.float32 and prep64.dtype == np.float64 and prep_raw.dtype == np.int16
+    np.testing.assert_allclose(prep32, prep64, rtol=1e-4, atol=1e-3)
+    np.testing.assert_allclose(prep_raw / header['EXPTIME'], prep64, atol=0.5)
+
+
+def test_scale_rgb_raw_exptime():
+    rgb_raw = [(np.random.rand(64, 64) * 4000).astype(np.int16) for _ in range(3)]
+    exptime = [2.0, 2.9, 2.0]
+    rgb = [channel / t for channel, t in zip(rgb_raw, exptime)]
+    rgblow, rgbhigh = np.array([100, 50, 80]), np.array([1500, 1200, 1800])
+    scaled = scale_rgb(rgb, rgblow, rgbhigh, rgbmix=np.eye(3), precision='float64')
+    scaled_raw = scale_rgb(rgb_raw, rgblow, rgbhigh, rgbmix=np.eye(3), precision='raw', exptime=exptime)
+    assert scaled_raw.dtype == np.float32
+    np.testing.assert_allclose(scaled_raw, scaled, atol=1e-2)
+
+
+def test_scale_rotate_to_grid_matches_padded_crop():
+    image = (np.random.rand(600, 600) * 10).astype(np.float32)
+    reference_pixel = np.array([310.0, 290.0])
+    padded = scale_rotate(image, angle=30, scale_factor=1.1, reference_pixel=reference_pixel)
+    # In the padded array the reference pixel is at the array center
+    start = (padded.shape[0] - 600) // 2
+    expected = padded[start:start + 600, start:start + 600]
+    rotated = scale_rotate_to_grid(image, (600, 600), angle=30, scale_factor=1.1, reference_pixel=reference_pixel)
+    assert rotated.shape == (600, 600) and rotated.dtype == np.float32
+    # opencv quantizes the interpolation weights, so sub-pixel offsets rounding differently give tiny differences
+    assert np.abs(rotated - expected).mean() < 1e-2
+
+
+def test_aiaprep_sub_window(tmp_path):
+    data = (np.random.rand(256, 256) * 1000).astype(np.int16)
+    fitsfile = write_aia_fits(str(tmp_path / 'aia.171.fits'), data, crota=5)
+    full = aiaprep(fitsfile, cropsize=4096)
+    # 200 x 100 window, off-center in the full-size image
+    window = aiaprep(fitsfile, cropsize=(200, 100), crop_center=(2047.5 + 20, 2047.5 - 10))
+    assert window.shape == (100, 200)
+    expected = full[1988:2088, 1968:2168]
+    assert expected.sum() > 0
+    assert np.abs(window - expected).mean() < 1e-3 * expected.mean()
+
+
+def test_tone_mapper_matches_scale_rgb():
+    rgb = [np.random.rand(120, 80) * 3000 for _ in range(3)]
+    rgblow, rgbhigh = np.array([100, 50, 80]), np.array([1500, 1200, 1800])
+    rgbmix = np.array([[1.0, 0.6, -0.3], [0.0, 1.0, 0.1], [0.0, 0.1, 1.0]])
+    for precision in ('float32', 'float64'):
+        tone_mapper = ToneMapper((120, 80), precision=precision)
+        for mix in (None, rgbmix):
+            expected = scale_rgb(rgb, rgblow, rgbhigh, rgbmix=mix, scalemin=20, precision=precision)
+            scaled = tone_mapper.scale_rgb(rgb, rgblow, rgbhigh, rgbmix=mix, scalemin=20)
+            assert np.array_equal(scaled, expected)
+
+
+def test_process_rgb_image_reuse_buffers(tmp_path):
+    data_files = [[write_aia_fits(str(tmp_path / ('aia.%s.fits' % wavel)),
+                                  (np.random.rand(128, 128) * 1000).astype(np.int16))]
+                  for wavel in ['304', '171', '193']]
+    kwargs = dict(rgblow=np.array([10, 10, 10]), rgbhigh=np.array([400, 450, 480]), scalemin=20, lab=(1, 0.96, 1.04),
+                  rgbmix=np.array([[1.0, 0.6, -0.3], [0.0, 1.0, 0.1], [0.0, 0.1, 1.0]]), cropsize=128)
+    bgr1, bgr2 = process_rgb_image(0, data_files, **kwargs)
+    bgr1_reused, bgr2_reused = process_rgb_image(0, data_files, reuse_buffers=True, **kwargs)
+    assert np.array_equal(bgr1, bgr1_reused)
+    assert np.array_equal(bgr2, bgr2_reused)
+
+
+def test_intensity_histogram_percentiles():
+    rgb = [np.random.lognormal(4, 1.5, (300, 300)) for _ in range(3)]
+    rgb[0][:100] = 0
+    histogram = IntensityHistogram()
+    # Accumulate over two halves, in two histograms
+    histogram.update([channel[:150] for channel in rgb])
+    other = IntensityHistogram()
+    other.update([channel[150:] for channel in rgb])
+    histogram.merge(other)
+    for percentiles in [(25, 25, 25), (50, 60, 70), (99.5, 99.9, 99.85), (0, 0, 0), (100, 100, 100)]:
+        expected = np.array([np.percentile(rgb[j], percentiles[j]) for j in range(3)])
+        np.testing.assert_allclose(histogram.percentile(percentiles), expected, rtol=2e-3)
+
+
+def write_aia_series(directory, nimages, size=128):
+    """ Write nimages random fits files for each of the 304, 171, 193 channels. Returns the data_files of RGBMixer """
+    data_files = []
+    for wavel in ['304', '171', '193']:
+        data_files.append([write_aia_fits(os.path.join(str(directory), 'aia.%s.%04d.fits' % (wavel, i)),
+                                          (np.random.rand(size, size) * 1000).astype(np.int16), crota=i)
+                           for i in range(nimages)])
+    return data_files
+
+
+def write_aia_mixer(directory, nimages):
+    """ RGBMixer of a series of write_aia_series, with the aia defaults at a cropsize of 128 and fixed scaling values """
+    data_files = write_aia_series(directory, nimages)
+    aia_mixer = RGBMixer(data_files=data_files, outputdir=str(directory))
+    aia_mixer.set_aia_default()
+    aia_mixer.cropsize = 128
+    aia_mixer.rgblow, aia_mixer.rgbhigh = np.array([10, 10, 10]), np.array([400, 450, 480])
+    return aia_mixer
 
 
+def test_rgbmixer_multiple_references(tmp_path):
+    data_files = write_aia_series(tmp_path, 3)
+    aia_mixer = RGBMixer(data_files=data_files, outputdir=str(tmp_path), ref=[0, 2])
+    aia_mixer.set_aia_default()
+    assert aia_mixer.ref_rgb is None
+    prepped = [[aiaprep(data_files[j][i]) for i in (0, 2)] for j in range(3)]
+    expected = np.array([np.percentile(prepped[j], aia_mixer.percentiles_high[j]) for j in range(3)])
+    np.testing.assert_allclose(aia_mixer.rgbhigh, expected, rtol=2e-3)
+
+
+def test_frame_cache(tmp_path):
+    data = (np.random.rand(128, 128) * 1000).astype(np.int16)
+    fitsfile = write_aia_fits(str(tmp_path / 'aia.171.fits'), data, crota=10)
+    cache = FrameCache(str(tmp_path / 'cache'))
+    prepdata = cache.aiaprep(fitsfile, cropsize=128)
+    cached, header = cache.aiaprep(fitsfile, cropsize=128, return_header=True)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert isinstance(cached, np.memmap) and header['EXPTIME'] == 2.0
+    assert np.array_equal(cached, prepdata)
+    assert np.array_equal(cached, aiaprep(fitsfile, cropsize=128))
+    # Other calibration parameters are cached separately, and the least recently used image is evicted first
+    _ = cache.aiaprep(fitsfile, cropsize=64)
+    assert cache.misses == 2
+    cache.evict(cache.size() - 1)
+    assert len(os.listdir(cache.cache_dir)) == 1
+    _ = cache.aiaprep(fitsfile, cropsize=64)
+    assert cache.hits == 2
+
+
+class FrameList(list):
+    """ Stream collecting the frames written to it """
+
+    def write(self, frame):
+        self.append(frame.copy())
+
+    def close(self):
+        pass
+
+
+def test_ordered_frame_sink():
+    frames = FrameList()
+    sink = OrderedFrameSink([3, 4, 5, 6], [frames])
+    for index in [5, 3, 6, 4]:
+        sink.put(index, np.full((2, 2, 3), index, dtype=np.uint8))
+    sink.close()
+    assert [frame[0, 0, 0] for frame in frames] == [3, 4, 5, 6]
+
+
+def test_video_commands():
+    command = encode_video('.', 'movie', crop=[3840, 2160, 128, 1935], frame_size=(1920, 1080), command_only=True)
+    assert 'crop=3840:2160:128:1935,scale=1920:1080,eq=contrast=1.1' in command
+    command = VideoStream('movie', frame_size=(1080, 1080), padded_size=(1920, 1080)).command((4096, 4096))
+    assert command[command.index('-s') + 1] == '4096x4096'
+    assert command[command.index('-vf') + 1] == 'scale=1080:1080,pad=1920:1080:420:0,eq=contrast=1.1'
+
+
+def test_video_renditions():
+    renditions = [VideoRendition('full', frame_size=(2048, 2048)),
+                  VideoRendition('crop', crop=[2048, 2048, 0, 2048], frame_size=(1024, 1024), fps=24, crf=20)]
+    command = encode_video('.', renditions=renditions, command_only=True).split()
+    # A single input, split into one filtered output per rendition
+    assert command.count('-i') == 1 and '-vf' not in command
+    assert command[command.index('-filter_complex') + 1] == (
+        '[0:v]split=2[s0][s1];[s0]scale=2048:2048,eq=contrast=1.1[v0];'
+        '[s1]crop=2048:2048:0:2048,scale=1024:1024,eq=contrast=1.1[v1]')
+    assert command[command.index('[v1]'):command.index('crop.mp4') + 1] == [
+        '[v1]', '-c:v', 'libx264', '-preset', 'slow', '-crf', '20', '-r', '24', '-pix_fmt', 'yuv420p', 'crop.mp4']
+    stream_command = VideoStream(renditions=renditions).command((4096, 4096))
+    assert stream_command[stream_command.index('-i') + 1] == '-' and stream_command.count('-map') == 2
+
+
+def test_process_rgb_list_stream(tmp_path):
+    aia_mixer = write_aia_mixer(tmp_path, 3)
+    frames = FrameList()
+    aia_mixer.process_rgb_list(1, [2, 0], video_streams=[frames], write_images=False)
+    assert len(frames) == 2 and frames[0].shape == (128, 128, 3)
+    assert not glob.glob(os.path.join(str(tmp_path), '*.jpeg'))
+    assert np.array_equal(frames[1], aia_mixer.process_rgb(0)[1])
+    assert os.path.isfile(aia_mixer.filepath_lab + '_%04d.jpeg' % 0)
+
+
+def test_frame_pipeline():
+    results = []
+    summary = FramePipeline(2, max_pending=2, maxtasksperchild=1, progress_interval=None).run(
+        abs, range(-5, 0), consumer=results.append)
+    assert sorted(results) == [1, 2, 3, 4, 5] and summary['done'] == 5
+    try:
+        FramePipeline(2, progress_interval=None).run(math.sqrt, [4, -1, 9])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('error in worker not raised')
+    # Tasks assigned in advance to each worker
+    results = []
+    summary = FramePipeline(2, progress_interval=None).run(abs, range(-7, 0), consumer=results.append, read_ahead=2)
+    assert sorted(results) == list(range(1, 8)) and summary['done'] == 7
+    with pytest.raises(ValueError):
+        FramePipeline(2, progress_interval=None).run(math.sqrt, [4, -1, 9], read_ahead=1)
+    # A worker process that dies is reported instead of waited for
+    with pytest.raises(RuntimeError, match='code 3'):
+        FramePipeline(2, progress_interval=None).run(os._exit, [3], read_ahead=1)
+    upcoming = []
+    FramePipeline(1, progress_interval=None).run(abs, range(4), read_ahead=2, prepare=upcoming.append)
+    assert upcoming == [[0, 1, 2], [1, 2, 3], [2, 3], [3]]
+
+
+def test_process_rgb_list_parallel(tmp_path):
+    aia_mixer = write_aia_mixer(tmp_path, 3)
+    frames = FrameList()
+    summary = aia_mixer.process_rgb_list(2, range(3), video_streams=[frames], maxtasksperchild=1)
+    assert summary['done'] == 3 and set(summary['stages']) == {'read', 'prep', 'tonemap', 'write'}
+    assert len(glob.glob(aia_mixer.filepath_lab + '_*.jpeg')) == 3
+    for i in range(3):
+        assert np.array_equal(frames[i], aia_mixer.process_rgb(i, write_images=False)[1])
+
+
+def test_render_config_is_compact(tmp_path):
+    data_files = write_aia_series(tmp_path, 2)
+    aia_mixer = RGBMixer(data_files=data_files, outputdir=str(tmp_path))
+    aia_mixer.set_aia_default()
+    aia_mixer.ref_rgb = [np.zeros((1024, 1024)) for _ in range(3)]
+    config = aia_mixer.render_config()
+    assert len(pickle.dumps(config)) < 5000
+    assert config.rgbmix[0] == (1.0, 0.6, -0.3) and config.filename_lab == aia_mixer.filepath_lab
+    assert config._replace(filename_lab=None) == aia_mixer.render_config(write_images=False)
+
+
+def test_process_rgb_list_shared_memory(tmp_path):
+    aia_mixer = write_aia_mixer(tmp_path, 4)
+    aia_mixer.crop = (slice(10, 110), slice(0, 64))
+    assert aia_mixer.frame_shape() == (64, 100, 3)
+    frames = {}
+    aia_mixer.process_rgb_list(2, range(4), write_images=False, frame_transport='shared_memory', max_pending=2,
+                               frame_consumer=lambda index, frame: frames.update({index: frame.copy()}))
+    assert sorted(frames) == [0, 1, 2, 3]
+    for i in range(4):
+        assert np.array_equal(frames[i], aia_mixer.process_rgb(i, write_images=False)[1])
+
+
+def test_process_rgb_image_threads(tmp_path):
+    data_files = write_aia_series(tmp_path, 1)
+    kwargs = dict(rgblow=np.array([10, 10, 10]), rgbhigh=np.array([400, 450, 480]), lab=(1, 0.96, 1.04), cropsize=128)
+    bgr1, bgr2 = process_rgb_image(0, data_files, **kwargs)
+    timings = {}
+    bgr1_threads, bgr2_threads = process_rgb_image(0, data_files, nthreads=3, timings=timings, **kwargs)
+    assert np.array_equal(bgr1, bgr1_threads) and np.array_equal(bgr2, bgr2_threads)
+    assert set(timings) == {'read', 'prep', 'tonemap', 'write'}
+
+
+def test_fits_index_match_triplets(tmp_path):
+    data = np.zeros((16, 16), dtype=np.int16)
+    # 12 s cadence. The green channel misses the 2nd image, the blue channel has an extra one.
+    times = {'304': [0, 12, 24, 36], '171': [1, 25, 37], '193': [0, 6, 11, 23, 35]}
+    channel_files = []
+    for wavel in ['304', '171', '193']:
+        channel_files.append([write_aia_fits(str(tmp_path / ('aia.%s.%02d.fits' % (wavel, t))), data,
+                                             t_obs='2012-08-31T19:00:%02d.50Z' % t) for t in times[wavel]][::-1])
+    index_file = str(tmp_path / 'index.json')
+    fits_index = FitsIndex(index_file)
+    matched = fits_index.match_triplets(channel_files, tolerance=2)
+    fits_index.save()
+    assert [[os.path.basename(f) for f in files] for files in matched] == [
+        ['aia.304.00.fits', 'aia.304.24.fits', 'aia.304.36.fits'],
+        ['aia.171.01.fits', 'aia.171.25.fits', 'aia.171.37.fits'],
+        ['aia.193.00.fits', 'aia.193.23.fits', 'aia.193.35.fits']]
+    # Headers are only read again for modified files
+    reloaded = FitsIndex(index_file)
+    assert reloaded.update(channel_files[0]) == 0
+    write_aia_fits(channel_files[0][0], data, t_obs='2012-08-31T19:00:40.00Z')
+    os.utime(channel_files[0][0], ns=(0, 0))
+    assert reloaded.update(channel_files[0]) == 1
+
+
+def test_process_rgb_list_resume(tmp_path):
+    aia_mixer = write_aia_mixer(tmp_path, 3)
+    manifest_file = str(tmp_path / 'manifest.json')
+    summary = aia_mixer.process_rgb_list(1, range(2), manifest_file=manifest_file, progress_interval=None)
+    assert (summary['done'], summary['skipped']) == (2, 0)
+    # Only the new image, the image with a missing output and the image with a modified input are rendered again
+    os.remove(aia_mixer.filepath_lab + '_%04d.jpeg' % 0)
+    summary = aia_mixer.process_rgb_list(1, range(3), manifest_file=manifest_file, progress_interval=None)
+    assert (summary['done'], summary['skipped']) == (2, 1)
+    write_aia_fits(aia_mixer.data_files[1][2], np.ones((128, 128), dtype=np.int16), crota=2)
+    summary = aia_mixer.process_rgb_list(1, range(3), manifest_file=manifest_file, progress_interval=None)
+    assert (summary['done'], summary['skipped']) == (1, 2)
+    # Changing the scaling parameters renders all images again
+    aia_mixer.gamma_rgb = [2.5, 2.5, 2.5]
+    summary = aia_mixer.process_rgb_list(1, range(3), manifest_file=manifest_file, progress_interval=None)
+    assert (summary['done'], summary['skipped']) == (3, 0)
+
+
+def test_benchmark_synthetic_data(tmp_path):
+    data_files = benchmark.write_synthetic_series(str(tmp_path), 2, size=256)
+    header = fits.getheader(data_files[0][1], 1)
+    assert header['WAVELNTH'] == 304 and header['T_OBS'] == '2012-08-31T19:00:12.00Z'
+    prepdata = aiaprep(data_files[1][0], cropsize=256)
+    assert prepdata.shape == (256, 256) and prepdata[128, 128] > 10 * prepdata[0, 0]
+    results = benchmark.run_benchmarks(sizes=[128], ncores=[1], repeats=2, nimages=2, workdir=str(tmp_path))
+    assert [r['name'] for r in results][-2:] == ['process_rgb_image', 'process_rgb_list']
+    assert all(r['throughput'] > 0 and r['latency']['p50'] > 0 for r in results)
+    # Peak of the fresh process of the parallel benchmark, not of this process
+    assert 0 < results[-1]['peak_rss_mb'] < benchmark.peak_rss()
+
+
+def test_instrumentation(tmp_path):
+    aia_mixer = write_aia_mixer(tmp_path, 2)
+    # Nothing is recorded when disabled
+    aia_mixer.process_rgb(0)
+    assert not instrumentation.events()
+    instrumentation.enable()
+    try:
+        aia_mixer.process_rgb_list(2, range(2), progress_interval=None)
+    finally:
+        instrumentation.enable(False)
+    events = instrumentation.collect()
+    summary = instrumentation.summary(events)
+    assert set(summary) == {'read_aia', 'warp', 'scale_rgb', 'lab', 'imwrite'}
+    assert summary['read_aia']['calls'] == 6 and summary['warp']['calls'] == 6
+    assert summary['read_aia']['bytes_read'] == sum(os.path.getsize(files[i]) for files in aia_mixer.data_files
+                                                          for i in range(2))
+    frames = instrumentation.frame_summary(events)
+    assert sorted(frames) == [0, 1]
+    assert frames[1]['bytes_written'] == os.path.getsize(aia_mixer.filepath_lab + '_0001.jpeg')
+    # Per-image growth of the peak memory, within the peak memory of the process
+    assert 0 <= frames[1]['peak_growth'] <= frames[1]['process_peak_rss']
+    # Background writes are recorded as stages of the image they belong to
+    instrumentation.enable()
+    try:
+        aia_mixer.frame_writer = FrameWriter(nthreads=1)
+        aia_mixer.process_rgb_list(1, range(2), progress_interval=None)
+    finally:
+        instrumentation.enable(False)
+    events = instrumentation.collect()
+    write_frames = [event['frame'] for event in events if event['name'] == 'imwrite']
+    assert sorted(write_frames) == [0, 1]
+    assert 'imwrite' in instrumentation.summary_table(events)
+    trace_file = str(tmp_path / 'trace.json')
+    instrumentation.write_trace(trace_file, events)
+    with open(trace_file) as f:
+        trace = json.load(f)
+    assert len(trace['traceEvents']) == len(events) and trace['traceEvents'][0]['ph'] == 'X'
+
+
+def test_tile_pyramid_writer(tmp_path):
+    image = (np.random.rand(400, 600, 3) * 255).astype(np.uint8)
+    writer = TilePyramidWriter(str(tmp_path), basename='im', tile_size=128, tile_format='png', nthreads=2)
+    nbytes = writer.write(image, 3)
+    tiles_dir = str(tmp_path / 'im_0003_files')
+    # 600 px wide: levels 0 (1x1) to 10 (600x400), with 5x4 tiles at full resolution
+    assert sorted(int(level) for level in os.listdir(tiles_dir) if level.isdigit()) == list(range(11))
+    assert len(os.listdir(os.path.join(tiles_dir, '10'))) == 20
+    assert np.array_equal(cv2.imread(os.path.join(tiles_dir, '10', '4_3.png')), image[384:, 512:])
+    assert cv2.imread(os.path.join(tiles_dir, '9', '0_0.png')).shape == (128, 128, 3)
+    # Unchanged tiles are not written again
+    mtime = os.stat(os.path.join(tiles_dir, '10', '0_0.png')).st_mtime_ns
+    assert writer.write(image, 3) == 0
+    # Only the tiles of the top-left corner are written again
+    image[0:10, 0:10] = 0
+    assert 0 < writer.write(image, 3) < nbytes / 4
+    assert os.stat(os.path.join(tiles_dir, '10', '0_0.png')).st_mtime_ns != mtime
+
+
+def test_process_rgb_tiles(tmp_path):
+    aia_mixer = write_aia_mixer(tmp_path, 1)
+    aia_mixer.tile_writer = TilePyramidWriter(str(tmp_path), basename='im_lab', tile_size=64)
+    _, bgr_lab = aia_mixer.process_rgb(0)
+    assert os.path.isfile(str(tmp_path / 'im_lab_0000.dzi'))
+    assert len(os.listdir(str(tmp_path / 'im_lab_0000_files' / '7'))) == 4
+
+
+def test_color_lut_matches_color_path(tmp_path):
+    data_files = benchmark.write_synthetic_series(str(tmp_path), 1, size=512)
+    rgb = [aiaprep(files[0], cropsize=512) for files in data_files]
+    histogram = IntensityHistogram()
+    histogram.update(rgb)
+    rgbmix = np.array([[1.0, 0.6, -0.3], [0.0, 1.0, 0.1], [0.0, 0.1, 1.0]])
+    kwargs = dict(rgblow=histogram.percentile((25, 25, 25)), rgbhigh=histogram.percentile((99.5, 99.99, 99.85)),
+                  gamma_rgb=(2.8, 2.8, 2.4), scalemin=20, rgbmix=rgbmix, lab=(1, 0.96, 1.04), cropsize=512,
+                  crop=(slice(0, 400), slice(100, 512)))
+    expected = process_rgb_image(0, data_files, **kwargs)
+    images = process_rgb_image(0, data_files, color_lut=True, **kwargs)
+    for image, expected_image in zip(images, expected):
+        assert image.shape == expected_image.shape == (412, 400, 3)
+        difference = np.abs(image.astype(int) - expected_image)
+        assert difference.mean() < 0.5 and difference.max() <= 6
+    # One table per set of parameters
+    assert get_color_lut((2.8, 2.8, 2.4), None, 0, None, 0) is get_color_lut((2.8, 2.8, 2.4), None, 0, None, 0)
+
+
+def test_adaptive_scaling(tmp_path):
+    data_files = [[write_aia_fits(str(tmp_path / ('aia.%s.%d.fits' % (wavel, i))),
+                                  (np.random.rand(128, 128) * 100 * (4 if i == 2 else 1)).astype(np.int16))
+                   for i in range(5)] for wavel in ['304', '171', '193']]
+    aia_mixer = RGBMixer(data_files=data_files, outputdir=str(tmp_path))
+    aia_mixer.set_aia_default()
+    aia_mixer.cropsize = 128
+    with pytest.raises(ValueError, match='frame_cache'):
+        aia_mixer.set_adaptive_scaling()
+    aia_mixer.frame_cache = FrameCache(str(tmp_path / 'cache'))
+    aia_mixer.set_adaptive_scaling(window=1, subsample=2)
+    rgbhigh = np.array([aia_mixer.frame_scaling[i][1] for i in range(5)])
+    # The brighter image gets 4 times higher scaling values
+    np.testing.assert_allclose(rgbhigh[2] / rgbhigh[[0, 1, 3, 4]], 4, rtol=0.05)
+    # Statistics of the calibrated images, as rendered
+    expected = [np.percentile(aiaprep(data_files[j][2], cropsize=128)[::2, ::2], aia_mixer.percentiles_high[j])
+                for j in range(3)]
+    np.testing.assert_allclose(rgbhigh[2], expected, rtol=0.02)
+    # Smoothed over 3 images, the window is truncated at the ends
+    aia_mixer.set_adaptive_scaling(window=3, subsample=2, ncores=2)
+    smoothed = np.array([aia_mixer.frame_scaling[i][1] for i in range(5)])
+    np.testing.assert_allclose(smoothed[0], rgbhigh[0:2].mean(axis=0), rtol=1e-6)
+    np.testing.assert_allclose(smoothed[2], rgbhigh[1:4].mean(axis=0), rtol=1e-6)
+    rgblow, rgbhigh = aia_mixer.frame_scaling[2]
+    # The rendering reads the images calibrated by the statistics pass
+    misses = aia_mixer.frame_cache.misses
+    bgr_rgb, bgr_lab = aia_mixer.process_rgb(2, write_images=False)
+    assert aia_mixer.frame_cache.misses == misses
+    expected_rgb, expected_lab = process_rgb_image(2, data_files, rgblow, rgbhigh, gamma_rgb=aia_mixer.gamma_rgb,
+                                                   scalemin=aia_mixer.scalemin, rgbmix=aia_mixer.rgbmix,
+                                                   lab=aia_mixer.lab, cropsize=128)
+    assert np.array_equal(bgr_rgb, expected_rgb) and np.array_equal(bgr_lab, expected_lab)
+    # A downscaled preview gets the scaling values of the full resolution rendering
+    aia_mixer.downscale = 4
+    aia_mixer.set_adaptive_scaling(window=3, subsample=2)
+    assert aia_mixer.frame_cache.misses == misses
+    np.testing.assert_array_equal(aia_mixer.frame_scaling[2], (rgblow, rgbhigh))
+
+
+def test_strip_tone_mapping_is_identical(tmp_path):
+    data_files = benchmark.write_synthetic_series(str(tmp_path), 1, size=256)
+    rgbmix = np.array([[1.0, 0.6, -0.3], [0.0, 1.0, 0.1], [0.0, 0.1, 1.0]])
+    # The high scaling values give a tone-mapped image that does not reach 255, converted to CIELab in a second pass
+    for precision, rgbhigh in [('float32', [400, 450, 480]), ('raw', [400, 450, 480]), ('float32', [1e5, 1e5, 1e5])]:
+        kwargs = dict(rgblow=np.array([10, 10, 10]), rgbhigh=np.array(rgbhigh), gamma_rgb=(2.8, 2.8, 2.4),
+                      scalemin=20, rgbmix=rgbmix, lab=(1, 0.96, 1.04), cropsize=(301, 203), precision=precision,
+                      crop=(slice(0, 250), slice(20, 200)))
+        expected = process_rgb_image(0, data_files, **kwargs)
+        for strip_rows in [1, 64, 1000]:
+            images = process_rgb_image(0, data_files, strip_rows=strip_rows, **kwargs)
+            assert np.array_equal(images[0], expected[0]) and np.array_equal(images[1], expected[1])
+
+
+def test_lease_queue(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    node1, node2 = LeaseQueue(queue_dir, lease_timeout=60, owner='node1'), LeaseQueue(queue_dir, lease_timeout=60,
+                                                                                        owner='node2')
+    assert node1.claim_batch(range(4), 2) == [0, 1]
+    assert node2.claim_batch(range(4), 2) == [2, 3]
+    node1.complete(0)
+    node1.close()
+    # Released and done images
+    assert node2.status(range(4)) == {'done': 1, 'leased': 2, 'pending': 1}
+    assert node2.claim_batch(range(4), 4) == [1]
+    # Leases that were not refreshed within the lease timeout are recovered
+    assert not node1.claim(2)
+    os.utime(node2.lease_path(2), (0, 0))
+    assert node1.claim(2)
+    assert node1.done_info(0)['owner'] == 'node1'
+    # The process that lost the lease does not remove the new one
+    node2.release(2)
+    assert node2.lease_owner(2) == 'node1'
+    # Successive batches continue the scan where the previous one stopped
+    node3 = LeaseQueue(queue_dir, lease_timeout=60, owner='node3')
+    assert node3.claim_batch(range(8), 1) == [4] and node3.cursor == 5
+
+
+def test_process_rgb_queue_nodes(tmp_path):
+    aia_mixer = write_aia_mixer(tmp_path, 6)
+    queue_dir = str(tmp_path / 'queue')
+    # A node died while holding the lease of image 4
+    queue = LeaseQueue(queue_dir, owner='dead')
+    queue.claim(4)
+    os.utime(queue.lease_path(4), (0, 0))
+    mixer_file = str(tmp_path / 'mixer.pickle')
+    with open(mixer_file, 'wb') as f:
+        pickle.dump(aia_mixer, f)
+    # Separate processes act as nodes
+    script = ('import pickle, sys; mixer = pickle.load(open(sys.argv[1], "rb")); '
+              'mixer.process_rgb_queue(sys.argv[2], range(6), batch_size=1, lease_timeout=60, owner=sys.argv[3], '
+              'progress_interval=None)')
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    nodes = [subprocess.Popen([sys.executable, '-c', script, mixer_file, queue_dir, 'node%d' % n], cwd=root_dir)
+             for n in range(3)]
+    assert all(node.wait() == 0 for node in nodes)
+    assert queue.wait(range(6), timeout=0)
+    assert all(os.path.isfile(aia_mixer.filepath_lab + '_%04d.jpeg' % i) for i in range(6))
+    assert {queue.done_info(i)['owner'] for i in range(6)} <= {'node0', 'node1', 'node2'}
+    assert not glob.glob(os.path.join(queue_dir, '*.lease'))
+    # The lease of the dead node is still fresh when the last node runs out of images to claim
+    queue_dir = str(tmp_path / 'queue_fresh')
+    LeaseQueue(queue_dir, owner='dead').claim(4)
+    summary = aia_mixer.process_rgb_queue(queue_dir, range(6), lease_timeout=1, progress_interval=None)
+    assert summary['done'] == 6 and LeaseQueue(queue_dir).wait(range(6), timeout=0)
+
+
+def test_prefetcher(tmp_path):
+    files = [str(tmp_path / ('file%d' % i)) for i in range(4)]
+    for i, path in enumerate(files):
+        with open(path, 'wb') as f:
+            f.write(bytes([i]) * 1000)
+    prefetcher = prefetch.Prefetcher(max_bytes=2000)
+    prefetcher.schedule(files)
+    # Wait for the reads within the memory budget
+    time.sleep(0.2)
+    assert prefetcher.stats()['used'] == 2000
+    assert [prefetcher.take(path) for path in files[:2]] == [bytes([0]) * 1000, bytes([1]) * 1000]
+    assert prefetcher.take(str(tmp_path / 'unscheduled')) is None
+    prefetcher.clear()
+    stats = prefetcher.stats()
+    assert (stats['hits'], stats['misses'], stats['used'], stats['peak_bytes']) == (2, 1, 0, 2000)
+    # Files that will not be taken free their memory without counting as misses
+    prefetcher.schedule(files[:1])
+    time.sleep(0.2)
+    prefetcher.discard(files[:1])
+    stats = prefetcher.stats()
+    assert (stats['misses'], stats['used']) == (1, 0)
+    prefetcher.close()
+
+
+def test_process_rgb_list_read_ahead(tmp_path):
+    aia_mixer = write_aia_mixer(tmp_path, 4)
+    expected = {i: aia_mixer.process_rgb(i, write_images=False)[1].copy() for i in range(4)}
+    for ncores, frame_transport in [(1, 'pickle'), (2, 'pickle'), (2, 'shared_memory')]:
+        frames = {}
+        summary = aia_mixer.process_rgb_list(ncores, range(4), write_images=False, progress_interval=None,
+                                             read_ahead=1, frame_transport=frame_transport,
+                                             frame_consumer=lambda i, frame: frames.update({i: frame.copy()}))
+        assert all(np.array_equal(frames[i], expected[i]) for i in range(4))
+        assert summary['done'] == 4 and summary['prefetch']['hits'] + summary['prefetch']['misses'] == 12
+    assert prefetch.installed() is None
+    # Images in the frame cache are not read ahead
+    aia_mixer.frame_cache = FrameCache(str(tmp_path / 'cache'))
+    for expected_reads in (12, 0):
+        summary = aia_mixer.process_rgb_list(2, range(4), write_images=False, progress_interval=None, read_ahead=1)
+        assert summary['prefetch']['hits'] + summary['prefetch']['misses'] == expected_reads
+    # The worker of the second run schedules none of the cached files
+    visualization._init_render_worker(aia_mixer.render_config(), False, prefetch_bytes=2 ** 24)
+    visualization._prefetch_images(range(4))
+    assert not prefetch.installed().state and not prefetch.installed().ready
+    prefetch.install(None)
+
+
+def test_cli_config(tmp_path):
+    config = {'mixer': {'data_dir': str(tmp_path), 'wavel_dirs': ['304', '171', '193'], 'outputdir': str(tmp_path),
+                        'defaults': 'aia', 'gama_rgb': [2, 2, 2]}}
+    with pytest.raises(ValueError, match='gama_rgb'):
+        cli.validate_config(config)
+    with pytest.raises(ValueError, match='rgblow and rgbhigh'):
+        cli.validate_config({'mixer': {'data_dir': str(tmp_path), 'wavel_dirs': ['304', '171', '193'],
+                                       'outputdir': str(tmp_path), 'rgbhigh': [400, 450, 480]}})
+    assert cli.rendition_keys == VideoRendition._fields
+    assert cli.frame_indices({'file_range': {'start': 2, 'step': 2}}, 7) == [2, 4, 6]
+    # Dry runs only import the standard library
+    del config['mixer']['gama_rgb']
+    config_file = str(tmp_path / 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = ('import sys, cli; cli.main(["render", sys.argv[1], "--dry-run"]); '
+              'print([module for module in ("numpy", "cv2", "astropy", "visualization") if module in sys.modules])')
+    output = subprocess.check_output([sys.executable, '-c', script, config_file], cwd=root_dir, text=True)
+    assert output.splitlines() == ['Would render 0 images from 0 / 0 / 0 files to %s with 1 processes' % tmp_path,
+                                   '[]']
+
+
+def test_cli_render(tmp_path):
+    data_files = write_aia_series(tmp_path, 2)
+    config = {'mixer': {'data_files': data_files, 'outputdir': str(tmp_path / 'rgb'), 'defaults': 'aia',
+                        'cropsize': 128, 'gamma_rgb': [2.5, 2.5, 2.5], 'crop': [[0, 100], [10, 120]],
+                        'rgblow': [10, 10, 10], 'rgbhigh': [400, 450, 480]},
+              'render': {'progress_interval': None},
+              'encode': {'renditions': [{'movie_filename': 'movie', 'frame_size': [100, 110]}]}}
+    config_file = str(tmp_path / 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    # Exit status of the console script
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = 'import sys, cli; sys.exit(cli.main(["render", sys.argv[1]]))'
+    assert subprocess.run([sys.executable, '-c', script, config_file], cwd=root_dir).returncode == 0
+    image = cv2.imread(str(tmp_path / 'rgb' / 'im_lab_0001.jpeg'))
+    assert image.shape == (110, 100, 3)
+    assert cli.main(['encode', config_file, '--dry-run']) == 0
+    command = cli.run_encode(cli.load_config(config_file), argparse.Namespace(dry_run=True))
+    assert '-vf scale=100:110' in command and command.endswith('movie.mp4 -y')
+    # A failed encoding is an error
+    config['encode']['images_dir'] = str(tmp_path / 'missing')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    with pytest.raises(SystemExit) as error:
+        cli.main(['encode', config_file])
+    assert error.value.code != 0
+
+
+def test_frame_writer_formats(tmp_path):
+    frame = (np.random.rand(40, 50, 3) * 255).astype(np.uint8)
+    basename = str(tmp_path / 'im')
+    FrameWriter().write(basename, 1, frame)
+    cv2.imwrite(str(tmp_path / 'expected.jpeg'), frame, [int(cv2.IMWRITE_JPEG_QUALITY), 95])
+    with open(basename + '_0001.jpeg', 'rb') as f, open(str(tmp_path / 'expected.jpeg'), 'rb') as g:
+        assert f.read() == g.read()
+    for image_format, expected in [('png', frame), ('png16', frame.astype(np.uint16) * 257),
+                                   ('tiff16', frame.astype(np.uint16) * 257)]:
+        path = FrameWriter(image_format).write(basename, 2, frame)
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        assert image.dtype == expected.dtype and np.array_equal(image, expected)
+    assert np.array_equal(np.load(FrameWriter('npy').write(basename, 3, frame)), frame)
+    # Background writes of a copy of the frame, without temporary files left
+    writer = FrameWriter('png', nthreads=2, max_pending=2)
+    paths = [writer.write(basename, i, frame) for i in range(10, 16)]
+    frame[:] = 0
+    writer.close()
+    assert all(cv2.imread(path).any() for path in paths)
+    assert not glob.glob(str(tmp_path / '*.tmp'))
+    # A failed background write is raised by flush() even after the write finished
+    writer = FrameWriter('jpeg', nthreads=1)
+    writer.write(str(tmp_path / 'missing' / 'im'), 1, frame)
+    writer.executor.shutdown()
+    writer.executor = None
+    writer.write(basename, 20, frame)
+    with pytest.raises(FileNotFoundError):
+        writer.flush()
+
+
+def test_process_rgb_list_frame_writer(tmp_path):
+    aia_mixer = write_aia_mixer(tmp_path, 3)
+    aia_mixer.filename_rgb = 'im_rgb'
+    aia_mixer.frame_writer = FrameWriter('png', nthreads=2)
+    summary = aia_mixer.process_rgb_list(1, range(3), progress_interval=None, read_ahead=2)
+    assert summary['done'] == 3
+    # Worker processes complete their background writes when they exit
+    os.remove(aia_mixer.filepath_lab + '_0002.png')
+    aia_mixer.process_rgb_list(2, range(3), progress_interval=None)
+    assert len(glob.glob(aia_mixer.filepath_lab + '_*.png')) == 3
+    bgr_rgb, bgr_lab = aia_mixer.process_rgb(2, write_images=False)
+    assert np.array_equal(cv2.imread(aia_mixer.filepath_lab + '_0002.png'), bgr_lab)
+    assert np.array_equal(cv2.imread(aia_mixer.filepath_rgb + '_0002.png'), bgr_rgb)
+    # 16-bit images from the floating-point images
+    aia_mixer.frame_writer = FrameWriter('png16')
+    aia_mixer.process_rgb(2)
+    image16 = cv2.imread(aia_mixer.filepath_lab + '_0002.png', cv2.IMREAD_UNCHANGED)
+    assert image16.dtype == np.uint16
+    # Differences with the 8-bit image come from its 8-bit CIELab conversion, which clips a few pixels
+    difference = np.abs(image16 / 257 - bgr_lab)
+    assert difference.mean() < 1 and np.percentile(difference, 99) < 5
+
+
+def test_preview_downscale(tmp_path):
+    data_files = benchmark.write_synthetic_series(str(tmp_path), 1, size=512)
+    prepdata = aiaprep(data_files[1][0], cropsize=512)
+    for downscale in [2, 4, 8]:
+        preview = aiaprep(data_files[1][0], cropsize=512, downscale=downscale)
+        expected = cv2.resize(prepdata, (512 // downscale, 512 // downscale), interpolation=cv2.INTER_AREA)
+        assert preview.shape == expected.shape
+        # Same grid as the area-averaged full resolution image, without the blur of warping at full resolution first
+        assert np.abs(preview - expected).mean() < 0.02 * expected.mean()
+    aia_mixer = RGBMixer(data_files=data_files, outputdir=str(tmp_path))
+    aia_mixer.cropsize = 512
+    aia_mixer.set_aia_default()
+    rgbhigh = aia_mixer.rgbhigh
+    aia_mixer.downscale = 4
+    aia_mixer.crop = (slice(100, 400), slice(0, 512))
+    aia_mixer.set_aia_default()
+    # Scaling values of the full resolution images
+    assert np.array_equal(aia_mixer.rgbhigh, rgbhigh)
+    bgr_rgb, bgr_lab = aia_mixer.process_rgb(0, write_images=False)
+    assert bgr_lab.shape == aia_mixer.frame_shape() == (128, 75, 3)
 
 
-
-
-
-
-
+def test_parameter_sweep(tmp_path):
+    data_files = benchmark.write_synthetic_series(str(tmp_path), 1, size=256)
+    aia_mixer = RGBMixer(data_files=data_files, outputdir=str(tmp_path))
+    aia_mixer.cropsize = 256
+    aia_mixer.crop = (slice(20, 236), slice(0, 200))
+    aia_mixer.set_aia_default()
+    variants = parameter_grid(percentiles_high=[(99.9, 99.99, 99.95), (99.95, 99.9, 99.99)],
+                              gamma_rgb=[(2.8, 2.8, 2.4), (2.2, 2.2, 2.2)], rgbmix=[None, aia_mixer.rgbmix],
+                              scalemin=[0, 20])
+    variants[3]['lab'] = None
+    variants[5]['lmin'] = 10
+    assert len(variants) == 16
+    sheet_file = str(tmp_path / 'sheet.png')
+    bgr_rgb, bgr_lab, sheet = aia_mixer.sweep(variants, batch_size=5, filename=sheet_file)
+    assert bgr_rgb.shape == bgr_lab.shape == (16, 200, 216, 3)
+    assert sheet.shape == (4 * 200 + 3 * 4, 4 * 216 + 3 * 4, 3)
+    assert os.path.isfile(sheet_file)
+    for k, variant in enumerate(variants):
+        aia_mixer.set_ref_low_high(phigh=variant['percentiles_high'])
+        for name in ('gamma_rgb', 'rgbmix', 'scalemin'):
+            setattr(aia_mixer, name, variant[name])
+        aia_mixer.lab = variant.get('lab', (1, 0.96, 1.04))
+        aia_mixer.lmin = variant.get('lmin', 0)
+        expected_rgb, expected_lab = aia_mixer.process_rgb(0, write_images=False)
+        # Same images as the rendering of each parameter set
+        assert np.array_equal(bgr_rgb[k], expected_rgb)
+        assert np.array_equal(bgr_lab[k], expected_rgb if expected_lab is None else expected_lab)
+    with pytest.raises(ValueError):
+        aia_mixer.sweep([{'gamma': 2}])
+    # The channels of the scaling values of the previous batches are released
+    pdatargb = [np.random.rand(256, 256).astype(np.float32) for _ in range(3)]
+    variants = [{'rgblow': 0, 'rgbhigh': 1 + k / 100, 'gamma_rgb': (2, 2, 2)} for k in range(32)]
+    tracemalloc.start()
+    render_sweep(pdatargb, variants, batch_size=2)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # 32 distinct normalized and gamma-scaled channels would hold 48 MB, on top of the 12 MB of the returned images
+    # and their concatenation
+    assert peak < 32 * 2 ** 20
@@ -1,11 +1,25 @@
 import os, glob
+import time
+import math
+import functools
+import itertools
+import collections
+import concurrent.futures
+import multiprocessing
+import multiprocessing.util
 import numpy as np
 from astropy.io import fits
 import cv2
 import calibration
+import instrumentation
+import prefetch
 import subprocess
 from calibration import aiaprep
-import multiprocessing
+from pipeline import FramePipeline, SharedFrameRing
+from fits_index import FitsIndex
+from manifest import RunManifest, parameters_hash
+from work_queue import LeaseQueue
+from writers import default_frame_writer
 
 #  disable multithreading in opencv. Default is to use all available, which is rather inefficient in this context
 cv2.setNumThreads(0)
@@ -18,7 +32,7 @@ class RGBMixer:
     """
 
     def __init__(self, data_dir=None, wavel_dirs=None, data_files=None, calibrate=True, outputdir=None, ref=0, crop=None,
-                 filename_lab=None, filename_rgb=None):
+                 filename_lab=None, filename_rgb=None, precision='float32', time_tolerance=None, index_file=None):
         """
 
         :param data_dir: Parent directory of the 3 subdirectories.
@@ -27,11 +41,18 @@ class RGBMixer:
         the paths must be relative to data_dir.
         :param data_files: list of RGB files. data_files[rgb channel][image index]. data_dir or data_files must be present.
         :param calibrate: set to True if the aia fits files need to be calitrated.
-        :param ref: index of the reference image used to get the intensity scaling values
+        :param ref: index of the reference image used to get the intensity scaling values, or sequence of indices
+        to accumulate the intensity statistics over several images, e.g. over a whole event.
         :param outputdir: directory for the output rgb images
         :param crop: (x,y)=(cols, rows) coordinates for cropping. E.g (slice(0,1024), slice(100,3200))
         :param filename_rgb: basename for the jpeg images if lab space unused, appended with the image number
         :param filename_lab: basename for lab-space-modified images, appended with the image number.
+        :param precision: working precision of the calibration and tone-mapping, one of calibration.precision_modes.
+        'float32' (default), 'float64', or 'raw' to keep the integer data and fold the exposure time in the scaling.
+        :param time_tolerance: if set, images of the 3 channels are matched by observation time instead of by their
+        position in the sorted file lists, within this tolerance in seconds. Unmatched images are left out.
+        :param index_file: json file of the fits_index.FitsIndex of the headers used for matching the images in time.
+        It is created or updated, so that headers are only read once. Default is to read the headers every time.
         """
 
         self.data_dir = data_dir
@@ -55,13 +76,47 @@ class RGBMixer:
             self.data_files=data_files
         else:
             if os.path.isdir(self.wavel_dirs[0]) and os.path.isdir(self.wavel_dirs[1]) and os.path.isdir(self.wavel_dirs[2]):
-                self.data_files = [glob.glob(os.path.join(ddir, '*.fits')) for ddir in self.wavel_dirs]
+                self.data_files = [sorted(glob.glob(os.path.join(ddir, '*.fits'))) for ddir in self.wavel_dirs]
             else:
                 raise ValueError('wavelength directories do not exist')
 
+        if time_tolerance is not None:
+            fits_index = FitsIndex(index_file)
+            self.data_files = fits_index.match_triplets(self.data_files, time_tolerance)
+            fits_index.save()
+
         self.calibrate = calibrate
-        self.ref_rgb_files = [files[ref] for files in self.data_files]
+        calibration.precision_dtype(precision)
+        self.precision = precision
+        self.ref_rgb_files = [files[np.atleast_1d(ref)[0]] for files in self.data_files]
         self.crop = crop
+        # Tone-map in the preallocated buffers of each process. Arrays returned by process_rgb are overwritten
+        # by the next call in the same process.
+        self.reuse_buffers = True
+        # Optional frame_cache.FrameCache of the calibrated images, e.g. to re-render an event with new colors
+        self.frame_cache = None
+        # Number of threads reading and calibrating the 3 channels of an image concurrently, in each process.
+        # Useful to cut the latency of single images, or to use fewer processes when memory is the limit.
+        self.nthreads = 1
+        # Optional writers.TilePyramidWriter of the output images, for zoomable viewers
+        self.tile_writer = None
+        # Optional writers.FrameWriter of the output images, e.g. for background writes or other formats.
+        # Default writes jpeg images at quality 95.
+        self.frame_writer = None
+        # Apply the color path through a cached 3D lookup table. See ColorLUT.
+        self.color_lut = False
+        # Tone-map in horizontal strips of this number of rows to bound the memory, or None for the full frame.
+        # See StripToneMapper.
+        self.strip_rows = None
+        # Adaptive scaling values of each image {image index: (rgblow, rgbhigh)}, set by set_adaptive_scaling.
+        # Images without adaptive values use rgblow and rgbhigh.
+        self.frame_scaling = None
+        # Size and center of the calibrated output grid. See calibration.aiaprep.
+        self.cropsize = calibration.aia_image_size
+        self.crop_center = None
+        # Preview mode: calibrate and render the images downscaled by this factor, e.g. 2, 4 or 8, with area averaging.
+        # Scaling values are still taken from the full resolution images, and crop is given in full resolution pixels.
+        self.downscale = 1
         # Reference image index to extract scaling values
         self.ref = ref
         # minimum and maximum rescaling values of each channel before gamma scaling
@@ -71,10 +126,8 @@ class RGBMixer:
         # Path and file naming scheme of the output images. This will be appended with the image number
         # for images processed in rgb space
         self.filename_rgb = filename_rgb
-        self.filepath_rgb = None
         # for images processed  in lab space
         self.filename_lab = filename_lab
-        self.filepath_lab = None
         # Intensity percentiles for linear scaling
         self.percentiles_low = (0, 0, 0)
         self.percentiles_high = (99.99, 99.99, 99.99)
@@ -88,13 +141,18 @@ class RGBMixer:
         self.lab = None
         # For contrast stretching on luminance (L) layer. L ranges in [0-255]
         self.lmin = 0
-        # Reference rgb image used for the intensity scaling values
+        # Reference rgb image used for the intensity scaling values. Only used if set by the user, the intensity
+        # statistics of the reference images are otherwise accumulated in the histograms below.
         self.ref_rgb = None
+        # IntensityHistogram of the reference image(s) used for the intensity scaling values
+        self.ref_histogram = None
+        # Calibrated reference images of the last sweep, reused by the next sweeps of the same image
+        self.sweep_images = None
 
     def set_aia_default(self):
 
-        # Load and prep reference image
-        self.ref_rgb = [aiaprep(fitsfile) for fitsfile in self.ref_rgb_files]
+        # Accumulate the intensity statistics of the reference image(s)
+        self.set_ref_histogram()
 
         self.percentiles_low = (25, 25, 25)
         self.percentiles_high = (99.5, 99.99, 99.85)
@@ -110,6 +168,26 @@ class RGBMixer:
         self.filename_lab = 'im_lab'
         self.set_ref_low_high()
 
+    def set_ref_histogram(self, ref=None, subsample=1):
+        """
+        Accumulate the intensity histograms of the reference image(s), one channel at a time so that only one prepped
+        image is held in memory. Percentiles for any scaling values can then be read from the histograms.
+
+        :param ref: index or sequence of indices of the reference images. Default is self.ref.
+        :param subsample: only use every subsample-th pixel along each axis, e.g. to go faster over many images.
+        """
+        if ref is None:
+            ref = self.ref
+        # Scaling values are always taken from exposure-normalized data.
+        ref_precision = 'float64' if self.precision == 'float64' else 'float32'
+        prep = aiaprep if self.frame_cache is None else self.frame_cache.aiaprep
+        histogram = IntensityHistogram()
+        for index in np.atleast_1d(ref):
+            for j in range(3):
+                histogram.update_channel(j, prep(self.data_files[j][index], precision=ref_precision),
+                                         subsample=subsample)
+        self.ref_histogram = histogram
+
     def set_ref_low_high(self, plow=None, phigh=None):
 
         if plow is None:
@@ -117,51 +195,694 @@ class RGBMixer:
         if phigh is None:
             phigh = self.percentiles_high
 
-        self.rgblow = np.array([np.percentile(self.ref_rgb[j], plow[j]) for j in range(3)])
-        self.rgbhigh = np.array([np.percentile(self.ref_rgb[j], phigh[j]) for j in range(3)])
+        if self.ref_histogram is None and self.ref_rgb is not None:
+            self.rgblow = np.array([np.percentile(self.ref_rgb[j], plow[j]) for j in range(3)])
+            self.rgbhigh = np.array([np.percentile(self.ref_rgb[j], phigh[j]) for j in range(3)])
+            return
 
-    def process_rgb(self, image_index):
-        """Setup which image version to output. Can be either just rgb, just lab, or both"""
+        if self.ref_histogram is None:
+            self.set_ref_histogram()
+        self.rgblow = self.ref_histogram.percentile(plow)
+        self.rgbhigh = self.ref_histogram.percentile(phigh)
 
-        bgr_stack1, bgr_stack2 = process_rgb_image(image_index, data_files=self.data_files,
-                                                   rgblow=self.rgblow, rgbhigh=self.rgbhigh, scalemin=self.scalemin,
-                                                   gamma_rgb=self.gamma_rgb,
-                                                   rgbmix=self.rgbmix,
-                                                   lab=self.lab,
-                                                   lmin=self.lmin,
-                                                   crop=self.crop,
-                                                   filename_rgb=self.filepath_rgb, filename_lab=self.filepath_lab)
-        return bgr_stack1, bgr_stack2
+    def set_adaptive_scaling(self, file_range=None, window=9, subsample=8, ncores=1):
+        """
+        Set per-image scaling values, to follow flares and exposure changes across an event instead of using the
+        values of the reference image(s) for all images. The percentiles_low and percentiles_high of each image are
+        estimated with an IntensityHistogram of every subsample-th pixel along each axis, then smoothed over time with
+        a centered moving average. Set the percentiles first, e.g. with set_aia_default().
+
+        The statistics are taken on the calibrated images at full resolution, whatever the downscale, so that a preview
+        gets the scaling values of the final rendering, and exposure-normalized as for the reference histogram. These
+        images are read from the frame_cache, which is required with calibrated data, with the same key as the full
+        resolution rendering: each fits file is thus read and calibrated once, by this pass, and the final rendering
+        reads the cached images instead.
+
+        :param file_range: sequence of image indices. Default is all images.
+        :param window: number of images of the moving average. 1 disables the smoothing.
+        :param subsample: only use every subsample-th pixel along each axis
+        :param ncores: number of parallel processes
+        """
+        if self.calibrate and self.frame_cache is None:
+            raise ValueError('set_adaptive_scaling requires a frame_cache with calibrated data')
+        if file_range is None:
+            file_range = range(len(self.data_files[0]))
+        file_range = sorted(file_range)
+        statistics = {}
+        frame_pipeline = FramePipeline(ncores, progress_interval=None)
+        frame_pipeline.run(_scaling_worker, file_range, initializer=_init_scaling_worker,
+                           initargs=(self.render_config(write_images=False), self.percentiles_low,
+                                     self.percentiles_high, subsample),
+                           consumer=lambda result: statistics.update({result['index']: result['low_high']}))
+        low_high = smooth_scaling(np.array([statistics[i] for i in file_range]), window)
+        self.frame_scaling = {i: (low, high) for i, (low, high) in zip(file_range, low_high)}
+
+    @property
+    def filepath_rgb(self):
+        """ Path and file naming scheme of the rgb images in the output directory, or None if not written """
+        if self.filename_rgb is None:
+            return None
+        return os.path.join(self.outputdir, self.filename_rgb)
+
+    @property
+    def filepath_lab(self):
+        """ Path and file naming scheme of the lab-space-modified images in the output directory, or None if not written """
+        if self.filename_lab is None:
+            return None
+        return os.path.join(self.outputdir, self.filename_lab)
+
+    def render_config(self, write_images=True):
+        """
+        Snapshot of the processing parameters, without any image data, e.g. to send to worker processes.
 
+        :param write_images: set to False to not write the images to the output directory.
+        :return: RenderConfig
+        """
+        return RenderConfig(
+            data_files=tuple(tuple(files) for files in self.data_files),
+            calibrate=self.calibrate,
+            rgblow=tuple(float(value) for value in np.broadcast_to(self.rgblow, 3)),
+            rgbhigh=tuple(float(value) for value in np.broadcast_to(self.rgbhigh, 3)),
+            scalemin=self.scalemin,
+            gamma_rgb=tuple(self.gamma_rgb),
+            rgbmix=None if self.rgbmix is None else tuple(map(tuple, np.asarray(self.rgbmix).tolist())),
+            lab=None if self.lab is None else tuple(self.lab),
+            lmin=self.lmin,
+            crop=self.crop,
+            filename_rgb=self.filepath_rgb if write_images else None,
+            filename_lab=self.filepath_lab if write_images else None,
+            precision=self.precision,
+            cropsize=self.cropsize,
+            crop_center=self.crop_center,
+            reuse_buffers=self.reuse_buffers,
+            frame_cache=self.frame_cache,
+            nthreads=self.nthreads,
+            tile_writer=self.tile_writer if write_images else None,
+            color_lut=self.color_lut,
+            strip_rows=self.strip_rows,
+            frame_scaling=None if self.frame_scaling is None else tuple(
+                (i, tuple(float(value) for value in low), tuple(float(value) for value in high))
+                for i, (low, high) in sorted(self.frame_scaling.items())),
+            frame_writer=self.frame_writer,
+            downscale=self.downscale)
+
+    def process_rgb(self, image_index, write_images=True, timings=None):
+        """Setup which image version to output. Can be either just rgb, just lab, or both
+
+        :param image_index: image index in the list of files
+        :param write_images: set to False to only return the images without writing them to the output directory.
+        :param timings: optional dictionary of per-stage wall times. See process_rgb_image.
+        With a background frame_writer, the images are written while the next images are processed: call
+        frame_writer.flush() before reading them.
+        """
 
-    def process_rgb_list(self, ncores, file_range):
+        config = self.render_config(write_images=write_images)
+        return render_frame(config, image_index, timings=timings)
+
+    def frame_shape(self):
+        """ Shape of the output images of calibrated data: [rows, cols, 3] """
+        rows, cols = calibration.downscaled_shape(calibration.output_grid(self.cropsize, self.crop_center)[0],
+                                                  self.downscale)
+        if self.crop is not None:
+            rows, cols = np.broadcast_to(0, (rows, cols))[downscale_crop(self.crop, self.downscale)[::-1]].shape
+        return rows, cols, 3
+
+    def process_rgb_list(self, ncores, file_range, video_streams=None, write_images=True, max_pending=None,
+                         maxtasksperchild=None, progress_interval=10, frame_consumer=None, frame_transport='pickle',
+                         manifest_file=None, hash_inputs=False, read_ahead=0, read_ahead_bytes=2 ** 28,
+                         image_done=None):
+        """
+        Process a list of images, optionally in parallel. Images are dispatched one at a time to the first available
+        worker, and only their per-stage timings are returned to the parent process, unless they are consumed.
+
+        :param ncores: number of parallel processes
+        :param file_range: sequence of image indices. Without video_streams or manifest_file, any iterable, consumed as
+        the images are dispatched to the processes.
+        :param video_streams: optional sequence of VideoStream, to which the frames are piped in the order of file_range.
+        The lab images are streamed if lab is set, the rgb images otherwise.
+        :param write_images: set to False to not write the images, e.g. if they are only streamed to ffmpeg.
+        :param max_pending: maximum number of images in flight. Default is twice the number of processes.
+        :param maxtasksperchild: number of images after which a worker process is replaced, to cap memory growth.
+        :param progress_interval: minimum time in seconds between progress reports. None disables the reports.
+        :param frame_consumer: optional function called in this process as frame_consumer(image_index, frame) for each
+        image, in the order they complete. Same image as streamed. The frame may be a view into a buffer reused after
+        the call: copy it to keep it.
+        :param frame_transport: how workers send the images to this process, if streamed or consumed.
+        'pickle' (default) or 'shared_memory' to write them into a pipeline.SharedFrameRing, without pickling.
+        :param manifest_file: optional path to the json file of a manifest.RunManifest, to resume or update a previous
+        run. Images already rendered from the same input files and parameters are skipped if their output files exist.
+        Requires writing the images, and cannot be combined with streaming or consuming the frames.
+        :param hash_inputs: set to True to compare the contents of the input files in the manifest, not only their
+        size and modification time.
+        :param read_ahead: number of images assigned to each worker in advance, whose fits files are read ahead in
+        background threads of the worker while it processes its current image. 0 disables the read-ahead.
+        max_pending and maxtasksperchild are then not used. See pipeline.FramePipeline.run.
+        :param read_ahead_bytes: memory budget in bytes of the files read ahead in each worker.
+        :param image_done: optional function called in this process with the index of each image once its files are
+        written, e.g. to mark it done in a work queue.
+        :return: summary of the run: number of images, elapsed time, throughput and mean wall time per stage.
+        The number of images skipped is added if a manifest is used. With read_ahead, the number of files read from
+        memory (hits) and from the files (misses), and the time spent waiting for reads in progress are added.
+        """
+
+        if frame_transport not in ('pickle', 'shared_memory'):
+            raise ValueError("frame_transport must be 'pickle' or 'shared_memory'")
+
+        config = self.render_config(write_images=write_images)
+        manifest = None
+        if manifest_file is not None:
+            if not write_images or video_streams or frame_consumer is not None:
+                raise ValueError('A manifest requires writing the images, without streaming or consuming them')
+            manifest = RunManifest(manifest_file, hash_contents=hash_inputs)
+            file_range = list(file_range)
+            todo = [i for i in file_range if not manifest.is_up_to_date(
+                i, frame_input_files(config, i), render_parameters_hash(config, i), frame_output_files(config, i))]
+            skipped = len(file_range) - len(todo)
+            if skipped:
+                print('Skipping %d up-to-date images' % skipped)
+            file_range = todo
+
+        sink = OrderedFrameSink(file_range, video_streams) if video_streams else None
+        return_frames = sink is not None or frame_consumer is not None
+        ring = None
+        if return_frames and frame_transport == 'shared_memory' and ncores > 1:
+            nslots = (max_pending if max_pending is not None else 2 * ncores) if read_ahead <= 0 else \
+                ncores * (read_ahead + 1)
+            ring = SharedFrameRing(nslots, self.frame_shape())
+
+        prefetch_stats = {'hits': 0, 'misses': 0, 'wait': 0.0}
+
+        def consume(result):
+            if 'events' in result:
+                instrumentation.add_events(result['events'])
+            if 'prefetch' in result:
+                for key, value in result['prefetch'].items():
+                    prefetch_stats[key] += value
+            if manifest is not None:
+                i = result['index']
+                manifest.record(i, frame_input_files(config, i), render_parameters_hash(config, i),
+                                frame_output_files(config, i))
+            if image_done is not None:
+                image_done(result['index'])
+            if not return_frames:
+                return
+            frame = result['frame'] if ring is None else ring.view(result['slot'])
+            if sink is not None:
+                sink.put(result['index'], frame)
+            if frame_consumer is not None:
+                frame_consumer(result['index'], frame)
+            if ring is not None:
+                del frame
+                ring.release(result['slot'])
+
+        # The background writes of an image overlap the processing of the next images, except if the manifest
+        # must certify that its files are written.
+        flush_writes = manifest is not None or image_done is not None
+        # Workers only receive the processing parameters, once, and never the reference images.
+        frame_pipeline = FramePipeline(ncores, max_pending=max_pending, maxtasksperchild=maxtasksperchild,
+                                       progress_interval=progress_interval)
+        try:
+            summary = frame_pipeline.run(_render_worker, file_range, initializer=_init_render_worker,
+                                         initargs=(config, return_frames, ring, instrumentation.enabled,
+                                                   read_ahead_bytes if read_ahead > 0 else None, flush_writes),
+                                         consumer=consume, read_ahead=read_ahead, prepare=_prefetch_images)
+            if config.frame_writer is not None:
+                # Writes of the workers that ran in this process. Worker processes flush theirs when they exit.
+                config.frame_writer.flush()
+        finally:
+            if ring is not None:
+                ring.close()
+            if read_ahead > 0 and ncores <= 1:
+                # Workers ran in this process
+                prefetch.install(None)
+            # Saved even if the run fails, so that the images already rendered are not rendered again.
+            if manifest is not None:
+                manifest.save()
+        if sink is not None:
+            sink.close()
+        if manifest is not None:
+            summary['skipped'] = skipped
+        if read_ahead > 0:
+            files = prefetch_stats['hits'] + prefetch_stats['misses']
+            summary['prefetch'] = dict(prefetch_stats, hit_rate=prefetch_stats['hits'] / files if files else 0)
+        return summary
+
+    def process_rgb_queue(self, queue_dir, file_range, ncores=1, batch_size=None, lease_timeout=600, owner=None,
+                          progress_interval=10):
+        """
+        Process a list of images as one of several nodes sharing the job through a work_queue.LeaseQueue, e.g. on
+        several hosts with a shared filesystem. Each node runs this method with the same queue directory, image list
+        and output directory, and claims batches of images until none is left. The claimed images are fed to a single
+        pool of processes, the next batch being claimed as the processes become free. Images of a node that died are
+        processed again by another node once their leases expire: a node that runs out of images to claim keeps
+        checking the leases of the other nodes until they are all done. The images are written to the output directory
+        with their index in the full series, so the nodes merge their results into the same image sequence, which can
+        be encoded once LeaseQueue.wait() returns.
+
+        :param queue_dir: directory of the lease files and done markers, shared by all the nodes
+        :param file_range: sequence of image indices of the whole job
+        :param ncores: number of parallel processes on this node
+        :param batch_size: number of images claimed at once. Default is the number of processes.
+        :param lease_timeout: time in seconds after which the leases of a node that stopped refreshing them are
+        recovered. Must be much longer than the processing time of an image.
+        :param owner: name of this node in the queue. Default is <hostname>-<pid>.
+        :param progress_interval: minimum time in seconds between progress reports. None disables the reports.
+        :return: summary of the images processed by this node: number of images and of batches, elapsed time and
+        throughput.
+        """
+        file_range = list(file_range)
+        batch_size = batch_size if batch_size is not None else ncores
+        batches = 0
+        with LeaseQueue(queue_dir, lease_timeout=lease_timeout, owner=owner) as queue:
+            queue.start_heartbeat()
+
+            def claimed_images():
+                # Images are claimed as the processes become free, and fed to the same pool of processes
+                nonlocal batches
+                while True:
+                    batch = queue.claim_batch(file_range, batch_size)
+                    if not batch:
+                        status = queue.status(file_range)
+                        with queue.lock:
+                            own_leases = len(queue.leases)
+                        if status['pending'] == 0 and status['leased'] <= own_leases:
+                            return
+                        if status['pending'] == 0:
+                            # Leased by other nodes, which may have died: retry until their leases expire
+                            time.sleep(lease_timeout / 10)
+                        continue
+                    batches += 1
+                    if progress_interval is not None:
+                        print('%s: claimed %d images, job status %s' % (queue.owner, len(batch),
+                                                                          queue.status(file_range)))
+                    yield from batch
+
+            summary = self.process_rgb_list(ncores, claimed_images(), progress_interval=progress_interval,
+                                            image_done=queue.complete)
+        return {'done': summary['done'], 'batches': batches, 'elapsed': summary['elapsed'],
+                'throughput': summary['throughput']}
+
+    def sweep(self, variants, image_index=None, downscale=None, batch_size=8, filename=None, columns=None):
+        """
+        Render one image with many sets of tone-mapping parameters, e.g. to explore the gamma, mixing and scaling
+        values of an event in seconds instead of rendering a movie per set. The calibrated images are prepared once and
+        kept for the next sweeps of the same image, and the images are tone-mapped in batches by render_sweep.
+
+        :param variants: sequence of dictionaries of parameter values, e.g. from parameter_grid(). The parameters are
+        those of sweep_parameters. Missing parameters are taken from the mixer. Percentiles are read from the reference
+        histogram, unless rgblow and rgbhigh are given.
+        :param image_index: image index in the list of files. Default is the reference image.
+        :param downscale: downscaling factor of the calibration. Default is the mixer downscale.
+        :param batch_size: number of images tone-mapped at once. See render_sweep.
+        :param filename: optional path of the contact sheet image to write
+        :param columns: number of columns of the contact sheet. Default makes a square grid.
+        :return: 8-bit bgr images of the variants [variants, rows, cols, 3], CIELab images if lab is set, and the
+        contact sheet, as in process_rgb_image.
+        """
+        if image_index is None:
+            image_index = int(np.atleast_1d(self.ref)[0])
+        downscale = downscale if downscale is not None else self.downscale
+        key = (image_index, self.calibrate, self.cropsize, self.crop_center, downscale, self.precision)
+        if self.sweep_images is None or self.sweep_images[0] != key:
+            files = [self.data_files[j][image_index] for j in range(3)]
+            exptime = None
+            if self.calibrate:
+                prep = aiaprep if self.frame_cache is None else self.frame_cache.aiaprep
+                pdatargb, headers = zip(*[prep(fitsfile, cropsize=self.cropsize, precision=self.precision,
+                                               return_header=True, crop_center=self.crop_center, downscale=downscale)
+                                          for fitsfile in files])
+                if self.precision == 'raw':
+                    exptime = [header['EXPTIME'] for header in headers]
+            else:
+                pdatargb = [load_fits(fitsfile, precision=self.precision) for fitsfile in files]
+                if downscale > 1:
+                    pdatargb = [calibration.downscale_image(data, downscale) for data in pdatargb]
+            self.sweep_images = (key, list(pdatargb), exptime)
+        _, pdatargb, exptime = self.sweep_images
+
+        if any('percentiles_low' in variant or 'percentiles_high' in variant for variant in variants):
+            if self.ref_histogram is None:
+                self.set_ref_histogram()
+        defaults = {'gamma_rgb': self.gamma_rgb, 'rgbmix': self.rgbmix, 'scalemin': self.scalemin, 'lab': self.lab,
+                    'lmin': self.lmin}
+        variants = [dict(defaults, **variant) for variant in variants]
+        for variant in variants:
+            if 'rgblow' not in variant and 'percentiles_low' not in variant:
+                variant['rgblow'] = self.rgblow
+            if 'rgbhigh' not in variant and 'percentiles_high' not in variant:
+                variant['rgbhigh'] = self.rgbhigh
+        rgb_images, lab_images = render_sweep(pdatargb, variants, histogram=self.ref_histogram,
+                                              precision=self.precision, exptime=exptime, batch_size=batch_size)
+        if self.crop is not None:
+            crop = downscale_crop(self.crop, downscale)[::-1]
+            rgb_images = rgb_images[(slice(None),) + crop]
+            if lab_images is not None:
+                lab_images = lab_images[(slice(None),) + crop]
+        sheet = contact_sheet(rgb_images if lab_images is None else lab_images, columns=columns)
+        if filename is not None:
+            cv2.imwrite(filename, sheet)
+        return rgb_images, lab_images, sheet
+
+
+RenderConfig = collections.namedtuple('RenderConfig', [
+    'data_files', 'calibrate', 'rgblow', 'rgbhigh', 'scalemin', 'gamma_rgb', 'rgbmix', 'lab', 'lmin', 'crop',
+    'filename_rgb', 'filename_lab', 'precision', 'cropsize', 'crop_center', 'reuse_buffers', 'frame_cache',
+    'nthreads', 'tile_writer', 'color_lut', 'strip_rows', 'frame_scaling', 'frame_writer', 'downscale'])
+RenderConfig.__doc__ = """ Immutable set of parameters of process_rgb_image, created by RGBMixer.render_config().
+Sequences are stored as tuples, and it holds no image data, so that it is cheap to send to worker processes. """
+
+
+def render_frame(config, image_index, timings=None):
+    """
+    Process an image with the parameters of a RenderConfig. See process_rgb_image.
+
+    :param config: RenderConfig
+    :param image_index: image index in the list of files
+    :param timings: optional dictionary of per-stage wall times.
+    :return: rgb and lab images
+    """
+    rgblow, rgbhigh = frame_scaling_values(config, image_index)
+    return process_rgb_image(image_index, data_files=config.data_files, calibrate=config.calibrate,
+                             rgblow=np.array(rgblow), rgbhigh=np.array(rgbhigh),
+                             scalemin=config.scalemin,
+                             gamma_rgb=config.gamma_rgb,
+                             rgbmix=None if config.rgbmix is None else np.array(config.rgbmix),
+                             lab=config.lab,
+                             lmin=config.lmin,
+                             crop=config.crop,
+                             filename_rgb=config.filename_rgb, filename_lab=config.filename_lab,
+                             precision=config.precision,
+                             cropsize=config.cropsize, crop_center=config.crop_center,
+                             reuse_buffers=config.reuse_buffers,
+                             frame_cache=config.frame_cache,
+                             timings=timings,
+                             nthreads=config.nthreads,
+                             tile_writer=config.tile_writer,
+                             color_lut=config.color_lut,
+                             strip_rows=config.strip_rows,
+                             frame_writer=config.frame_writer,
+                             downscale=config.downscale)
+
+
+def frame_input_files(config, image_index):
+    """
+    :param config: RenderConfig
+    :param image_index: image index in the list of files
+    :return: list of the input files of the image, one per channel
+    """
+    return [files[image_index] for files in config.data_files]
+
+
+def frame_output_files(config, image_index):
+    """
+    :param config: RenderConfig
+    :param image_index: image index in the list of files
+    :return: list of the image files written by render_frame
+    """
+    writer = config.frame_writer if config.frame_writer is not None else default_frame_writer
+    outputs = []
+    if config.filename_rgb is not None:
+        outputs.append(writer.filename(config.filename_rgb, image_index))
+    if config.lab is not None and config.filename_lab is not None:
+        outputs.append(writer.filename(config.filename_lab, image_index))
+    return outputs
+
+
+def render_parameters_hash(config, image_index=None):
+    """
+    Hash of the parameters of a RenderConfig that determine the rendered images, i.e. without the input and output
+    files, which are compared separately, nor the parameters that only affect the performance.
+
+    :param config: RenderConfig
+    :param image_index: optional image index. With adaptive scaling, only the scaling values of that image are hashed.
+    :return: hexadecimal string
+    """
+    if image_index is not None:
+        rgblow, rgbhigh = frame_scaling_values(config, image_index)
+        config = config._replace(rgblow=rgblow, rgbhigh=rgbhigh, frame_scaling=None)
+    return parameters_hash(config._replace(data_files=None, filename_rgb=None, filename_lab=None, reuse_buffers=None,
+                                           frame_cache=None, nthreads=None, tile_writer=None,
+                                           strip_rows=None))
 
-        if ncores > 1:
-            multiprocessing.set_start_method('spawn')
-            p = multiprocessing.Pool(ncores)
-            p.map(self.process_rgb, file_range)
-            p.close()
-        else:
-            for i in file_range:
-                _ = self.process_rgb(i)
 
+def frame_scaling_values(config, image_index):
+    """
+    :param config: RenderConfig
+    :param image_index: image index in the list of files
+    :return: rgblow and rgbhigh of the image: its adaptive scaling values if any, those of the config otherwise.
+    """
+    if config.frame_scaling is not None:
+        for index, rgblow, rgbhigh in config.frame_scaling:
+            if index == image_index:
+                return rgblow, rgbhigh
+    return config.rgblow, config.rgbhigh
 
 
-def rgb_high_low(rgb_files, percentiles_low, percentiles_high):
+def smooth_scaling(values, window):
+    """
+    Centered moving average over time of per-image scaling values. The window is truncated at both ends of the series.
+
+    :param values: numpy array of scaling values, the first axis being time
+    :param window: number of images of the moving average
+    :return: numpy array of the smoothed values
+    """
+    half = window // 2
+    cumsum = np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+    n = len(values)
+    start = np.clip(np.arange(n) - half, 0, n)
+    stop = np.clip(np.arange(n) + half + 1, 0, n)
+    count = (stop - start).reshape((-1,) + (1,) * (values.ndim - 1))
+    return (cumsum[stop] - cumsum[start]) / count
+
+
+# State of the worker processes of RGBMixer.set_adaptive_scaling, set once per process by _init_scaling_worker.
+_scaling_state = None
+
+
+def _init_scaling_worker(config, percentiles_low, percentiles_high, subsample):
+    global _scaling_state
+    _scaling_state = (config, percentiles_low, percentiles_high, subsample)
+
+
+def _scaling_worker(image_index):
+    config, percentiles_low, percentiles_high, subsample = _scaling_state
+    histogram = IntensityHistogram()
+    for j in range(3):
+        fitsfile = config.data_files[j][image_index]
+        # At full resolution: area averaging of a downscaled preview lowers the high percentiles
+        if config.calibrate:
+            # Same cache entry as process_rgb_image at full resolution
+            data, header = config.frame_cache.aiaprep(fitsfile, cropsize=config.cropsize, precision=config.precision,
+                                                      return_header=True, crop_center=config.crop_center)
+            data = data[::subsample, ::subsample]
+            if config.precision == 'raw':
+                # Scaling values are always taken from exposure-normalized data.
+                data = data / np.float32(header['EXPTIME'])
+        else:
+            data = load_fits(fitsfile, precision=config.precision)[::subsample, ::subsample]
+        histogram.update_channel(j, data)
+    return {'index': image_index,
+            'low_high': (histogram.percentile(percentiles_low), histogram.percentile(percentiles_high))}
+
+
+# State of the worker processes of RGBMixer.process_rgb_list, set once per process by _init_render_worker.
+_worker_config = None
+_worker_return_frames = False
+_worker_ring = None
+# Wait for the background writes of each image before returning its result, e.g. for a manifest entry
+_worker_flush_writes = False
+# Whether the input files of the images assigned to the worker are in the frame cache, see _prefetch_images
+_worker_cached = {}
+
+
+def _init_render_worker(config, return_frames, ring=None, instrument=False, prefetch_bytes=None, flush_writes=False):
+    global _worker_config, _worker_return_frames, _worker_ring, _worker_flush_writes
+    _worker_config = config
+    _worker_return_frames = return_frames
+    _worker_ring = ring
+    _worker_flush_writes = flush_writes
+    instrumentation.enable(instrument)
+    if prefetch_bytes is not None:
+        prefetch.install(prefetch.Prefetcher(max_bytes=prefetch_bytes))
+    if config.frame_writer is not None and multiprocessing.parent_process() is not None:
+        # The last background writes of a worker complete when the pool shuts it down. Their instrumentation events
+        # are not collected.
+        multiprocessing.util.Finalize(config.frame_writer, config.frame_writer.close, exitpriority=10)
+
+
+def _render_worker(image_index):
+    timings = {}
+    prefetcher = prefetch.installed()
+    if prefetcher is not None:
+        before = prefetcher.stats()
+    bgr_stack1, bgr_stack2 = render_frame(_worker_config, image_index, timings=timings)
+    input_files = frame_input_files(_worker_config, image_index)
+    if prefetcher is not None:
+        # Files read ahead and not taken, e.g. cached in the meantime by another process, would hold the memory budget
+        prefetcher.discard(input_files)
+    for path in input_files:
+        _worker_cached.pop(path, None)
+    if _worker_flush_writes and _worker_config.frame_writer is not None:
+        # The result tells the parent process that the images are written
+        _worker_config.frame_writer.flush()
+    result = {'index': image_index, 'timings': timings, 'frame': None}
+    if prefetcher is not None:
+        after = prefetcher.stats()
+        result['prefetch'] = {key: after[key] - before[key] for key in ('hits', 'misses', 'wait')}
+    if _worker_return_frames:
+        frame = bgr_stack1 if bgr_stack2 is None else bgr_stack2
+        if _worker_ring is not None:
+            result['slot'] = _worker_ring.put(frame)
+        else:
+            result['frame'] = frame
+    if instrumentation.enabled:
+        result['events'] = instrumentation.collect()
+    return result
+
+
+def _prefetch_images(image_indices):
+    """ Read the fits files of the next images of the worker ahead, except those in the frame cache, of which only the
+    header is read. See pipeline.FramePipeline.run. """
+    config = _worker_config
+    paths = [path for i in image_indices for path in frame_input_files(config, i)]
+    if config.calibrate and config.frame_cache is not None:
+        for path in paths:
+            if path not in _worker_cached:
+                _worker_cached[path] = config.frame_cache.contains(path, cropsize=config.cropsize,
+                                                                   precision=config.precision,
+                                                                   crop_center=config.crop_center,
+                                                                   downscale=config.downscale)
+        paths = [path for path in paths if not _worker_cached[path]]
+    prefetch.schedule(paths)
+
+
+def rgb_high_low(rgb_files, percentiles_low, percentiles_high, precision='float32'):
     """ Convenience function to get the minimum and maximum rescaling values of each channel before gamma scaling.
 
     :param rgb_files: list of 3 files. 1 per channel
     :param percentiles_low: list of percentiles for the minimum scaling value, in order of [red, green, blue]
     :param percentiles_high: list of percentiles for the maximum scaling value, in order of [red, green, blue]
+    :param precision: 'float32' or 'float64'. Scaling values are always computed on exposure-normalized data.
     :return: 2 lists of 3 minimum and maximum intensity. one per channel in each list.
     """
-    pdatargb = [aiaprep(rgb_files[j]) for j in range(3)]
-    rgblow = np.array([np.percentile(pdatargb[j], percentiles_low[j]) for j in range(3)])
-    rgbhigh = np.array([np.percentile(pdatargb[j], percentiles_high[j]) for j in range(3)])
-    return rgblow, rgbhigh
+    histogram = IntensityHistogram()
+    for j in range(3):
+        histogram.update_channel(j, aiaprep(rgb_files[j], precision=precision))
+    return histogram.percentile(percentiles_low), histogram.percentile(percentiles_high)
+
+
+class IntensityHistogram:
+    """ Streaming estimator of the intensity percentiles of the rgb channels.
+    Intensities are accumulated in fixed, logarithmically-spaced bins, so that any number of images can be added in one
+    pass with a bounded memory, and percentiles are then interpolated within the bins without sorting any data.
+    The default bins are about 0.1 % wide in relative intensity.
+    """
 
+    def __init__(self, vmin=1e-2, vmax=1e6, nbins=16384, nchannels=3):
+        """
+        :param vmin: lower edge of the logarithmic bins. Values in ]0, vmin[ share a single linear bin.
+        :param vmax: upper edge of the logarithmic bins. Values above share a single bin up to the maximum value.
+        :param nbins: number of logarithmic bins
+        :param nchannels: number of channels
+        """
+        self.vmin = vmin
+        self.vmax = vmax
+        self.nbins = nbins
+        self.log_vmin = np.log(vmin)
+        self.dlog = (np.log(vmax) - self.log_vmin) / nbins
+        # bin 0: values <= 0, bin 1: ]0, vmin[, logarithmic bins, last bin: values >= vmax
+        self.counts = np.zeros((nchannels, nbins + 3), dtype=np.int64)
+        self.min = np.full(nchannels, np.inf)
+        self.max = np.full(nchannels, -np.inf)
+
+    def update(self, rgb, subsample=1):
+        """
+        Add an image to the histograms.
+
+        :param rgb: list of images, one per channel.
+        :param subsample: only use every subsample-th pixel along each axis.
+        """
+        for j, channel in enumerate(rgb):
+            self.update_channel(j, channel, subsample=subsample)
+
+    def update_channel(self, j, data, subsample=1):
+        """
+        Add the image of a single channel to its histogram.
+
+        :param j: channel index
+        :param data: numpy array
+        :param subsample: only use every subsample-th pixel along each axis.
+        """
+        data = np.asarray(data)
+        if subsample > 1:
+            data = data[::subsample, ::subsample]
+        data = data.astype(np.float32, copy=False).ravel()
+        data = data[np.isfinite(data)]
+        if data.size == 0:
+            return
+
+        idx = np.log(np.maximum(data, np.float32(self.vmin)))
+        idx -= np.float32(self.log_vmin)
+        idx /= np.float32(self.dlog)
+        idx = idx.astype(np.int64)
+        idx += 2
+        np.minimum(idx, self.nbins + 2, out=idx)
+        idx[data < self.vmin] = 1
+        idx[data <= 0] = 0
+        self.counts[j] += np.bincount(idx, minlength=self.nbins + 3)
+        self.min[j] = min(self.min[j], data.min())
+        self.max[j] = max(self.max[j], data.max())
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same bins, e.g. accumulated in another process.
+
+        :param other: IntensityHistogram
+        """
+        if other.counts.shape != self.counts.shape or other.vmin != self.vmin or other.vmax != self.vmax:
+            raise ValueError('histograms must have the same bins')
+        self.counts += other.counts
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+
+    def percentile(self, percentiles):
+        """
+        Estimate the intensity percentiles, one per channel.
+
+        :param percentiles: percentile for all channels or sequence of percentiles, one per channel, in [0-100]
+        :return: numpy array of the intensity percentiles, one per channel.
+        """
+        nchannels = self.counts.shape[0]
+        percentiles = np.broadcast_to(np.asarray(percentiles, dtype=np.float64), nchannels)
+        return np.array([self._channel_percentile(j, percentiles[j]) for j in range(nchannels)])
+
+    def _channel_percentile(self, j, q):
+        counts = self.counts[j]
+        cumcounts = np.cumsum(counts)
+        if cumcounts[-1] == 0:
+            raise ValueError('histogram of channel %d is empty' % j)
+        if q <= 0:
+            return self.min[j]
+        if q >= 100:
+            return self.max[j]
+        # Same rank definition as the default linear interpolation of np.percentile
+        rank = q / 100 * (cumcounts[-1] - 1)
+        b = np.searchsorted(cumcounts, rank, side='right')
+        previous = cumcounts[b - 1] if b > 0 else 0
+        frac = np.clip((rank - previous + 0.5) / counts[b], 0, 1)
+
+        if b == 0:
+            value = self.min[j] * (1 - frac)
+        elif b == 1:
+            value = frac * self.vmin
+        elif b == self.nbins + 2:
+            value = self.vmax + frac * (self.max[j] - self.vmax)
+        else:
+            value = np.exp(self.log_vmin + (b - 2 + frac) * self.dlog)
+        return np.clip(value, self.min[j], self.max[j])
 
-def scale_rgb(rgb, rgblow, rgbhigh, gamma_rgb=(2.8, 2.8, 2.4), rgbmix=None, scalemin=0):
+
+def scale_rgb(rgb, rgblow, rgbhigh, gamma_rgb=(2.8, 2.8, 2.4), rgbmix=None, scalemin=0, precision='float32', exptime=None):
     """ Rescale the rgb image series.
     First linearly rescales between minimum and maximum values independently on each channel.
     Apply gamma-scaling on the [0-1]-normalized channels.
@@ -174,30 +895,42 @@ def scale_rgb(rgb, rgblow, rgbhigh, gamma_rgb=(2.8, 2.8, 2.4), rgbmix=None, scal
     This is meant to be a single value and not a channel-dependent parameter.
     :param rgbmix: rgb mixing matrix in [red, green, blue] order in both dimensions.
     :param scalemin: minimum value for optional contrast stretching after gamma-scaling.
+    :param precision: working precision, one of calibration.precision_modes. 'raw' data are processed in float32.
+    :param exptime: exposure times of the 3 channels if the images are not normalized by the exposure time,
+    e.g. prepped in 'raw' precision. The normalization is then folded into the rescaling values.
     :return: rescaled rgb image as numpy 3D array: [height, width, rgb channels]
     """
 
-    rgb_gamma = 1 / np.array(gamma_rgb)
+    dtype = calibration.precision_dtype(precision)
+    rgblow = np.broadcast_to(np.asarray(rgblow, dtype=np.float64), 3)
+    rgbhigh = np.broadcast_to(np.asarray(rgbhigh, dtype=np.float64), 3)
+    if exptime is not None:
+        # (data/exptime - low) / (high - low) = (data - low*exptime) / ((high - low)*exptime)
+        rgblow = rgblow * np.asarray(exptime)
+        rgbhigh = rgbhigh * np.asarray(exptime)
+
+    # Scalars are cast to the working type so that numpy does not upcast the arrays
+    rgb_gamma = (1 / np.array(gamma_rgb, dtype=np.float64)).astype(dtype)
 
-    # Copy is needed due to in-place operations
-    rgb2 = rgb.copy()
+    rgb2 = [None] * 3
     for i in range(3):
-        rgb2[i] = (rgb[i] - rgblow[i]) * 1 / (rgbhigh[i] - rgblow[i])
+        rgb2[i] = np.subtract(rgb[i], dtype(rgblow[i]), dtype=dtype)
+        rgb2[i] /= dtype(rgbhigh[i] - rgblow[i])
         rgb2[i].clip(0, 1, out=rgb2[i])
 
     red, green, blue = [(channel ** gamma) for (channel, gamma) in zip(rgb2, rgb_gamma)]
 
     # Apply color mixing
     if rgbmix is not None:
-        [[rr, rg, rb], [gr, gg, gb], [br, bg, bb]] = rgbmix
+        [[rr, rg, rb], [gr, gg, gb], [br, bg, bb]] = np.asarray(rgbmix, dtype=dtype)
         nred = rr*red + rg*green + rb*blue  # ~ 320 ms
         ngreen = gr*red + gg*green + gb*blue  # ~ 180 ms
         nblue = br*red + bg*green + bb*blue
-        rgb_stack = np.stack((nred, ngreen, nblue), axis=-1).astype(np.float32)
+        rgb_stack = np.stack((nred, ngreen, nblue), axis=-1).astype(np.float32, copy=False)
     else:
-        rgb_stack = np.stack((red, green, blue), axis=-1).astype(np.float32)
+        rgb_stack = np.stack((red, green, blue), axis=-1).astype(np.float32, copy=False)
 
-    # stack and rescale channels for 8-bit range, convert from 64 to 32 bit float for now (needed for CIELab)
+    # stack and rescale channels for 8-bit range, convert to 32 bit float if needed (needed for CIELab)
     rgb_stack.clip(0, 1, out=rgb_stack)
     rgb_stack *= 255
     # Contrast stretch in RGB space
@@ -207,7 +940,510 @@ def scale_rgb(rgb, rgblow, rgbhigh, gamma_rgb=(2.8, 2.8, 2.4), rgbmix=None, scal
     return rgb_stack
 
 
-def process_lab_32bit(bgr, lf=1, af=1, bf=1, lmin=0):
+class ToneMapper:
+    """ Tone-mapping engine working in preallocated buffers.
+    Produces the same output as scale_rgb and the 8-bit conversions of process_rgb_image, but the working arrays are
+    allocated once and reused for every frame of the same shape, and all operations are done in place.
+    The returned arrays are views into these buffers: they are overwritten by the next frame.
+    """
+
+    def __init__(self, shape, precision='float32'):
+        """
+        :param shape: (rows, cols) shape of the images
+        :param precision: working precision, one of calibration.precision_modes
+        """
+        self.shape = tuple(shape)
+        self.precision = precision
+        self.dtype = calibration.precision_dtype(precision)
+        # normalized and gamma-scaled channels, and color-mixed channels
+        self.channels = np.empty((3, *self.shape), dtype=self.dtype)
+        self.mixed = np.empty((3, *self.shape), dtype=self.dtype)
+        self.tmp = np.empty(self.shape, dtype=self.dtype)
+        # stacked rgb channels in the 8-bit range, and 8-bit bgr outputs
+        self.rgb_stack = np.empty((*self.shape, 3), dtype=np.float32)
+        self.bgr8 = np.empty((*self.shape, 3), dtype=np.uint8)
+        self.lab8 = np.empty((*self.shape, 3), dtype=np.uint8)
+        self.bgr8_lab = np.empty((*self.shape, 3), dtype=np.uint8)
+
+    def scale_rgb(self, rgb, rgblow, rgbhigh, gamma_rgb=(2.8, 2.8, 2.4), rgbmix=None, scalemin=0, exptime=None):
+        """ In-place equivalent of scale_rgb. See scale_rgb for the parameters.
+
+        :return: rescaled rgb image as numpy 3D array: [height, width, rgb channels], view of the internal buffer.
+        """
+        dtype = self.dtype
+        rgblow = np.broadcast_to(np.asarray(rgblow, dtype=np.float64), 3)
+        rgbhigh = np.broadcast_to(np.asarray(rgbhigh, dtype=np.float64), 3)
+        if exptime is not None:
+            rgblow = rgblow * np.asarray(exptime)
+            rgbhigh = rgbhigh * np.asarray(exptime)
+        rgb_gamma = (1 / np.array(gamma_rgb, dtype=np.float64)).astype(dtype)
+
+        for i in range(3):
+            channel = self.channels[i]
+            np.subtract(rgb[i], dtype(rgblow[i]), out=channel, dtype=dtype)
+            channel /= dtype(rgbhigh[i] - rgblow[i])
+            channel.clip(0, 1, out=channel)
+            np.power(channel, rgb_gamma[i], out=channel)
+
+        # Apply color mixing
+        if rgbmix is not None:
+            mix = np.asarray(rgbmix, dtype=dtype)
+            for i in range(3):
+                np.multiply(mix[i, 0], self.channels[0], out=self.mixed[i])
+                for j in (1, 2):
+                    np.multiply(mix[i, j], self.channels[j], out=self.tmp)
+                    self.mixed[i] += self.tmp
+            channels = self.mixed
+        else:
+            channels = self.channels
+
+        rgb_stack = self.rgb_stack
+        for i in range(3):
+            rgb_stack[..., i] = channels[i]
+
+        rgb_stack.clip(0, 1, out=rgb_stack)
+        rgb_stack *= 255
+        # Contrast stretch in RGB space
+        rgb_stack -= scalemin
+        rgb_stack *= 255
+        rgb_stack /= 255 - scalemin
+        rgb_stack.clip(0, 255, out=rgb_stack)
+
+        return rgb_stack
+
+    def bgr_stack(self):
+        """ Flipped view of the rgb stack in the bgr channel order of OpenCV. Same as in process_rgb_image. """
+        return np.flipud(np.flip(self.rgb_stack, axis=2))
+
+    def to_bgr8(self):
+        """ 8-bit conversion of the bgr stack, in the internal buffer. """
+        np.copyto(self.bgr8, self.bgr_stack(), casting='unsafe')
+        return self.bgr8
+
+    def lab_to_bgr8(self, lab32):
+        """ 8-bit conversion of the output of process_lab_32bit back to the bgr color space, in the internal buffer. """
+        np.copyto(self.lab8, lab32, casting='unsafe')
+        cv2.cvtColor(self.lab8, cv2.COLOR_Lab2BGR, dst=self.bgr8_lab)
+        return self.bgr8_lab
+
+
+# One tone-mapping engine per process, reused as long as the image shape and precision do not change.
+_tone_mapper = None
+
+
+def get_tone_mapper(shape, precision='float32'):
+    """
+    Get the tone-mapping engine of the current process for a given image shape and precision.
+    The buffers of the previous engine are released if the shape or precision changed.
+
+    :param shape: (rows, cols) shape of the images
+    :param precision: working precision, one of calibration.precision_modes
+    :return: ToneMapper instance
+    """
+    global _tone_mapper
+    if _tone_mapper is None or _tone_mapper.shape != tuple(shape) or _tone_mapper.precision != precision:
+        _tone_mapper = None
+        _tone_mapper = ToneMapper(shape, precision=precision)
+    return _tone_mapper
+
+
+class StripToneMapper:
+    """ Tone-mapping and CIELab color balance of an image in horizontal strips of a fixed number of rows.
+    The floating-point working arrays are those of a ToneMapper of the strip size, so the memory used beyond the
+    calibrated input images and the 8-bit output images does not depend on the image size. The 8-bit output images are
+    still full frames, filled strip by strip, because the image encoders of the FrameWriter and the video streams take
+    whole images. They take 3 bytes per pixel each, against 12 bytes per pixel for the float32 arrays of the full-frame
+    path. The output is identical to the output of the full-frame path of process_rgb_image.
+
+    process_lab_32bit normalizes the image by its global minimum and maximum, unknown until all the strips are
+    tone-mapped. The tone-mapped values are clipped to [0-255], and real images reach both bounds, so the strips are
+    converted assuming this range, in a single pass. Only if the range of the image turns out to be narrower, the
+    strips are tone-mapped again and converted with that range.
+    """
+
+    def __init__(self, cols, precision='float32', strip_rows=256):
+        """
+        :param cols: number of columns of the images
+        :param precision: working precision, one of calibration.precision_modes
+        :param strip_rows: number of rows of the strips
+        """
+        self.cols = cols
+        self.precision = precision
+        self.strip_rows = strip_rows
+        self.tone_mappers = {}
+
+    def tone_mapper(self, rows):
+        # One engine for the full strips, and one for the last strip if shorter
+        if rows not in self.tone_mappers:
+            self.tone_mappers[rows] = ToneMapper((rows, self.cols), precision=self.precision)
+        return self.tone_mappers[rows]
+
+    def strips(self, rows):
+        """ (first row, last row + 1) of each strip of an image """
+        return [(y0, min(y0 + self.strip_rows, rows)) for y0 in range(0, rows, self.strip_rows)]
+
+    def tone_map(self, rgb, rgblow, rgbhigh, gamma_rgb=(2.8, 2.8, 2.4), rgbmix=None, scalemin=0, exptime=None,
+                 lab=None, lmin=0):
+        """
+        See scale_rgb and process_lab_32bit for the parameters.
+
+        :param rgb: list of the red, green and blue calibrated images
+        :return: 8-bit bgr image, and 8-bit bgr image balanced in CIELab space or None if lab is None. Both are
+        flipped upside down as in process_rgb_image.
+        """
+        rows = rgb[0].shape[0]
+        scale_args = dict(gamma_rgb=gamma_rgb, rgbmix=rgbmix, scalemin=scalemin, exptime=exptime)
+        bgr8 = np.empty((rows, self.cols, 3), dtype=np.uint8)
+        bgr8_lab = np.empty((rows, self.cols, 3), dtype=np.uint8) if lab is not None else None
+        # Range of the contrast-stretched values, clipped in scale_rgb
+        value_range = (0, 255)
+        image_min, image_max = np.inf, -np.inf
+        for y0, y1 in self.strips(rows):
+            tone_mapper = self.tone_mapper(y1 - y0)
+            tone_mapper.scale_rgb([channel[y0:y1] for channel in rgb], rgblow, rgbhigh, **scale_args)
+            # Input rows [y0, y1[ are output rows [rows - y1, rows - y0[ of the flipped images
+            bgr8[rows - y1:rows - y0] = tone_mapper.to_bgr8()
+            if lab is not None:
+                bgr_stack = tone_mapper.bgr_stack()
+                image_min = min(image_min, bgr_stack.min())
+                image_max = max(image_max, bgr_stack.max())
+                lab32 = process_lab_32bit(bgr_stack, lf=lab[0], af=lab[1], bf=lab[2], lmin=lmin,
+                                          value_range=value_range)
+                bgr8_lab[rows - y1:rows - y0] = tone_mapper.lab_to_bgr8(lab32)
+        if lab is not None and (image_min, image_max) != value_range:
+            # Second pass with the range of this image, as computed by process_lab_32bit on the full frame
+            value_range = (image_min, image_max)
+            for y0, y1 in self.strips(rows):
+                tone_mapper = self.tone_mapper(y1 - y0)
+                tone_mapper.scale_rgb([channel[y0:y1] for channel in rgb], rgblow, rgbhigh, **scale_args)
+                lab32 = process_lab_32bit(tone_mapper.bgr_stack(), lf=lab[0], af=lab[1], bf=lab[2], lmin=lmin,
+                                          value_range=value_range)
+                bgr8_lab[rows - y1:rows - y0] = tone_mapper.lab_to_bgr8(lab32)
+        return bgr8, bgr8_lab
+
+
+# One strip tone-mapping engine per process
+_strip_tone_mapper = None
+
+
+def get_strip_tone_mapper(cols, precision='float32', strip_rows=256):
+    """
+    Get the strip tone-mapping engine of the current process, replaced if its parameters change.
+
+    :param cols: number of columns of the images
+    :param precision: working precision, one of calibration.precision_modes
+    :param strip_rows: number of rows of the strips
+    :return: StripToneMapper instance
+    """
+    global _strip_tone_mapper
+    if _strip_tone_mapper is None or (_strip_tone_mapper.cols, _strip_tone_mapper.precision,
+                                      _strip_tone_mapper.strip_rows) != (cols, precision, strip_rows):
+        _strip_tone_mapper = None
+        _strip_tone_mapper = StripToneMapper(cols, precision=precision, strip_rows=strip_rows)
+    return _strip_tone_mapper
+
+
+# Parameters that can be swept by render_sweep and RGBMixer.sweep
+sweep_parameters = ('percentiles_low', 'percentiles_high', 'rgblow', 'rgbhigh', 'gamma_rgb', 'rgbmix', 'scalemin',
+                    'lab', 'lmin')
+
+
+def parameter_grid(**values):
+    """
+    All combinations of parameter values, e.g. for RGBMixer.sweep:
+    parameter_grid(gamma_rgb=[(2.4, 2.4, 2.4), (2.8, 2.8, 2.4)], scalemin=[0, 20, 40]) gives 6 parameter sets.
+
+    :param values: sequence of values of each parameter
+    :return: list of dictionaries of parameter values
+    """
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+def render_sweep(pdatargb, variants, histogram=None, precision='float32', exptime=None, batch_size=8):
+    """
+    Tone-map the same calibrated images with many parameter sets, e.g. to choose the tone-mapping of an event.
+    Gives the same images as the full-frame path of process_rgb_image, but the parts shared by several parameter sets
+    are computed once: the normalization of each channel for each distinct pair of scaling values, its gamma scaling
+    for each distinct gamma, and the percentiles read from the histograms. These channels are kept only until the last
+    batch that uses them. The color mixing, contrast stretching and CIELab conversions are then done on batches of
+    batch_size images at once.
+
+    :param pdatargb: calibrated images of the red, green and blue channels
+    :param variants: sequence of dictionaries of the parameters of each image: rgblow and rgbhigh, or percentiles_low
+    and percentiles_high read from the histogram, gamma_rgb, rgbmix, scalemin, and optionally lab and lmin.
+    :param histogram: IntensityHistogram of the reference images, for the percentiles
+    :param precision: working precision, one of calibration.precision_modes
+    :param exptime: exposure times of the 3 channels if the images are not normalized by the exposure time
+    :param batch_size: number of images processed at once, which bounds the memory of the color mixing and CIELab
+    conversions. The shared channels also hold memory: a normalized and a gamma-scaled image per distinct scaling
+    values and gamma of a channel in the batch, kept while the next batches share them, e.g. fewer when the variants
+    are ordered by scaling values.
+    :return: rgb images and CIELab-modified images, as 8-bit bgr numpy arrays [variants, height, width, 3]. The CIELab
+    images are None if no variant has lab, and the rgb images for the variants without lab.
+    """
+    dtype = calibration.precision_dtype(precision)
+    percentiles = {}
+    normalized = {}
+    gamma_scaled = {}
+
+    def percentile(values):
+        values = tuple(np.broadcast_to(values, 3).tolist())
+        if values not in percentiles:
+            percentiles[values] = histogram.percentile(values)
+        return percentiles[values]
+
+    def channel(j, low, high, gamma):
+        # Same operations as scale_rgb, each computed once
+        if (j, low, high) not in normalized:
+            low_exp, high_exp = (low, high) if exptime is None else (low * exptime[j], high * exptime[j])
+            data = np.subtract(pdatargb[j], dtype(low_exp), dtype=dtype)
+            data /= dtype(high_exp - low_exp)
+            data.clip(0, 1, out=data)
+            normalized[j, low, high] = data
+        if (j, low, high, gamma) not in gamma_scaled:
+            gamma_scaled[j, low, high, gamma] = normalized[j, low, high] ** (1 / np.float64(gamma)).astype(dtype)
+        return gamma_scaled[j, low, high, gamma]
+
+    variants = list(variants)
+    for variant in variants:
+        unknown = set(variant) - set(sweep_parameters)
+        if unknown:
+            raise ValueError('Unknown sweep parameters: %s' % ', '.join(sorted(unknown)))
+    # Channel parameters (j, low, high, gamma) of each variant, and the last batch using each shared channel
+    channel_keys = []
+    last_batch = {}
+    for number, variant in enumerate(variants):
+        rgblow = variant['rgblow'] if 'rgblow' in variant else percentile(variant['percentiles_low'])
+        rgbhigh = variant['rgbhigh'] if 'rgbhigh' in variant else percentile(variant['percentiles_high'])
+        rgblow = np.broadcast_to(np.asarray(rgblow, dtype=np.float64), 3)
+        rgbhigh = np.broadcast_to(np.asarray(rgbhigh, dtype=np.float64), 3)
+        keys = [(j, float(rgblow[j]), float(rgbhigh[j]), float(variant['gamma_rgb'][j])) for j in range(3)]
+        channel_keys.append(keys)
+        for key in keys:
+            last_batch[key] = last_batch[key[:3]] = number // batch_size
+    has_lab = any(variant.get('lab') is not None for variant in variants)
+    rgb_images = []
+    lab_images = [] if has_lab else None
+    for start in range(0, len(variants), batch_size):
+        batch = variants[start:start + batch_size]
+        channels = [[], [], []]
+        for keys in channel_keys[start:start + batch_size]:
+            for j, key in enumerate(keys):
+                channels[j].append(channel(*key))
+        # Release the channels that the next batches do not use
+        for cache in (normalized, gamma_scaled):
+            for key in [key for key in cache if last_batch[key] <= start // batch_size]:
+                del cache[key]
+        red, green, blue = [np.stack(images) for images in channels]
+        del channels
+        # Mixing coefficients of each image of the batch, broadcast over the pixels. No mixing is the identity.
+        mix = np.array([np.eye(3) if variant.get('rgbmix') is None else variant['rgbmix'] for variant in batch],
+                       dtype=dtype).reshape(len(batch), 3, 3, 1, 1)
+        rgb_stack = np.stack([mix[:, i, 0] * red + mix[:, i, 1] * green + mix[:, i, 2] * blue for i in range(3)],
+                             axis=-1).astype(np.float32, copy=False)
+        del red, green, blue
+        rgb_stack.clip(0, 1, out=rgb_stack)
+        rgb_stack *= 255
+        scalemin = np.array([variant.get('scalemin', 0) for variant in batch], dtype=np.float64).reshape(-1, 1, 1, 1)
+        rgb_stack = (rgb_stack - scalemin.astype(np.float32)) * 255 / (255 - scalemin).astype(np.float32)
+        rgb_stack.clip(0, 255, out=rgb_stack)
+        # OpenCV orders channels as B,G,R instead of R,G,B, and flip upside down.
+        bgr_stack = rgb_stack[:, ::-1, :, ::-1]
+        bgr8 = np.clip(bgr_stack, 0, 255).astype(np.uint8)
+        rgb_images.append(bgr8)
+        if has_lab:
+            lab_images.append(_sweep_lab(bgr_stack, bgr8, batch))
+    rgb_images = np.concatenate(rgb_images)
+    if has_lab:
+        lab_images = np.concatenate(lab_images)
+    return rgb_images, lab_images
+
+
+def _sweep_lab(bgr_stack, bgr8, batch):
+    """ CIELab stage of process_rgb_image on a batch of images of render_sweep, in a single color conversion. """
+    nimages, rows, cols = bgr_stack.shape[0:3]
+    # Normalized by the minimum and maximum of each image, as in process_lab_32bit
+    bgr_min = bgr_stack.min(axis=(1, 2, 3), keepdims=True)
+    bgr_max = bgr_stack.max(axis=(1, 2, 3), keepdims=True)
+    bgr2 = (bgr_stack - bgr_min) * 1 / (bgr_max - bgr_min)
+    # Images stacked vertically are converted at once
+    lab = cv2.cvtColor(bgr2.reshape(nimages * rows, cols, 3), cv2.COLOR_BGR2Lab).reshape(bgr_stack.shape)
+    L, a, b = [lab[..., i] for i in range(3)]
+    L *= 255/100
+    a += 128
+    b += 128
+    lab_values = [variant.get('lab') or (1, 1, 1) for variant in batch]
+    lf, af, bf = [np.array([values[i] for values in lab_values], dtype=np.float32).reshape(-1, 1, 1) for i in range(3)]
+    lmin = np.array([variant.get('lmin', 0) for variant in batch], dtype=np.float64).reshape(-1, 1, 1)
+    L = (L - lmin.astype(np.float32)) * lf * 255 / (255 - lmin).astype(np.float32)
+    a *= af
+    b *= bf
+    lab = np.stack([L, a, b], axis=-1)
+    lab.clip(0, 255, out=lab)
+    lab8 = cv2.cvtColor(lab.astype(np.uint8).reshape(nimages * rows, cols, 3), cv2.COLOR_Lab2BGR)
+    lab8 = lab8.reshape(bgr_stack.shape)
+    # Images without lab keep their rgb image
+    for k, variant in enumerate(batch):
+        if variant.get('lab') is None:
+            lab8[k] = bgr8[k]
+    return lab8
+
+
+def contact_sheet(images, columns=None, labels=None, spacing=4):
+    """
+    Tile images in a grid, e.g. the images of a parameter sweep.
+
+    :param images: 8-bit bgr images of the same shape [images, height, width, 3]
+    :param columns: number of columns. Default makes a square grid.
+    :param labels: optional text written in the top-left corner of each image. Default is the image number.
+    :param spacing: number of black pixels between images
+    :return: 8-bit bgr image of the grid
+    """
+    nimages, rows, cols = images.shape[0:3]
+    if columns is None:
+        columns = math.ceil(math.sqrt(nimages))
+    if labels is None:
+        labels = [str(k) for k in range(nimages)]
+    grid_rows = math.ceil(nimages / columns)
+    sheet = np.zeros((grid_rows * (rows + spacing) - spacing, columns * (cols + spacing) - spacing, 3), dtype=np.uint8)
+    font_scale = max(rows / 512, 0.4)
+    for k, image in enumerate(images):
+        y, x = (k // columns) * (rows + spacing), (k % columns) * (cols + spacing)
+        sheet[y:y + rows, x:x + cols] = image
+        if labels[k]:
+            cv2.putText(sheet, labels[k], (x + 4, y + int(24 * font_scale) + 4), cv2.FONT_HERSHEY_SIMPLEX, font_scale,
+                        (255, 255, 255), max(int(2 * font_scale), 1), cv2.LINE_AA)
+    return sheet
+
+
+class ColorLUT:
+    """ 3D color lookup table of the color path of process_rgb_image.
+    For a given set of parameters, the gamma scaling, rgb mixing, contrast stretching and CIELab color balance map the
+    three normalized channel intensities to fixed 8-bit bgr colors. This mapping is tabulated once on a lattice of
+    size^3 colors, uniform in gamma-scaled intensities, and applied to each image by trilinear interpolation, without
+    any full-frame floating point intermediate.
+
+    The normalized intensities are first quantized to 16 bits and converted to lattice coordinates by a 1D shaper
+    table per channel, which replaces the per-pixel power of the gamma scaling. The lattice is stored as a 2D image of
+    size rows (red) and size*size columns (blue, green), so that the interpolation runs as two bilinear cv2.remap
+    lookups in the blue slices around each pixel and a per-pixel blend between them.
+
+    process_lab_32bit normalizes each image by its own minimum and maximum before the CIELab conversion. The table
+    assumes these are 0 and 255, which holds for full-disk AIA images where the dark background is clipped to 0 by
+    scalemin and the brightest regions saturate at rgbhigh. Very dark pixels, within a few 16-bit quantization steps of
+    rgblow, are less accurate when scalemin is 0.
+    """
+
+    shaper_levels = 2 ** 16
+
+    def __init__(self, gamma_rgb=(2.8, 2.8, 2.4), rgbmix=None, scalemin=0, lab=None, lmin=0, size=64):
+        """
+        :param gamma_rgb: see scale_rgb
+        :param rgbmix: see scale_rgb
+        :param scalemin: see scale_rgb
+        :param lab: CIELab parameters (lf, af, bf) of process_lab_32bit, or None for the rgb images only
+        :param lmin: see process_lab_32bit
+        :param size: number of lattice points along each axis
+        """
+        self.size = size
+        self.lab = lab
+        n = size
+
+        # Shapers: 16-bit normalized intensity -> lattice coordinate, per channel
+        x = np.arange(self.shaper_levels, dtype=np.float64) / (self.shaper_levels - 1)
+        coords = [x ** (1 / gamma) * (n - 1) for gamma in gamma_rgb]
+        self.red_coord = coords[0].astype(np.float32)
+        self.green_coord = coords[1].astype(np.float32)
+        # Blue lattice slice below the coordinate, as a column offset, and interpolation weight of the slice above
+        blue_floor = np.minimum(np.floor(coords[2]), n - 2)
+        self.blue_offset = (blue_floor * n).astype(np.float32)
+        self.blue_weight = (coords[2] - blue_floor).astype(np.float32)
+
+        # Colors of the lattice, from the gamma-scaled intensities on, as in scale_rgb and process_rgb_image
+        u = np.linspace(0, 1, n, dtype=np.float32)
+        red, green, blue = np.meshgrid(u, u, u, indexing='ij')
+        if rgbmix is not None:
+            [[rr, rg, rb], [gr, gg, gb], [br, bg, bb]] = np.asarray(rgbmix, dtype=np.float32)
+            rgb_stack = np.stack((rr*red + rg*green + rb*blue, gr*red + gg*green + gb*blue,
+                                  br*red + bg*green + bb*blue), axis=-1)
+        else:
+            rgb_stack = np.stack((red, green, blue), axis=-1)
+        rgb_stack.clip(0, 1, out=rgb_stack)
+        rgb_stack *= 255
+        rgb_stack = (rgb_stack - scalemin) * 255 / (255 - scalemin)
+        rgb_stack.clip(0, 255, out=rgb_stack)
+        bgr = np.ascontiguousarray(rgb_stack[..., ::-1], dtype=np.float32)
+        outputs = [bgr]
+        if lab is not None:
+            lab32 = process_lab_32bit(bgr.reshape(n * n, n, 3), lf=lab[0], af=lab[1], bf=lab[2], lmin=lmin,
+                                      value_range=(0, 255))
+            bgr_lab = cv2.cvtColor(lab32.astype(np.uint8), cv2.COLOR_Lab2BGR)
+            outputs.append(bgr_lab.reshape(n, n, n, 3).astype(np.float32))
+        table = np.concatenate(outputs, axis=-1)
+        # [red, green, blue, channels] -> 2D image [red, blue * size + green, channels]
+        self.table = np.ascontiguousarray(table.transpose(0, 2, 1, 3).reshape(n, n * n, table.shape[-1]))
+
+    def apply(self, rgb, rgblow, rgbhigh, exptime=None, strip_rows=256):
+        """
+        Map calibrated images to 8-bit bgr images, in the orientation of the images of process_rgb_image.
+
+        :param rgb: list of the red, green and blue calibrated images
+        :param rgblow: see scale_rgb
+        :param rgbhigh: see scale_rgb
+        :param exptime: see scale_rgb
+        :param strip_rows: number of image rows processed at once, bounding the size of the intermediate arrays
+        :return: bgr image of the rgb path, and bgr image of the CIELab path or None if lab is not set
+        """
+        rgblow = np.broadcast_to(np.asarray(rgblow, dtype=np.float64), 3)
+        rgbhigh = np.broadcast_to(np.asarray(rgbhigh, dtype=np.float64), 3)
+        if exptime is not None:
+            rgblow = rgblow * np.asarray(exptime)
+            rgbhigh = rgbhigh * np.asarray(exptime)
+        scales = (self.shaper_levels - 1) / (rgbhigh - rgblow)
+        # Images are flipped upside down, as in process_rgb_image
+        channels = [np.flipud(channel) for channel in rgb]
+        rows, cols = channels[0].shape
+        bgr8 = np.empty((rows, cols, 3), dtype=np.uint8)
+        bgr8_lab = np.empty((rows, cols, 3), dtype=np.uint8) if self.lab is not None else None
+
+        for y0 in range(0, rows, strip_rows):
+            y1 = min(y0 + strip_rows, rows)
+            quantized = []
+            for j in range(3):
+                x = np.subtract(channels[j][y0:y1], np.float32(rgblow[j]), dtype=np.float32)
+                x *= np.float32(scales[j])
+                x += np.float32(0.5)
+                x.clip(0, self.shaper_levels - 1, out=x)
+                quantized.append(x.astype(np.uint16))
+            map_y = self.red_coord.take(quantized[0])
+            map_x = self.blue_offset.take(quantized[2])
+            map_x += self.green_coord.take(quantized[1])
+            weight = self.blue_weight.take(quantized[2])
+            below = cv2.remap(self.table, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            map_x += np.float32(self.size)
+            above = cv2.remap(self.table, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            colors = cv2.blendLinear(below, above, 1 - weight, weight)
+            # Truncated as the rgb path of process_rgb_image. The CIELab colors are already 8-bit: rounded.
+            np.copyto(bgr8[y0:y1], colors[..., 0:3], casting='unsafe')
+            if bgr8_lab is not None:
+                colors[..., 3:6] += np.float32(0.5)
+                np.copyto(bgr8_lab[y0:y1], colors[..., 3:6], casting='unsafe')
+        return bgr8, bgr8_lab
+
+
+@functools.lru_cache(maxsize=8)
+def get_color_lut(gamma_rgb, rgbmix, scalemin, lab, lmin, size=64):
+    """
+    Get the ColorLUT of a set of parameters, built once per process and parameter set.
+    All parameters must be hashable: sequences are given as tuples.
+
+    :return: ColorLUT instance
+    """
+    return ColorLUT(gamma_rgb=gamma_rgb, rgbmix=rgbmix, scalemin=scalemin, lab=lab, lmin=lmin, size=size)
+
+
+def process_lab_32bit(bgr, lf=1, af=1, bf=1, lmin=0, value_range=None):
     """
     Process the color balancing in CIELab space. Due to the format needed by the library used (openCV), the order of the
     channels must be ordered as blue, green, red (red and blue swapped).
@@ -218,10 +1454,12 @@ def process_lab_32bit(bgr, lf=1, af=1, bf=1, lmin=0):
     :param af: green-red axis modifier (>0).
     :param bf: blue-yellow axis modifier (>0).
     :param lmin: Minimum value for the contrast stretching in the luminance dimension. Luminance range = [0-255]
+    :param value_range: (min, max) of the bgr values mapped to [0-1]. Default is the minimum and maximum of the image.
     :return: Numpy array of the rescaled "bgr" image. For visualization in Matplotlib, must swap again blue <-> red
     """
     # 32 bits needs to be scaled withi [0-1]
-    bgr2 = (bgr - bgr.min()) * 1 / (bgr.max() - bgr.min())
+    bgr_min, bgr_max = (bgr.min(), bgr.max()) if value_range is None else value_range
+    bgr2 = (bgr - bgr_min) * 1 / (bgr_max - bgr_min)
     lab = cv2.cvtColor(bgr2, cv2.COLOR_BGR2Lab)
     L, a, b = [lab[:, :, i] for i in range(3)]
     # In 32 bits, L ranges within [0 - 100]. In 8 bit: [0 255]
@@ -239,7 +1477,30 @@ def process_lab_32bit(bgr, lf=1, af=1, bf=1, lmin=0):
     return lab
 
 
-def process_rgb_image(i, data_files, rgblow, rgbhigh, calibrate=True, gamma_rgb=(2.8, 2.8, 2.4), scalemin=0, rgbmix=None, lab=None, lmin=0, crop=None, filename_rgb=None, filename_lab=None):
+def downscale_crop(crop, downscale):
+    """
+    :param crop: tuple of slices of (x,y) zero-based coordinates in the full resolution images
+    :param downscale: integer downscaling factor
+    :return: tuple of slices of the same window in the downscaled images
+    """
+    return tuple(slice(None if s.start is None else s.start // downscale,
+                       None if s.stop is None else -(-s.stop // downscale)) for s in crop)
+
+
+def lab_to_bgr(lab32):
+    """
+    Floating-point conversion of a CIELab image of process_lab_32bit to bgr, e.g. for 16-bit output images.
+
+    :param lab32: CIELab image with the 3 channels scaled to the [0-255] range of 8-bit CIELab images in openCV
+    :return: bgr image in the [0-255] range
+    """
+    lab = np.empty(lab32.shape, dtype=np.float32)
+    lab[..., 0] = lab32[..., 0] * (100 / 255)
+    lab[..., 1:] = lab32[..., 1:] - 128
+    return cv2.cvtColor(lab, cv2.COLOR_Lab2BGR) * 255
+
+
+def process_rgb_image(i, data_files, rgblow, rgbhigh, calibrate=True, gamma_rgb=(2.8, 2.8, 2.4), scalemin=0, rgbmix=None, lab=None, lmin=0, crop=None, filename_rgb=None, filename_lab=None, precision='float32', cropsize=calibration.aia_image_size, crop_center=None, reuse_buffers=False, frame_cache=None, timings=None, nthreads=1, tile_writer=None, color_lut=False, strip_rows=None, frame_writer=None, downscale=1):
     """
     Create an rgb image out of three fits files at different wavelengths, conveniently scaled for visualization.
 
@@ -256,79 +1517,193 @@ def process_rgb_image(i, data_files, rgblow, rgbhigh, calibrate=True, gamma_rgb=
     :param crop: tuple of slices of (x,y) zero-based coordinates for cropping. E.g (slice(100,1300), slice(0,1000))
     :param filename_rgb: basename for the jpeg images if lab space unused, appended with the image number
     :param filename_lab: basename for lab-space-modified images, appended with the image number.
+    :param precision: working precision, one of calibration.precision_modes. In 'raw' mode, the exposure time
+    normalization of calibrated data is folded into rgblow and rgbhigh. Uncalibrated data are assumed normalized.
+    :param cropsize: size of the calibrated output grid, integer or (width, height). See calibration.aiaprep.
+    :param crop_center: (x, y) center of the calibrated output grid in the full-size image. See calibration.aiaprep.
+    :param reuse_buffers: set to True to tone-map in the preallocated buffers of the process ToneMapper.
+    The returned arrays are then overwritten by the next call in the same process.
+    :param frame_cache: frame_cache.FrameCache instance to read the calibrated images from, or to store them in.
+    :param timings: optional dictionary where the wall time of the 'read', 'prep', 'tonemap' and 'write' stages
+    are added, in seconds.
+    :param nthreads: number of threads to read and calibrate the 3 channels concurrently. Default is sequential.
+    :param tile_writer: optional TilePyramidWriter, to write the output image as a tile pyramid. The lab image is used
+    if lab is set, the rgb image otherwise.
+    :param color_lut: set to True to apply the gamma scaling, rgb mixing, contrast stretching and CIELab color balance
+    through a ColorLUT, cached per set of parameters. This assumes that the contrast-stretched image spans [0-255].
+    :param strip_rows: optional number of rows of the strips in which the tone-mapping and CIELab stages are done,
+    to bound their memory. Same output as the full-frame path. See StripToneMapper.
+    :param frame_writer: optional writers.FrameWriter of filename_rgb and filename_lab images, e.g. to write them in
+    background threads or in another format. Default writes jpeg images at quality 95. With a background writer,
+    call its flush() method before reading the images. 16-bit formats get the floating-point images before their
+    conversion to 8 bits, except with color_lut or strip_rows.
+    :param downscale: integer factor by which the images are downscaled during the calibration, with area averaging,
+    for fast previews. The scaling values and crop are those of the full resolution images.
     :return: rgb image as a 3-channel numpy array: [image rows, image cols, 3]
     """
 
+    if downscale > 1 and crop is not None:
+        crop = downscale_crop(crop, downscale)
     bgr_stack2 = None
+    # Floating-point bgr and CIELab images of the full-frame path, before their conversion to 8 bits
+    bgr_stack = None
+    lab32 = None
+    exptime = None
+    instrumentation.set_frame(i)
+    start = time.perf_counter()
 
     # Prep aia data and export the r,g,b arrays into a list of numpy arrays.
+    # The 3 channels are optionally processed concurrently: fits reading, decompression and warping release the GIL.
+    channel_map = map if nthreads <= 1 else get_channel_executor(nthreads).map
+    files = [data_files[j][i] for j in range(3)]
     if calibrate:
-        pdatargb = [calibration.aiaprep(data_files[j][i]) for j in range(3)]
+        if frame_cache is not None:
+            # Read calibrated data from the cache. This is recorded as the read stage.
+            pdatargb, headers = zip(*channel_map(
+                lambda fitsfile: frame_cache.aiaprep(fitsfile, cropsize=cropsize, precision=precision,
+                                                     return_header=True, crop_center=crop_center,
+                                                     downscale=downscale), files))
+            start = record_stage(timings, 'read', start)
+        else:
+            raw_data = list(channel_map(lambda fitsfile: calibration.read_aia(fitsfile, precision=precision), files))
+            start = record_stage(timings, 'read', start)
+            headers = [header for _, header in raw_data]
+            pdatargb = list(channel_map(
+                lambda raw: calibration.prep_aia(raw[0], raw[1], cropsize=cropsize, crop_center=crop_center,
+                                                 downscale=downscale),
+                raw_data))
+            del raw_data
+            start = record_stage(timings, 'prep', start)
+        if precision == 'raw':
+            exptime = [header['EXPTIME'] for header in headers]
     else:
-        pdatargb = [load_fits(data_files[j][i]) for j in range(3)]
+        pdatargb = list(channel_map(lambda fitsfile: load_fits(fitsfile, precision=precision), files))
+        if downscale > 1:
+            pdatargb = [calibration.downscale_image(data, downscale) for data in pdatargb]
+        start = record_stage(timings, 'read', start)
+
+    if color_lut:
+        # Whole color path through the 3D lookup table of the parameters
+        with instrumentation.stage('color_lut'):
+            lut = get_color_lut(tuple(float(gamma) for gamma in gamma_rgb),
+                                None if rgbmix is None else tuple(map(tuple, np.asarray(rgbmix, dtype=float).tolist())),
+                                scalemin, None if lab is None else tuple(lab), lmin)
+            bgr_stack1, bgr_stack2 = lut.apply(pdatargb, rgblow, rgbhigh, exptime=exptime)
+        if crop is not None:
+            bgr_stack1 = bgr_stack1[crop[::-1]]
+            if bgr_stack2 is not None:
+                bgr_stack2 = bgr_stack2[crop[::-1]]
+    elif strip_rows is not None:
+        with instrumentation.stage('strips'):
+            strip_tone_mapper = get_strip_tone_mapper(pdatargb[0].shape[1], precision=precision, strip_rows=strip_rows)
+            bgr_stack1, bgr_stack2 = strip_tone_mapper.tone_map(pdatargb, rgblow, rgbhigh, gamma_rgb=gamma_rgb,
+                                                                rgbmix=rgbmix, scalemin=scalemin, exptime=exptime,
+                                                                lab=lab, lmin=lmin)
+        if crop is not None:
+            bgr_stack1 = bgr_stack1[crop[::-1]]
+            if bgr_stack2 is not None:
+                bgr_stack2 = bgr_stack2[crop[::-1]]
+    else:
+        # Apply hdr tone-mapping
+        with instrumentation.stage('scale_rgb'):
+            if reuse_buffers:
+                tone_mapper = get_tone_mapper(pdatargb[0].shape, precision=precision)
+                tone_mapper.scale_rgb(pdatargb, rgblow, rgbhigh, gamma_rgb=gamma_rgb, scalemin=scalemin, rgbmix=rgbmix,
+                                      exptime=exptime)
+                bgr_stack = tone_mapper.bgr_stack()
+                bgr_stack1 = tone_mapper.to_bgr8()
+            else:
+                tone_mapper = None
+                im_rgb255 = scale_rgb(pdatargb, rgblow, rgbhigh, gamma_rgb=gamma_rgb, scalemin=scalemin, rgbmix=rgbmix,
+                                      precision=precision, exptime=exptime)
+
+                # OpenCV orders channels as B,G,R instead of R,G,B, and flip upside down.
+                bgr_stack = np.flipud(np.flip(im_rgb255, axis=2))
+
+                bgr_stack1 = np.clip(bgr_stack, 0, 255)
+                bgr_stack1 = bgr_stack1.astype(np.uint8)
+            if crop is not None:
+                bgr_stack1 = bgr_stack1[crop[::-1]]
+
+        if lab is not None:
+            with instrumentation.stage('lab'):
+                lab32 = process_lab_32bit(bgr_stack, lf=lab[0], af=lab[1], bf=lab[2], lmin=lmin)
+                if tone_mapper is not None:
+                    bgr_stack2 = tone_mapper.lab_to_bgr8(lab32)
+                else:
+                    bgr_stack2 = cv2.cvtColor(lab32.astype(np.uint8), cv2.COLOR_Lab2BGR)
+                if crop is not None:
+                    bgr_stack2 = bgr_stack2[crop[::-1]]
+    start = record_stage(timings, 'tonemap', start)
+
+    writer = frame_writer if frame_writer is not None else default_frame_writer
+    if filename_rgb is not None:
+        frame = bgr_stack1
+        if writer.bit_depth == 16 and bgr_stack is not None:
+            frame = bgr_stack if crop is None else bgr_stack[crop[::-1]]
+        writer.write(filename_rgb, i, frame)
+
+    if lab is not None and filename_lab is not None:
+        frame = bgr_stack2
+        if writer.bit_depth == 16 and lab32 is not None:
+            frame = lab_to_bgr(lab32)
+            if crop is not None:
+                frame = frame[crop[::-1]]
+        writer.write(filename_lab, i, frame)
+
+    if tile_writer is not None:
+        with instrumentation.stage('tiles') as stage:
+            stage.add(bytes_written=tile_writer.write(bgr_stack1 if bgr_stack2 is None else bgr_stack2, i))
+    record_stage(timings, 'write', start)
 
-    # Apply hdr tone-mapping
-    im_rgb255 = scale_rgb(pdatargb, rgblow, rgbhigh, gamma_rgb=gamma_rgb, scalemin=scalemin, rgbmix=rgbmix)
+    return bgr_stack1, bgr_stack2
 
-    # OpenCV orders channels as B,G,R instead of R,G,B, and flip upside down.
-    bgr_stack = np.flipud(np.flip(im_rgb255, axis=2))
 
-    bgr_stack1 = np.clip(bgr_stack, 0, 255)
-    bgr_stack1 = bgr_stack1.astype(np.uint8)
-    if crop is not None:
-        bgr_stack1 = bgr_stack1[crop[::-1]]
+# Thread pool of the current process for the concurrent processing of the channels, and its number of threads
+_channel_executor = None
+_channel_threads = 0
 
-    if filename_rgb is not None:
-        outputfile_rgb = filename_rgb + '_%04d.jpeg'%i
-        cv2.imwrite(outputfile_rgb, bgr_stack1, [int(cv2.IMWRITE_JPEG_QUALITY), 95])
 
-    if lab is not None:
-        lab32 = process_lab_32bit(bgr_stack, lf=lab[0], af=lab[1], bf=lab[2], lmin=lmin)
-        bgr_stack2 = cv2.cvtColor(lab32.astype(np.uint8), cv2.COLOR_Lab2BGR)
-        if crop is not None:
-            bgr_stack2 = bgr_stack2[crop[::-1]]
-        if filename_lab is not None:
-            outputfile_lab = filename_lab + '_%04d.jpeg'%i
-            cv2.imwrite(outputfile_lab, bgr_stack2, [int(cv2.IMWRITE_JPEG_QUALITY), 95])
+def get_channel_executor(nthreads):
+    """
+    Get the thread pool of the current process used to process the channels of an image concurrently.
+    The pool is replaced if the number of threads changes.
 
-    return bgr_stack1, bgr_stack2
+    :param nthreads: number of threads
+    :return: concurrent.futures.ThreadPoolExecutor
+    """
+    global _channel_executor, _channel_threads
+    if _channel_executor is None or _channel_threads != nthreads:
+        if _channel_executor is not None:
+            _channel_executor.shutdown()
+        _channel_executor = concurrent.futures.ThreadPoolExecutor(nthreads)
+        _channel_threads = nthreads
+    return _channel_executor
 
 
-def encode_video(images_dir, movie_filename, image_format='jpeg', fps=30, file_ext='.mp4', crop=None, frame_size=None, padded_size=None, image_pattern_search=None, command_only=False):
+def record_stage(timings, stage, start):
     """
-    Run ffmpeg to create a movie from jpeg images. Input images will be found based on the image directory and a pattern search.
-    If you're writing images with your own methods, use padded numbering: 001, 002, ..., 010 instead of 1,2,...10
-    or else you'll need to write your own parser for inputing the list of input image the right order for ffmpeg.
+    Add the wall time elapsed since start to a stage of the timings dictionary of process_rgb_image.
 
-
-    :param images_dir: path to directory where images will be searched based on a pattern search. (default is *.jpeg).
-    :param movie_filename: output file without extension (e.g: /path/to/my_movie and not /path/to/my_movie.mp4).
-    It can be an absolute path or a path relative to the images_dir.
-    :param fps: number of frames per second to display
-    :param file_ext: suffix defining the file format and appended to movie_filename. Default is '.mp4'.
-    :param crop: (width, height, x, y) crop the input images frop top left (x, y) coordinates over width and height pixels
-    :param frame_size: (width, height) without padding, actual video size. Default to image size.
-    With padding (see padded_size bellow), this will be the size of the image within the padded frame.
-    :param padded_size: (width, height) actual output video size with horizontal and vertical padding.
-    If used, the frame_size must be able to fit in the padded_size.
-    :param image_format: format of the input images. Default is jpeg.
-    :param image_pattern_search: pattern string to look for input images:
-    e.g. "my_images_aia_blah_*.jpeg" if using padded numbers. or "my_images_aia_blah_%d.jpeg" if not
-    Default is to use "*.image_format". E.g if image_format ='jpeg', will look for images in images_dir/*.jpeg
-    :param command_only: set to True if you only want to get the command line string that gets executed.
-    If you use this in the terminal, you need to add single or double quotes around the image name pattern
-    :return: Command-line string called by subprocess.
+    :param timings: dictionary of wall times in seconds per stage name, or None to not record anything.
+    :param stage: stage name
+    :param start: start time of the stage from time.perf_counter()
+    :return: current time, i.e. the start time of the next stage
     """
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + now - start
+    return now
 
-    video_filter = None
 
-    # Check valid file suffix
-    if not file_ext.startswith('.') and not movie_filename.endswith('.'):
-        file_ext = '.'+file_ext
-    filename = movie_filename + file_ext
+def get_video_filter(crop=None, frame_size=None, padded_size=None, image_size=None):
+    """
+    ffmpeg video filter for cropping, rescaling and padding the frames. See encode_video for the parameters.
 
-    if image_pattern_search is None:
-        image_pattern_search = "*.%s"%image_format
+    :param image_size: (width, height) of the input images. Only needed for padding if frame_size is None.
+    :return: video filter string
+    """
+    video_filter = None
 
     # cropping must be given in input coordinate frame.
     if crop is not None:
@@ -337,11 +1712,11 @@ def encode_video(images_dir, movie_filename, image_format='jpeg', fps=30, file_e
     # Only instruct ffmpeg to rescale if frame_size is explicitly given.
     if frame_size is not None:
         if video_filter is not None: # append comma first.
-            video_filter += ",scale=%d:%d" % frame_size
+            video_filter += ",scale=%d:%d" % tuple(frame_size)
         else:
-            video_filter = "scale=%d:%d" % frame_size
+            video_filter = "scale=%d:%d" % tuple(frame_size)
     else:
-        frame_size = cv2.imread(glob.glob(os.path.join(images_dir, '*.%s') % image_format)[0]).shape[0:2][::-1]
+        frame_size = image_size
 
     # Padding happens last before color adjustments
     if padded_size is not None:
@@ -352,25 +1727,108 @@ def encode_video(images_dir, movie_filename, image_format='jpeg', fps=30, file_e
         else:
             video_filter = "pad=%d:%d:%d:%d" % (*padded_size, x, y)
 
-
     # No matter what, we need at least to boost contrast to 1.1 because of codecs effect of washing out colors
     if video_filter is None:
         video_filter = 'eq=contrast=1.1'
     else:
         video_filter += ',eq=contrast=1.1'
 
+    return video_filter
+
+
+VideoRendition = collections.namedtuple('VideoRendition', [
+    'movie_filename', 'crop', 'frame_size', 'padded_size', 'fps', 'file_ext', 'codec', 'preset', 'crf', 'pix_fmt'],
+    defaults=(None, None, None, 30, '.mp4', 'libx264', 'slow', 18, 'yuv420p'))
+VideoRendition.__doc__ = """ Output movie of encode_video or VideoStream. movie_filename, file_ext, crop, frame_size and
+padded_size are as in encode_video. fps is the frame rate of the output file, codec, preset and crf the ffmpeg
+video codec settings and pix_fmt the output pixel format. """
+
+
+def movie_path(movie_filename, file_ext='.mp4'):
+    """ Movie file name with its file extension """
+    if not file_ext.startswith('.') and not movie_filename.endswith('.'):
+        file_ext = '.'+file_ext
+    return movie_filename + file_ext
+
+
+def get_video_outputs(renditions, image_size=None):
+    """
+    ffmpeg output arguments encoding the decoded input into each rendition. A single rendition is filtered with -vf.
+    Several renditions share one decode of the input, duplicated by the split filter of a filter graph.
+
+    :param renditions: sequence of VideoRendition
+    :param image_size: (width, height) of the input images. Only needed for padding if a frame_size is None.
+    :return: list of command-line arguments
+    """
+    video_filters = [get_video_filter(crop=r.crop, frame_size=r.frame_size, padded_size=r.padded_size,
+                                      image_size=image_size) for r in renditions]
+    arguments = []
+    if len(renditions) > 1:
+        graph = '[0:v]split=%d%s' % (len(renditions), ''.join('[s%d]' % k for k in range(len(renditions))))
+        graph += ''.join(';[s%d]%s[v%d]' % (k, video_filter, k) for k, video_filter in enumerate(video_filters))
+        arguments += ["-filter_complex", graph]
+    for k, (rendition, video_filter) in enumerate(zip(renditions, video_filters)):
+        if len(renditions) > 1:
+            arguments += ["-map", "[v%d]" % k]
+        arguments += ["-c:v", rendition.codec,
+                      "-preset", rendition.preset,
+                      "-crf", "%d" % rendition.crf,
+                      "-r", "%d" % rendition.fps]
+        if len(renditions) == 1:
+            arguments += ["-vf", video_filter]
+        arguments += ["-pix_fmt", rendition.pix_fmt,
+                      movie_path(rendition.movie_filename, rendition.file_ext)]
+    return arguments
+
+
+def encode_video(images_dir, movie_filename=None, image_format='jpeg', fps=30, file_ext='.mp4', crop=None, frame_size=None, padded_size=None, image_pattern_search=None, command_only=False, renditions=None, check=False):
+    """
+    Run ffmpeg to create a movie from jpeg images. Input images will be found based on the image directory and a pattern search.
+    If you're writing images with your own methods, use padded numbering: 001, 002, ..., 010 instead of 1,2,...10
+    or else you'll need to write your own parser for inputing the list of input image the right order for ffmpeg.
+    Several movies, e.g. at different resolutions or fields of view, can be encoded at once from a single read and
+    decode of the images by giving a list of renditions.
+
+
+    :param images_dir: path to directory where images will be searched based on a pattern search. (default is *.jpeg).
+    :param movie_filename: output file without extension (e.g: /path/to/my_movie and not /path/to/my_movie.mp4).
+    It can be an absolute path or a path relative to the images_dir.
+    :param fps: number of frames per second to display
+    :param file_ext: suffix defining the file format and appended to movie_filename. Default is '.mp4'.
+    :param crop: (width, height, x, y) crop the input images frop top left (x, y) coordinates over width and height pixels
+    :param frame_size: (width, height) without padding, actual video size. Default to image size.
+    With padding (see padded_size bellow), this will be the size of the image within the padded frame.
+    :param padded_size: (width, height) actual output video size with horizontal and vertical padding.
+    If used, the frame_size must be able to fit in the padded_size.
+    :param image_format: format of the input images. Default is jpeg.
+    :param image_pattern_search: pattern string to look for input images:
+    e.g. "my_images_aia_blah_*.jpeg" if using padded numbers. or "my_images_aia_blah_%d.jpeg" if not
+    Default is to use "*.image_format". E.g if image_format ='jpeg', will look for images in images_dir/*.jpeg
+    :param command_only: set to True if you only want to get the command line string that gets executed.
+    If you use this in the terminal, you need to add single or double quotes around the image name pattern
+    :param renditions: optional sequence of VideoRendition, encoded in one pass instead of the single movie given by
+    movie_filename, file_ext, crop, frame_size and padded_size.
+    :param check: set to True to raise subprocess.CalledProcessError if ffmpeg fails, instead of only printing it.
+    :return: Command-line string called by subprocess.
+    """
+
+    if renditions is None:
+        if movie_filename is None:
+            raise ValueError('Either movie_filename or renditions must be given')
+        renditions = [VideoRendition(movie_filename, crop=crop, frame_size=frame_size, padded_size=padded_size,
+                                     file_ext=file_ext)]
+
+    if image_pattern_search is None:
+        image_pattern_search = "*.%s"%image_format
+
+    image_size = None
+    if any(r.frame_size is None and r.padded_size is not None for r in renditions):
+        image_size = cv2.imread(glob.glob(os.path.join(images_dir, '*.%s') % image_format)[0]).shape[0:2][::-1]
+
     command = ["ffmpeg",
                "-framerate", "%d" % fps,
                "-pattern_type", "glob",
-               "-i", image_pattern_search,
-               "-c:v", "libx264",
-               "-preset", "slow",
-               "-crf", "18",
-               "-r", "30",
-               "-vf", video_filter,
-               "-pix_fmt", "yuv420p",
-               filename,
-               "-y"]
+               "-i", image_pattern_search] + get_video_outputs(renditions, image_size=image_size) + ["-y"]
     # Working example:
     # ffmpeg -framerate 30 -pattern_type glob -i 'im_rgb_*.jpeg' -c:v libx264 -preset slow -crf 18 -r 30 -vf crop=3840:2160:128:1935,scale=1920:1080 -pix_fmt yuv420p rgb_movie_3840x2160_1920x1080.mp4 -y
     if command_only:
@@ -378,32 +1836,148 @@ def encode_video(images_dir, movie_filename, image_format='jpeg', fps=30, file_e
 
     try:
         _ = subprocess.check_call(command, cwd=images_dir)
-        print('Movie file written at: %s'%filename)
+        for rendition in renditions:
+            print('Movie file written at: %s' % movie_path(rendition.movie_filename, rendition.file_ext))
     except subprocess.CalledProcessError:
         print('Movie creation failed')
+        if check:
+            raise
 
     return subprocess.list2cmdline(command)
 
 
-def load_fits(fitsfile):
+class VideoStream:
+    """ Encode a movie by piping raw bgr frames to ffmpeg over stdin, instead of writing and reading back images.
+    ffmpeg is started when the first frame is written, as the input size is taken from that frame.
+    See encode_video for the encoding parameters. Several renditions can be encoded from the same stream.
+    """
+
+    def __init__(self, movie_filename=None, fps=30, file_ext='.mp4', crop=None, frame_size=None, padded_size=None,
+                 renditions=None):
+        if renditions is None:
+            if movie_filename is None:
+                raise ValueError('Either movie_filename or renditions must be given')
+            renditions = [VideoRendition(movie_filename, crop=crop, frame_size=frame_size, padded_size=padded_size,
+                                         file_ext=file_ext)]
+        self.renditions = list(renditions)
+        self.filename = movie_path(self.renditions[0].movie_filename, self.renditions[0].file_ext)
+        self.fps = fps
+        self.input_size = None
+        self.process = None
+
+    def command(self, input_size):
+        """
+        ffmpeg command for a given input size
+
+        :param input_size: (width, height) of the input frames
+        :return: list of command-line arguments
+        """
+        return ["ffmpeg",
+                "-f", "rawvideo",
+                "-pix_fmt", "bgr24",
+                "-s", "%dx%d" % tuple(input_size),
+                "-framerate", "%d" % self.fps,
+                "-i", "-"] + get_video_outputs(self.renditions, image_size=input_size) + ["-y"]
+
+    def write(self, frame):
+        """
+        Write a frame to ffmpeg.
+
+        :param frame: 8-bit bgr image as numpy array [height, width, 3]
+        """
+        input_size = frame.shape[0:2][::-1]
+        if self.process is None:
+            self.input_size = input_size
+            self.process = subprocess.Popen(self.command(input_size), stdin=subprocess.PIPE)
+        elif input_size != self.input_size:
+            raise ValueError('frame size %s differs from the movie input size %s' % (input_size, self.input_size))
+        self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+
+    def close(self):
+        """ Close the input of ffmpeg and wait for the end of the encoding. """
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        if self.process.wait() == 0:
+            for rendition in self.renditions:
+                print('Movie file written at: %s' % movie_path(rendition.movie_filename, rendition.file_ext))
+        else:
+            print('Movie creation failed')
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class OrderedFrameSink:
+    """ Write frames received in any order to streams in a given order.
+    Frames arriving ahead of their turn are buffered until all the previous frames are written.
+    """
+
+    def __init__(self, indices, streams):
+        """
+        :param indices: sequence of the image indices in the order they must be written
+        :param streams: sequence of objects with a write(frame) method, e.g. VideoStream
+        """
+        self.indices = list(indices)
+        self.streams = streams
+        self.position = 0
+        self.pending = {}
+
+    def put(self, index, frame):
+        """
+        Receive a frame, and write it along with any buffered frames that follow it.
+        Buffered frames are copied, as they may be views into buffers reused by the producer.
+
+        :param index: image index of the frame
+        :param frame: 8-bit bgr image
+        """
+        if self.position >= len(self.indices) or index != self.indices[self.position]:
+            self.pending[index] = frame.copy()
+            return
+        self._write(frame)
+        while self.position < len(self.indices) and self.indices[self.position] in self.pending:
+            self._write(self.pending.pop(self.indices[self.position]))
+
+    def _write(self, frame):
+        for stream in self.streams:
+            stream.write(frame)
+        self.position += 1
+
+    def close(self):
+        """ Close all streams. Raises an error if frames are missing. """
+        for stream in self.streams:
+            stream.close()
+        if self.position < len(self.indices):
+            raise RuntimeError('%d frames were not written' % (len(self.indices) - self.position))
+
+
+def load_fits(fitsfile, precision='float32'):
     """
     This is only used if working with aia fits files already calibrated. Because the headers aren't needed in this case,
     this just loads the data from the HDU. This tests first if the fits file at hand is single-hdu (primary-only) or
     primary hdu with an image extension.
 
-    :param fitsfile: path to fits file
+    :param fitsfile: path to fits file. Read from memory if prefetched, see prefetch.py
+    :param precision: one of calibration.precision_modes. 'raw' keeps the data type of the file.
     :return:
     """
     try:
-        hdul = fits.open(fitsfile)
+        hdul = fits.open(prefetch.fits_source(fitsfile))
     except FileNotFoundError:
         print("Could not open fits file")
     else:
-        if len(hdul) == 1:
-            data = hdul[0].data.astype(np.float64)
-        else:
-            hdul[1].verify('silentfix')
-            data = hdul[1].data.astype(np.float64)
+        with instrumentation.stage('read_fits') as stage:
+            if len(hdul) == 1:
+                data = calibration.cast_data(hdul[0].data, precision)
+            else:
+                hdul[1].verify('silentfix')
+                data = calibration.cast_data(hdul[1].data, precision)
+            if instrumentation.enabled:
+                stage.add(bytes_read=os.path.getsize(fitsfile))
 
         hdul.close()
         return data
\ No newline at end of file
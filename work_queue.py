@@ -0,0 +1,249 @@
+"""
+File-based work queue to share a rendering job between several processes or hosts, through a shared filesystem only.
+
+Each image index is claimed by creating its lease file exclusively (O_CREAT | O_EXCL), which only one process can
+succeed at, even over NFS v3 and later. The owner of a lease refreshes its modification time while it works on the
+image, and writes a done marker when finished. A lease that has not been refreshed for longer than the lease timeout is
+considered abandoned, e.g. if its host died, and is recovered by renaming it away, which only one process can succeed
+at, before claiming the index again. Another process may have recovered the same lease and claimed the index again
+between the age check and the rename, in which case the renamed lease is fresh and is put back. If yet another process
+created a lease in the meantime, the index is rendered twice.
+
+Rendering an image again is harmless, so the lease timeout only needs to be much longer than the heartbeat interval.
+"""
+import os
+import json
+import time
+import socket
+import threading
+
+
+class LeaseQueue:
+    """ Work queue of image indices, backed by lease files and done markers in a shared directory. """
+
+    def __init__(self, queue_dir, lease_timeout=600, owner=None):
+        """
+        :param queue_dir: directory shared by all the processes working on the job. Created if it does not exist.
+        :param lease_timeout: time in seconds after which a lease that was not refreshed can be recovered
+        :param owner: name of this process in the leases and done markers. Default is <hostname>-<pid>.
+        """
+        os.makedirs(queue_dir, exist_ok=True)
+        self.queue_dir = queue_dir
+        self.lease_timeout = lease_timeout
+        self.owner = owner if owner is not None else '%s-%d' % (socket.gethostname(), os.getpid())
+        self.leases = set()
+        # Position in the indices of claim_batch where the next scan starts
+        self.cursor = 0
+        self.lock = threading.Lock()
+        self.heartbeat_thread = None
+        self.stop_heartbeat = threading.Event()
+
+    def lease_path(self, index):
+        return os.path.join(self.queue_dir, '%08d.lease' % index)
+
+    def done_path(self, index):
+        return os.path.join(self.queue_dir, '%08d.done' % index)
+
+    def is_done(self, index):
+        return os.path.isfile(self.done_path(index))
+
+    def claim(self, index):
+        """
+        Try to claim an image index.
+
+        :param index: image index
+        :return: True if this process now holds the lease of the index
+        """
+        if self.is_done(index):
+            return False
+        path = self.lease_path(index)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._recover(path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'owner': self.owner, 'time': time.time()}, f)
+            # The index may have been completed between the done check and the lease creation
+            if self.is_done(index):
+                os.remove(path)
+                return False
+            with self.lock:
+                self.leases.add(index)
+            return True
+        return False
+
+    def claim_batch(self, indices, size):
+        """
+        Claim up to size image indices, in the order of indices. The scan starts where the previous call stopped, so
+        that successive calls over the same indices check each index once instead of checking all the indices claimed
+        so far again. Once the end is reached, the scan starts again from the beginning, to claim the indices released
+        or abandoned by other processes in the meantime.
+
+        :param indices: sequence of image indices of the job, the same in all the calls
+        :param size: maximum number of indices to claim
+        :return: list of the claimed indices
+        """
+        claimed = []
+        if self.cursor >= len(indices):
+            self.cursor = 0
+        for _ in range(len(indices)):
+            if len(claimed) >= size:
+                break
+            index = indices[self.cursor]
+            self.cursor = (self.cursor + 1) % len(indices)
+            if self.claim(index):
+                claimed.append(index)
+        return claimed
+
+    def _recover(self, path):
+        """ Remove an abandoned lease. Returns True if it was abandoned and is now removed. """
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
+            # Released in the meantime
+            return True
+        if age < self.lease_timeout:
+            return False
+        stale_path = '%s.%s.stale' % (path, self.owner)
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            # Recovered by another process first
+            return False
+        # The lease may have been recovered and claimed again by another process since the age check
+        if time.time() - os.stat(stale_path).st_mtime < self.lease_timeout:
+            try:
+                # Unlike rename, link does not replace a lease created in the meantime
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def complete(self, index, info=None):
+        """
+        Mark a claimed index as done and release its lease.
+
+        :param index: image index
+        :param info: optional json-serializable information stored in the done marker
+        """
+        tmp_path = '%s.%s.tmp' % (self.done_path(index), self.owner)
+        with open(tmp_path, 'w') as f:
+            json.dump({'owner': self.owner, 'time': time.time(), 'info': info}, f)
+        os.replace(tmp_path, self.done_path(index))
+        self.release(index)
+
+    def release(self, index):
+        """
+        Release the lease of a claimed index without marking it as done, e.g. if its processing failed.
+        The lease file is left in place if it was recovered and claimed by another process in the meantime.
+
+        :param index: image index
+        """
+        with self.lock:
+            self.leases.discard(index)
+        if self.lease_owner(index) != self.owner:
+            return
+        try:
+            os.remove(self.lease_path(index))
+        except FileNotFoundError:
+            pass
+
+    def lease_owner(self, index):
+        """
+        :param index: image index
+        :return: owner of the lease of the index, or None if it is not leased or its lease is being created
+        """
+        try:
+            with open(self.lease_path(index)) as f:
+                return json.load(f)['owner']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def heartbeat(self):
+        """ Refresh the leases held by this process. """
+        with self.lock:
+            leases = list(self.leases)
+        for index in leases:
+            try:
+                os.utime(self.lease_path(index))
+            except FileNotFoundError:
+                pass
+
+    def start_heartbeat(self, interval=None):
+        """
+        Refresh the leases in a background thread.
+
+        :param interval: time in seconds between two refreshes. Default is a tenth of the lease timeout.
+        """
+        if self.heartbeat_thread is not None:
+            return
+        interval = interval if interval is not None else self.lease_timeout / 10
+        self.stop_heartbeat.clear()
+
+        def run():
+            while not self.stop_heartbeat.wait(interval):
+                self.heartbeat()
+
+        self.heartbeat_thread = threading.Thread(target=run, daemon=True)
+        self.heartbeat_thread.start()
+
+    def close(self):
+        """ Stop the heartbeat and release the leases still held. """
+        if self.heartbeat_thread is not None:
+            self.stop_heartbeat.set()
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+        with self.lock:
+            leases = list(self.leases)
+        for index in leases:
+            self.release(index)
+
+    def status(self, indices):
+        """
+        :param indices: sequence of image indices of the job
+        :return: dictionary of the number of indices done, leased and pending
+        """
+        done = leased = 0
+        for index in indices:
+            if self.is_done(index):
+                done += 1
+            elif os.path.exists(self.lease_path(index)):
+                leased += 1
+        return {'done': done, 'leased': leased, 'pending': len(indices) - done - leased}
+
+    def done_info(self, index):
+        """
+        :param index: image index
+        :return: content of the done marker of the index: owner, time and info
+        """
+        with open(self.done_path(index)) as f:
+            return json.load(f)
+
+    def wait(self, indices, poll_interval=5, timeout=None):
+        """
+        Wait until all indices are done, e.g. before encoding the movie of the job.
+
+        :param indices: sequence of image indices of the job
+        :param poll_interval: time in seconds between two checks
+        :param timeout: maximum waiting time in seconds. Default waits forever.
+        :return: True if all indices are done
+        """
+        start = time.time()
+        while True:
+            if all(self.is_done(index) for index in indices):
+                return True
+            if timeout is not None and time.time() - start >= timeout:
+                return False
+            time.sleep(poll_interval)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,284 @@
+"""
+Writing of the output images, in a choice of formats, optionally in background threads.
+
+A FrameWriter encodes and writes the images either in the calling thread, or in a pool of background threads so that
+the processing of the next image is not stalled by the encoding and the disk. The number of images waiting to be
+written is bounded, and the images are copied when submitted, so the caller can reuse its buffers right away.
+Files are written under a temporary name and renamed, so that encode_video never picks up a partially written image.
+
+A TilePyramidWriter writes the images as tile pyramids for zoomable viewers.
+"""
+import io
+import os
+import json
+import math
+import hashlib
+import threading
+import concurrent.futures
+import numpy as np
+import cv2
+import instrumentation
+
+# File extension of each image format. png16 and tiff16 are 16 bits per channel, for archival.
+image_formats = {'jpeg': '.jpeg', 'png': '.png', 'png16': '.png', 'tiff16': '.tiff', 'npy': '.npy'}
+
+
+class FrameWriter:
+    """ Encode and write 3-channel bgr images, as jpeg, png, 16-bit png or tiff, or numpy .npy files. """
+
+    def __init__(self, image_format='jpeg', quality=95, png_compression=1, nthreads=0, max_pending=4):
+        """
+        :param image_format: one of image_formats
+        :param quality: jpeg quality in [0-100]
+        :param png_compression: png compression level in [0-9]. Low levels are much faster for a slightly bigger file.
+        :param nthreads: number of background threads writing the images. 0 writes them in the calling thread.
+        :param max_pending: maximum number of images submitted and not yet written. Submitting more waits.
+        """
+        if image_format not in image_formats:
+            raise ValueError('image_format must be one of %s' % ', '.join(image_formats))
+        self.image_format = image_format
+        self.quality = quality
+        self.png_compression = png_compression
+        self.nthreads = nthreads
+        self.max_pending = max_pending
+        self.executor = None
+        self.slots = None
+        self.futures = []
+
+    def __getstate__(self):
+        # The thread pool is created again in each worker process
+        state = self.__dict__.copy()
+        state.update(executor=None, slots=None, futures=[])
+        return state
+
+    def __repr__(self):
+        # Only the parameters that determine the written files, e.g. for manifest.parameters_hash
+        return 'FrameWriter(image_format=%r, quality=%r, png_compression=%r)' % (self.image_format, self.quality,
+                                                                                 self.png_compression)
+
+    @property
+    def extension(self):
+        return image_formats[self.image_format]
+
+    @property
+    def bit_depth(self):
+        """ 16 for the 16-bit formats, 8 otherwise. Images in .npy files keep their data type. """
+        return 16 if self.image_format in ('png16', 'tiff16') else 8
+
+    def filename(self, basename, index):
+        """
+        :param basename: path and base name of the images
+        :param index: image number
+        :return: path of the image file
+        """
+        return '%s_%04d%s' % (basename, index, self.extension)
+
+    def convert(self, frame):
+        """
+        Copy of an image in the data type of the format.
+
+        :param frame: 8-bit image, or floating-point image in the [0-255] range, e.g. before its conversion to 8 bits.
+        :return: new numpy array, 16-bit for the 16-bit formats, 8-bit for jpeg and png, unchanged for npy.
+        """
+        frame = np.asarray(frame)
+        if self.image_format == 'npy':
+            return frame.copy()
+        if self.bit_depth == 16:
+            if frame.dtype == np.uint8:
+                # 255 -> 65535
+                return frame.astype(np.uint16) * np.uint16(257)
+            return np.clip(np.rint(frame * 257), 0, 65535).astype(np.uint16)
+        if frame.dtype == np.uint8:
+            return frame.copy()
+        return np.clip(frame, 0, 255).astype(np.uint8)
+
+    def encode(self, frame):
+        """
+        :param frame: image converted with convert()
+        :return: bytes of the image file
+        """
+        if self.image_format == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, frame)
+            return buffer.getvalue()
+        if self.image_format == 'jpeg':
+            params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+        elif self.image_format == 'tiff16':
+            params = []
+        else:
+            params = [int(cv2.IMWRITE_PNG_COMPRESSION), self.png_compression]
+        _, buffer = cv2.imencode(self.extension, frame, params)
+        return buffer.tobytes()
+
+    def _write(self, path, frame, image_index=None):
+        with instrumentation.stage('imwrite', frame=image_index) as stage:
+            data = self.encode(frame)
+            tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            stage.add(bytes_written=len(data))
+
+    def write(self, basename, index, frame):
+        """
+        Write an image, or submit it to the background threads.
+
+        :param basename: path and base name of the images
+        :param index: image number
+        :param frame: image. See convert().
+        :return: path of the image file
+        """
+        path = self.filename(basename, index)
+        if self.nthreads <= 0:
+            self._write(path, self.convert(frame))
+            return path
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.nthreads)
+            self.slots = threading.BoundedSemaphore(self.max_pending)
+        frame = self.convert(frame)
+        self.slots.acquire()
+        # Recorded as a stage of the image being processed when submitted, not when written
+        future = self.executor.submit(self._write, path, frame, instrumentation.current_frame())
+        future.add_done_callback(lambda _: self.slots.release())
+        # Finished writes are dropped, except the failed ones so that flush() raises their error
+        self.futures = [f for f in self.futures if not f.done() or f.exception() is not None] + [future]
+        return path
+
+    def flush(self):
+        """ Wait until all submitted images are written. Raises the first error of the writes, if any. """
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """ Flush and stop the background threads. """
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+# Synchronous jpeg writer at quality 95, used when no writer is given
+default_frame_writer = FrameWriter()
+
+
+class TilePyramidWriter:
+    """ Write images as Deep Zoom tile pyramids for zoomable viewers, e.g. OpenSeadragon.
+    The pyramid is built in memory from the output image by successive 2x downsampling, down to a single pixel, and
+    the tiles are encoded by a pool of threads. The hash of the pixels of each tile is kept in a json file of the
+    pyramid, so that rewriting an image only encodes and writes the tiles whose content changed.
+
+    For an image named im_lab_0042, the pyramid is written as im_lab_0042.dzi and the tiles as
+    im_lab_0042_files/<level>/<column>_<row>.<tile_format>, level 0 being the 1x1 pixel image.
+    """
+
+    def __init__(self, output_dir, basename='im_tiles', tile_size=256, overlap=0, tile_format='jpeg', quality=95,
+                 nthreads=4):
+        """
+        :param output_dir: directory of the pyramids
+        :param basename: basename of the pyramids, appended with the image number
+        :param tile_size: width and height of the tiles, without overlap
+        :param overlap: number of pixels of each tile overlapping its neighbours
+        :param tile_format: 'jpeg' or 'png'
+        :param quality: jpeg quality
+        :param nthreads: number of threads encoding and writing the tiles
+        """
+        if tile_format not in ('jpeg', 'png'):
+            raise ValueError("tile_format must be 'jpeg' or 'png'")
+        self.output_dir = output_dir
+        self.basename = basename
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.tile_format = tile_format
+        self.quality = quality
+        self.nthreads = nthreads
+        self.executor = None
+
+    def __getstate__(self):
+        # The thread pool is created again in each worker process
+        state = self.__dict__.copy()
+        state['executor'] = None
+        return state
+
+    def pyramid_levels(self, image):
+        """
+        :param image: full resolution image
+        :return: list of the images of each level, from level 0 (1x1 pixel) to the full resolution image
+        """
+        levels = [image]
+        while max(levels[-1].shape[0:2]) > 1:
+            height, width = levels[-1].shape[0:2]
+            levels.append(cv2.resize(levels[-1], (math.ceil(width / 2), math.ceil(height / 2)),
+                                     interpolation=cv2.INTER_AREA))
+        return levels[::-1]
+
+    def tiles(self, level_image):
+        """
+        :param level_image: image of a pyramid level
+        :return: list of (column, row, tile) of the level, tiles being views of the level image
+        """
+        height, width = level_image.shape[0:2]
+        tiles = []
+        for row in range(math.ceil(height / self.tile_size)):
+            for col in range(math.ceil(width / self.tile_size)):
+                x0 = max(col * self.tile_size - self.overlap, 0)
+                y0 = max(row * self.tile_size - self.overlap, 0)
+                x1 = min((col + 1) * self.tile_size + self.overlap, width)
+                y1 = min((row + 1) * self.tile_size + self.overlap, height)
+                tiles.append((col, row, level_image[y0:y1, x0:x1]))
+        return tiles
+
+    def write(self, image, index):
+        """
+        Write the pyramid of an image. Unchanged tiles of an existing pyramid are left untouched.
+
+        :param image: 8-bit bgr image as numpy array [height, width, 3]
+        :param index: image number
+        :return: number of bytes written
+        """
+        name = '%s_%04d' % (self.basename, index)
+        tiles_dir = os.path.join(self.output_dir, name + '_files')
+        hash_file = os.path.join(tiles_dir, 'tiles.json')
+        hashes = {}
+        if os.path.isfile(hash_file):
+            with open(hash_file) as f:
+                hashes = json.load(f)
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.nthreads)
+
+        tasks = []
+        for level, level_image in enumerate(self.pyramid_levels(image)):
+            os.makedirs(os.path.join(tiles_dir, str(level)), exist_ok=True)
+            for col, row, tile in self.tiles(level_image):
+                tasks.append(('%d/%d_%d.%s' % (level, col, row, self.tile_format), tile))
+        new_hashes = dict(self.executor.map(lambda task: self._write_tile(tiles_dir, hashes, *task), tasks))
+
+        nbytes = 0
+        for key, (digest, size) in new_hashes.items():
+            nbytes += size
+            hashes[key] = digest
+        self._write_file(hash_file, json.dumps(hashes).encode())
+        dzi = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="%d" Overlap="%d" Format="%s">'
+               '<Size Width="%d" Height="%d"/></Image>\n' % (self.tile_size, self.overlap, self.tile_format,
+                                                               image.shape[1], image.shape[0]))
+        self._write_file(os.path.join(self.output_dir, name + '.dzi'), dzi.encode())
+        return nbytes
+
+    def _write_tile(self, tiles_dir, hashes, key, tile):
+        digest = hashlib.blake2b(np.ascontiguousarray(tile).data, digest_size=16).hexdigest()
+        path = os.path.join(tiles_dir, key)
+        if hashes.get(key) == digest and os.path.isfile(path):
+            return key, (digest, 0)
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality] if self.tile_format == 'jpeg' else []
+        _, buffer = cv2.imencode('.' + self.tile_format, tile, params)
+        self._write_file(path, buffer.tobytes())
+        return key, (digest, buffer.size)
+
+    @staticmethod
+    def _write_file(path, data):
+        # Written under a temporary name and renamed, so that viewers never read a partially written file
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)